@@ -0,0 +1,49 @@
+-- benchmarks/daily_tickets_archive.sql
+-- Hot daily_tickets queries with a year of history, before and after archival.
+-- Needs migrations/002_daily_tickets_archive.sql applied first. Everything runs
+-- inside one transaction that is rolled back, so it can be pointed at a staging
+-- copy of the database without leaving synthetic rows behind. Synthetic users
+-- get negative telegram_ids to avoid clashing with real ones.
+-- Run with: psql "$DATABASE_URL" -f benchmarks/daily_tickets_archive.sql
+-- Compare the "Execution Time" lines of the two EXPLAIN ANALYZE blocks.
+
+begin;
+
+-- 2,000 buyers a day for 365 days (~730k rows), each closed day has a winner.
+insert into public.users (telegram_id, first_name, join_date)
+select -g, 'bench', now() - interval '400 days'
+from generate_series(1, 2000) g
+on conflict (telegram_id) do nothing;
+
+insert into public.daily_tickets (telegram_id, date, count)
+select -u, current_date - d, 1 + (u % 3)
+from generate_series(0, 364) d, generate_series(1, 2000) u;
+
+insert into public.winners (telegram_id, amount, win_date)
+select -1, 1.00, current_date - d
+from generate_series(2, 364) d;
+
+analyze public.daily_tickets;
+
+\echo '--- Before archival: a year of history in daily_tickets ---'
+explain (analyze, buffers) select count from public.daily_tickets where date = current_date;
+explain (analyze, buffers) select telegram_id, count from public.daily_tickets where date = current_date - 1;
+explain (analyze, buffers) select count from public.daily_tickets where telegram_id = -42 and date = current_date;
+
+select public.archive_daily_tickets(current_date - 1) as archived_dates;
+analyze public.daily_tickets;
+
+\echo '--- After archival: only today and yesterday are hot ---'
+explain (analyze, buffers) select count from public.daily_tickets where date = current_date;
+explain (analyze, buffers) select telegram_id, count from public.daily_tickets where date = current_date - 1;
+explain (analyze, buffers) select count from public.daily_tickets where telegram_id = -42 and date = current_date;
+
+\echo '--- Archived day lookups ---'
+explain (analyze, buffers) select telegram_ids, counts from public.daily_tickets_archive where date = current_date - 30;
+explain (analyze, buffers) select total_tickets from public.daily_ticket_summaries where date = current_date - 30;
+
+select (select count(*) from public.daily_tickets) as hot_rows,
+       (select count(*) from public.daily_tickets_archive) as archived_dates,
+       pg_size_pretty(pg_total_relation_size('public.daily_tickets_archive')) as archive_size;
+
+rollback;
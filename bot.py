@@ -5,16 +5,38 @@ import logging # logging को पहले इम्पोर्ट करे
 import asyncio
 import random
 import datetime
+import csv
+import gzip
+import bisect
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import multiprocessing
+import queue
+import signal
+import tempfile
+import sys
+import time
+import threading
+import traceback
+import tracemalloc
+import uuid
+from collections import Counter, deque
 from decimal import Decimal, ROUND_HALF_UP # <--- YAHAN COMMA SAHI KIYA GAYA
 
 # from dotenv import load_dotenv # Uncomment if using a .env file locally
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
 from telegram.constants import ParseMode
 
 from supabase.client import create_client, Client # Sahi import
+from postgrest.exceptions import APIError
 
+import httpx
 import pytz
 
 # --- Logging Configuration (इसे एनवायरनमेंट वेरिएबल लोड होने के ठीक बाद रखें) ---
@@ -39,6 +61,19 @@ TICKET_PRICE_USDT_STR = os.getenv("TICKET_PRICE_USDT", "4.0")
 REFERRAL_PERCENT_STR = os.getenv("REFERRAL_PERCENT", "0.25")
 GLOBAL_CRYPTO_TAX_PERCENT_STR = os.getenv("GLOBAL_CRYPTO_TAX_PERCENT", "0.25")
 TIMEZONE_STR = os.getenv("TIMEZONE", "Asia/Kolkata")
+ERROR_ALERT_WINDOW_SECONDS_STR = os.getenv("ERROR_ALERT_WINDOW_SECONDS", "60")
+ERROR_ALERT_MAX_WINDOW_SECONDS_STR = os.getenv("ERROR_ALERT_MAX_WINDOW_SECONDS", "3600")
+DB_TIMEOUT_SECONDS_STR = os.getenv("DB_TIMEOUT_SECONDS", "5")
+DB_READ_RETRIES_STR = os.getenv("DB_READ_RETRIES", "2")
+DB_CIRCUIT_FAILURE_THRESHOLD_STR = os.getenv("DB_CIRCUIT_FAILURE_THRESHOLD", "5")
+DB_CIRCUIT_COOLDOWN_SECONDS_STR = os.getenv("DB_CIRCUIT_COOLDOWN_SECONDS", "30")
+OUTBOUND_MESSAGES_PER_SECOND_STR = os.getenv("OUTBOUND_MESSAGES_PER_SECOND", "30")
+OUTBOUND_CONNECTION_POOL_SIZE_STR = os.getenv("OUTBOUND_CONNECTION_POOL_SIZE", "32")
+HOURLY_ROUNDS_ENABLED = os.getenv("HOURLY_ROUNDS_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+HOURLY_TICKET_PRICE_USDT_STR = os.getenv("HOURLY_TICKET_PRICE_USDT", TICKET_PRICE_USDT_STR)
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH") # set to record incoming updates for replay_updates.py
+RECORD_UPDATES_SECRET = os.getenv("RECORD_UPDATES_SECRET")
+BOT_WORKERS_STR = os.getenv("BOT_WORKERS", "1")
 
 logger.debug(f"STAGE 2.0: BOT_TOKEN loaded: {bool(BOT_TOKEN)}")
 logger.debug(f"STAGE 2.1: ADMIN_ID_STR loaded: {bool(ADMIN_ID_STR)}")
@@ -65,6 +100,16 @@ try:
     TICKET_PRICE_USDT = Decimal(TICKET_PRICE_USDT_STR)
     REFERRAL_PERCENT = Decimal(REFERRAL_PERCENT_STR)
     GLOBAL_CRYPTO_TAX_PERCENT = Decimal(GLOBAL_CRYPTO_TAX_PERCENT_STR)
+    ERROR_ALERT_WINDOW_SECONDS = int(ERROR_ALERT_WINDOW_SECONDS_STR)
+    ERROR_ALERT_MAX_WINDOW_SECONDS = int(ERROR_ALERT_MAX_WINDOW_SECONDS_STR)
+    DB_TIMEOUT_SECONDS = float(DB_TIMEOUT_SECONDS_STR)
+    DB_READ_RETRIES = int(DB_READ_RETRIES_STR)
+    DB_CIRCUIT_FAILURE_THRESHOLD = int(DB_CIRCUIT_FAILURE_THRESHOLD_STR)
+    DB_CIRCUIT_COOLDOWN_SECONDS = float(DB_CIRCUIT_COOLDOWN_SECONDS_STR)
+    OUTBOUND_MESSAGES_PER_SECOND = float(OUTBOUND_MESSAGES_PER_SECOND_STR)
+    OUTBOUND_CONNECTION_POOL_SIZE = int(OUTBOUND_CONNECTION_POOL_SIZE_STR)
+    HOURLY_TICKET_PRICE_USDT = Decimal(HOURLY_TICKET_PRICE_USDT_STR)
+    BOT_WORKERS = int(BOT_WORKERS_STR)
     logger.info("STAGE 4.0: Basic numeric environment variables converted.")
 
     if not (Decimal(0) <= REFERRAL_PERCENT <= Decimal(1)):
@@ -73,6 +118,9 @@ try:
     if not (Decimal(0) <= GLOBAL_CRYPTO_TAX_PERCENT <= Decimal(1)):
         logger.error("FATAL: GLOBAL_CRYPTO_TAX_PERCENT must be between 0 and 1. Exiting.")
         exit(1)
+    if BOT_WORKERS < 1:
+        logger.error("FATAL: BOT_WORKERS must be at least 1. Exiting.")
+        exit(1)
     if (REFERRAL_PERCENT + GLOBAL_CRYPTO_TAX_PERCENT) > Decimal(1):
         logger.error("FATAL: Sum of REFERRAL_PERCENT and GLOBAL_CRYPTO_TAX_PERCENT cannot exceed 1. Exiting.")
         exit(1)
@@ -93,6 +141,7 @@ logger.info(f"Ticket Price: {TICKET_PRICE_USDT} USDT")
 logger.info(f"Referral Percent: {REFERRAL_PERCENT*100}%")
 logger.info(f"Global Crypto Tax Percent: {GLOBAL_CRYPTO_TAX_PERCENT*100}%")
 logger.info(f"Prize Pool Contribution Percent: {PRIZE_POOL_CONTRIBUTION_PERCENT*100}%")
+logger.info(f"Hourly Rounds: {'enabled' if HOURLY_ROUNDS_ENABLED else 'disabled'} (Ticket Price: {HOURLY_TICKET_PRICE_USDT} USDT)")
 
 # --- Supabase Client ---
 logger.info("STAGE 6: Attempting to connect to Supabase.")
@@ -125,17 +174,126 @@ except Exception as e:
     exit(1)
 
 # --- Global State (for pending payments - Simple in-memory approach) ---
-pending_payments = {} # {user_id: {amount_paid: Decimal, num_tickets: int, message_id: int, date: date, chat_id: int}}
+pending_payments = {} # {user_id: {amount_paid: Decimal, num_tickets: int, message_id: int, date: date, chat_id: int, round_id: str | None, claim_id: str}}
+# BOT_WORKERS > 1 mein har worker ke paas apne users ke claims hain; /stats (worker 0) sabka count yahan se padhta hai.
+shared_pending_payment_counts = None # multiprocessing.Array, ek slot per worker; sirf worker processes mein set hota hai
+worker_slot = 0
+
+def publish_pending_payment_count() -> None:
+    if shared_pending_payment_counts is not None:
+        shared_pending_payment_counts[worker_slot] = len(pending_payments)
+
+def pending_payment_count() -> int:
+    if shared_pending_payment_counts is None:
+        return len(pending_payments)
+    return sum(shared_pending_payment_counts[:])
 logger.debug("STAGE 7: Global state 'pending_payments' initialized.")
 
+# --- Database Resilience: timeouts, retries, circuit breaker ---
+# supabase-py ka client synchronous hai, isliye har call apne DB thread pool mein chalti hai (event loop aur
+# default executor block nahi hote). Idempotent calls per-operation timeout aur jittered backoff ke saath
+# retry hote hain. Non-idempotent writes par timeout nahi lagta: timeout thread ko cancel nahi karta, to
+# write baad mein bhi lag sakti hai jabki caller use fail maan chuka hota. Unhe postgrest client ka apna
+# HTTP timeout rokta hai. Lagataar failures par circuit open ho jaata hai: tab calls turant
+# DatabaseUnavailableError deti hain aur read helpers last-known-good cached value lautate hain.
+DB_OPERATION_TIMEOUTS = { # seconds; baaki sab ke liye DB_TIMEOUT_SECONDS
+    'get_all_user_telegram_ids': 15.0,
+    'get_daily_ticket_entries_for_draw': 15.0,
+    'reconcile_daily_stats': 60.0,
+}
+DB_RETRY_BASE_DELAY_SECONDS = 0.2
+DB_EXECUTOR_WORKERS = 16
+db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="supabase")
+
+class DatabaseUnavailableError(Exception):
+    """Supabase circuit is open, or a call timed out / failed after its retries."""
+
+db_circuit = {'state': 'closed', 'consecutive_failures': 0, 'opened_at': 0.0}
+db_last_known_good = {} # {(operation, key): value}
+
+def db_circuit_allows_call() -> bool:
+    if db_circuit['state'] == 'closed':
+        return True
+    if db_circuit['state'] == 'open' and time.monotonic() - db_circuit['opened_at'] >= DB_CIRCUIT_COOLDOWN_SECONDS:
+        # Cooldown khatam: ek trial call ko jaane do (half-open).
+        db_circuit['state'] = 'half_open'
+        logger.info("DB_CIRCUIT: Cooldown elapsed, circuit half-open. Allowing a trial call.")
+        return True
+    return False
+
+def record_db_success() -> None:
+    if db_circuit['state'] != 'closed':
+        logger.info("DB_CIRCUIT: Trial call succeeded, circuit closed.")
+    db_circuit['state'] = 'closed'
+    db_circuit['consecutive_failures'] = 0
+
+def record_db_failure(operation: str, error: BaseException) -> None:
+    db_circuit['consecutive_failures'] += 1
+    logger.warning(f"DB_CIRCUIT: {operation} failed ({db_circuit['consecutive_failures']} consecutive): {type(error).__name__} - {error}")
+    if db_circuit['state'] == 'half_open' or db_circuit['consecutive_failures'] >= DB_CIRCUIT_FAILURE_THRESHOLD:
+        if db_circuit['state'] != 'open':
+            logger.error(f"DB_CIRCUIT: Opening circuit for {DB_CIRCUIT_COOLDOWN_SECONDS}s after {db_circuit['consecutive_failures']} consecutive failures.")
+        db_circuit['state'] = 'open'
+        db_circuit['opened_at'] = time.monotonic()
+
+def remember_last_known_good(operation: str, key, value) -> None:
+    db_last_known_good[(operation, key)] = value
+
+def last_known_good(operation: str, key, default=None):
+    return db_last_known_good.get((operation, key), default)
+
+async def run_db_query(operation: str, build_query, idempotent: bool = True):
+    """Run build_query().execute() on the DB thread pool with timeout, retries and the circuit breaker.
+
+    Only idempotent calls get the per-operation timeout and retries. A non-idempotent write is awaited
+    until the client itself returns or fails, so it is never reported failed while its thread may still
+    commit it. PostgREST APIErrors (e.g. PGRST116 for single() with
+    0 rows) mean the database answered, so they count as success and are re-raised unchanged for the
+    caller to interpret.
+    """
+    if not db_circuit_allows_call():
+        raise DatabaseUnavailableError(f"Circuit open, skipping {operation}")
+
+    loop = asyncio.get_running_loop()
+    timeout = DB_OPERATION_TIMEOUTS.get(operation, DB_TIMEOUT_SECONDS) if idempotent else None
+    attempts = 1 + (DB_READ_RETRIES if idempotent else 0)
+    for attempt in range(1, attempts + 1):
+        try:
+            response = await asyncio.wait_for(loop.run_in_executor(db_executor, lambda: build_query().execute()), timeout=timeout)
+        except APIError:
+            record_db_success()
+            raise
+        except Exception as e:
+            record_db_failure(operation, e)
+            if attempt >= attempts or db_circuit['state'] == 'open':
+                raise DatabaseUnavailableError(f"{operation} failed after {attempt} attempt(s): {type(e).__name__} - {e}") from e
+            delay = random.uniform(0, DB_RETRY_BASE_DELAY_SECONDS * (2 ** attempt)) # full jitter
+            logger.debug(f"DB: Retrying {operation} in {delay:.2f}s (attempt {attempt + 1}/{attempts}).")
+            await asyncio.sleep(delay)
+            continue
+        record_db_success()
+        return response
+
 # --- Helper Functions: Database ---
 async def get_user(telegram_id: int):
-    """Fetch a user from the database by telegram_id."""
+    """Fetch a user from the database by telegram_id. None means the user is not registered.
+
+    During an outage the last-known-good copy is served; without one DatabaseUnavailableError is raised,
+    because "unknown" must not be mistaken for "not registered".
+    """
     logger.debug(f"DB: Attempting to get user {telegram_id}")
     try:
-        response = supabase.from_('users').select('*').eq('telegram_id', telegram_id).single().execute()
+        response = await run_db_query('get_user', lambda: supabase.from_('users').select('*').eq('telegram_id', telegram_id).single())
         logger.debug(f"DB: Get user {telegram_id} response: {response.data is not None}")
+        remember_last_known_good('get_user', telegram_id, response.data)
         return response.data
+    except DatabaseUnavailableError as e:
+        cached_user = last_known_good('get_user', telegram_id)
+        if cached_user is None:
+            logger.warning(f"DB degraded and no cached copy of user {telegram_id}: {e}")
+            raise
+        logger.warning(f"DB degraded, serving cached user {telegram_id}: {e}")
+        return cached_user
     except Exception as e:
         if hasattr(e, 'message') and "PGRST116" in e.message and "0 rows" in e.message: 
             logger.debug(f"Supabase: User {telegram_id} not found (0 rows for single() - old lib).")
@@ -147,112 +305,128 @@ async def get_user(telegram_id: int):
             logger.error(f"Supabase error fetching user {telegram_id}: {type(e)} - {e}")
         return None
 
-async def create_user(telegram_id: int, username: str | None, first_name: str | None, last_name: str | None, referrer_telegram_id: int | None = None):
-    """Create a new user in the database."""
+async def create_user(telegram_id: int, username: str | None, first_name: str | None, last_name: str | None, referrer_telegram_id: int | None = None,
+                      notifications: list[dict] | None = None):
+    """Create a new user in the database. The signup is counted in daily_stats / referral_stats and
+    notifications are queued in the outbox, all in the same transaction."""
     logger.debug(f"DB: Attempting to create user {telegram_id}")
     try:
-        data_to_insert = {
-            'telegram_id': telegram_id,
-            'username': username,
-            'first_name': first_name,
-            'last_name': last_name,
-            'referrer_telegram_id': referrer_telegram_id,
-            'join_date': datetime.datetime.now(pytz.timezone(TIMEZONE_STR)).isoformat()
-        }
-        response = supabase.from_('users').insert([data_to_insert]).execute()
+        join_date = datetime.datetime.now(pytz.timezone(TIMEZONE_STR))
+        response = await run_db_query('create_user', lambda: supabase.rpc('register_user', {
+            'telegram_id_input': telegram_id,
+            'username_input': username,
+            'first_name_input': first_name,
+            'last_name_input': last_name,
+            'referrer_id_input': referrer_telegram_id,
+            'join_date_input': join_date.isoformat(),
+            'stat_date_input': join_date.date().isoformat(),
+            'notifications_input': outbox_rows(notifications or [])
+        }), idempotent=False)
         if response.data:
             logger.info(f"New user created: {telegram_id} (Referrer: {referrer_telegram_id})")
+            remember_last_known_good('get_user', telegram_id, response.data[0])
             return response.data[0]
-        
-        error_msg = "Unknown error creating user."
-        if hasattr(response, 'error') and response.error:
-            error_msg = response.error.message
-            if hasattr(response.error, 'details') and response.error.details: 
-                error_msg += f" Details: {response.error.details}"
-            elif hasattr(response.error, 'hint') and response.error.hint:
-                error_msg += f" Hint: {response.error.hint}"
-        logger.error(f"Supabase error creating user {telegram_id}: {error_msg}")
+        logger.error(f"Supabase RPC register_user returned no row for user {telegram_id}.")
         return None
     except Exception as e:
         logger.error(f"Exception creating user {telegram_id}: {e}")
         return None
 
-async def increment_daily_tickets_for_user(telegram_id: int, num_tickets: int = 1):
-    logger.debug(f"DB: Attempting to increment {num_tickets} tickets for user {telegram_id} via RPC.")
-    if num_tickets <= 0:
-        logger.warning(f"Attempted to increment 0 or negative tickets for user {telegram_id}.")
-        return False
-    try:
-        today_iso = datetime.date.today().isoformat()
-        response = supabase.rpc('increment_daily_ticket', {
-            'user_id_input': telegram_id,
-            'ticket_date_input': today_iso,
-            'num_tickets_to_add': num_tickets
-        }).execute()
-
-        if hasattr(response, 'error') and response.error:
-             logger.error(f"Supabase RPC error incrementing {num_tickets} tickets for {telegram_id} on {today_iso}: {response.error.message}")
-             return False
-        
-        logger.info(f"{num_tickets} tickets incremented via RPC for user {telegram_id} for {today_iso}.")
-        return True
-    except Exception as e: 
-        logger.error(f"Exception calling RPC increment_daily_ticket for user {telegram_id} ({num_tickets} tickets): {e}")
-        if hasattr(e, 'message'): logger.error(f"RPC Exception details: {getattr(e, 'message', 'N/A')}")
-        if hasattr(e, 'details'): logger.error(f"RPC Exception details: {getattr(e, 'details', 'N/A')}")
-        if hasattr(e, 'hint'): logger.error(f"RPC Exception hint: {getattr(e, 'hint', 'N/A')}")
-        return False
-
 async def get_total_tickets_for_date(date_obj: datetime.date) -> int:
     logger.debug(f"DB: Getting total tickets for date {date_obj.isoformat()}")
     try:
-        response = supabase.from_('daily_tickets').select('count').eq('date', date_obj.isoformat()).execute()
+        response = await run_db_query('get_total_tickets_for_date', lambda: supabase.from_('daily_tickets').select('count').eq('date', date_obj.isoformat()))
         
+        total = 0
         if response.data:
             total = sum(item['count'] for item in response.data if isinstance(item.get('count'), int))
             logger.debug(f"DB: Total tickets for {date_obj.isoformat()}: {total}")
-            return total
-        logger.debug(f"DB: No ticket data found for {date_obj.isoformat()} to sum.")
-        return 0
+        elif is_archivable_date(date_obj):
+            total = await get_archived_ticket_total(date_obj)
+        else:
+            logger.debug(f"DB: No ticket data found for {date_obj.isoformat()} to sum.")
+        remember_last_known_good('get_total_tickets_for_date', date_obj, total)
+        return total
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached ticket total for {date_obj}: {e}")
+        return last_known_good('get_total_tickets_for_date', date_obj, 0)
     except Exception as e:
         logger.error(f"Supabase error fetching total tickets for {date_obj}: {e}")
         return 0
 
 async def get_daily_ticket_entries_for_draw(date_obj: datetime.date) -> list:
+    # Draw ke liye stale cache kabhi use nahi hota; padh na paaye to DatabaseUnavailableError, taaki draw "0 tickets" na samjhe.
     logger.debug(f"DB: Getting daily ticket entries for draw on {date_obj.isoformat()}")
     try:
-        response = supabase.from_('daily_tickets').select('telegram_id, count').eq('date', date_obj.isoformat()).execute()
-        logger.debug(f"DB: Fetched {len(response.data) if response.data else 0} entries for draw on {date_obj.isoformat()}")
-        return response.data if response.data else []
+        response = await run_db_query('get_daily_ticket_entries_for_draw', lambda: supabase.from_('daily_tickets').select('telegram_id, count').eq('date', date_obj.isoformat()))
     except Exception as e:
         logger.error(f"Supabase error fetching daily ticket entries for {date_obj} for draw: {e}")
+        raise e if isinstance(e, DatabaseUnavailableError) else DatabaseUnavailableError(str(e)) from e
+    logger.debug(f"DB: Fetched {len(response.data) if response.data else 0} entries for draw on {date_obj.isoformat()}")
+    if not response.data and is_archivable_date(date_obj):
+        return await get_archived_ticket_entries(date_obj)
+    return response.data if response.data else []
+
+# --- Helper Functions: Daily Tickets Archive ---
+# Jin dates ka draw winners mein record ho chuka hai, woh raat ko daily_tickets se
+# daily_tickets_archive (per date ek row) aur daily_ticket_summaries mein chali jaati hain.
+# Schema: migrations/002_daily_tickets_archive.sql. Hot queries sirf aaj aur kal ko chhooti hain.
+def is_archivable_date(date_obj: datetime.date) -> bool:
+    """Only dates before yesterday can have been moved to the archive."""
+    return date_obj < datetime.date.today() - datetime.timedelta(days=1)
+
+async def get_archived_ticket_total(date_obj: datetime.date) -> int:
+    logger.debug(f"DB: Getting archived ticket total for {date_obj.isoformat()}")
+    try:
+        response = await run_db_query('get_archived_ticket_total', lambda: supabase.from_('daily_ticket_summaries').select('total_tickets').eq('date', date_obj.isoformat()).limit(1))
+        if response.data:
+            return int(response.data[0].get('total_tickets') or 0)
+        return 0
+    except Exception as e:
+        logger.error(f"Supabase error fetching archived ticket total for {date_obj}: {e}")
+        return 0
+
+async def get_archived_ticket_entries(date_obj: datetime.date) -> list:
+    """Archived (telegram_id, count) entries for date_obj, in the same shape as daily_tickets rows. Raises DatabaseUnavailableError on failure."""
+    logger.debug(f"DB: Getting archived ticket entries for {date_obj.isoformat()}")
+    try:
+        response = await run_db_query('get_archived_ticket_entries', lambda: supabase.from_('daily_tickets_archive').select('telegram_ids, counts').eq('date', date_obj.isoformat()).limit(1))
+    except Exception as e:
+        logger.error(f"Supabase error fetching archived ticket entries for {date_obj}: {e}")
+        raise e if isinstance(e, DatabaseUnavailableError) else DatabaseUnavailableError(str(e)) from e
+    if not response.data:
         return []
+    row = response.data[0]
+    return [{'telegram_id': telegram_id, 'count': count} for telegram_id, count in zip(row.get('telegram_ids') or [], row.get('counts') or [])]
 
-async def add_winner_record(telegram_id: int, amount: Decimal, win_date: datetime.date):
-    logger.debug(f"DB: Adding winner record for {telegram_id}, amount {amount}, date {win_date.isoformat()}")
+async def daily_draw_recorded(date_obj: datetime.date) -> bool:
+    """Whether the daily draw of date_obj already has a winner. Raises DatabaseUnavailableError on failure."""
     try:
-        data_to_insert = {
-            'telegram_id': telegram_id,
-            'amount': float(amount), 
-            'win_date': win_date.isoformat()
-        }
-        response = supabase.from_('winners').insert([data_to_insert]).execute()
-        if response.data:
-            logger.info(f"Winner recorded: {telegram_id} on {win_date} with {amount:.2f} USDT")
-            return response.data[0]
-        error_msg = response.error.message if hasattr(response, 'error') and response.error else "Unknown error adding winner"
-        logger.error(f"Supabase error adding winner {telegram_id}: {error_msg}")
-        return None
+        response = await run_db_query('daily_draw_recorded', lambda: supabase.from_('winners').select('id').eq('win_date', date_obj.isoformat()).is_('round_id', 'null').limit(1))
     except Exception as e:
-        logger.error(f"Exception adding winner {telegram_id}: {e}")
+        logger.error(f"Supabase error checking the daily draw of {date_obj}: {e}")
+        raise e if isinstance(e, DatabaseUnavailableError) else DatabaseUnavailableError(str(e)) from e
+    return bool(response.data)
+
+async def archive_closed_ticket_dates(cutoff_date: datetime.date) -> int | None:
+    """Archive every closed date before cutoff_date. Returns the number of dates archived, None on error."""
+    logger.debug(f"DB: Archiving closed daily_tickets dates before {cutoff_date.isoformat()}")
+    try:
+        response = await run_db_query('archive_daily_tickets', lambda: supabase.rpc('archive_daily_tickets', {'cutoff_date_input': cutoff_date.isoformat()}), idempotent=False)
+        archived_dates = int(response.data or 0)
+        logger.info(f"DB: Archived {archived_dates} closed daily_tickets date(s) before {cutoff_date.isoformat()}.")
+        return archived_dates
+    except Exception as e:
+        logger.error(f"Exception calling RPC archive_daily_tickets before {cutoff_date}: {e}")
         return None
 
 async def get_latest_winners(limit: int = 7):
     logger.debug(f"DB: Getting latest {limit} winners.")
     try:
-        winners_response = supabase.from_('winners').select('telegram_id, amount, win_date').order('win_date', desc=True).limit(limit).execute()
+        winners_response = await run_db_query('get_latest_winners', lambda: supabase.from_('winners').select('telegram_id, amount, win_date').order('win_date', desc=True).limit(limit))
         if not winners_response.data:
             logger.debug("DB: No winners found.")
+            remember_last_known_good('get_latest_winners', limit, [])
             return []
         
         logger.debug(f"DB: Found {len(winners_response.data)} raw winner entries.")
@@ -261,14 +435,18 @@ async def get_latest_winners(limit: int = 7):
         if not winner_telegram_ids:
              return winners_response.data 
 
-        users_response = supabase.from_('users').select('telegram_id, username, first_name').in_('telegram_id', winner_telegram_ids).execute()
+        users_response = await run_db_query('get_latest_winners_users', lambda: supabase.from_('users').select('telegram_id, username, first_name').in_('telegram_id', winner_telegram_ids))
         user_map = {user['telegram_id']: user for user in users_response.data} if users_response.data else {}
         logger.debug(f"DB: Fetched user info for {len(user_map)} winners.")
 
         for winner in winners_response.data:
             winner['user_info'] = user_map.get(winner['telegram_id'])
         
+        remember_last_known_good('get_latest_winners', limit, winners_response.data)
         return winners_response.data
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached latest winners: {e}")
+        return last_known_good('get_latest_winners', limit, [])
     except Exception as e:
         logger.error(f"Supabase error fetching latest winners: {e}")
         return []
@@ -276,10 +454,14 @@ async def get_latest_winners(limit: int = 7):
 async def get_all_user_telegram_ids() -> list[int]:
     logger.debug("DB: Getting all user telegram_ids.")
     try:
-        response = supabase.from_('users').select('telegram_id').execute()
+        response = await run_db_query('get_all_user_telegram_ids', lambda: supabase.from_('users').select('telegram_id'))
         ids = [user['telegram_id'] for user in response.data] if response.data else []
         logger.debug(f"DB: Found {len(ids)} user telegram_ids.")
+        remember_last_known_good('get_all_user_telegram_ids', None, ids)
         return ids
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached user telegram_ids: {e}")
+        return last_known_good('get_all_user_telegram_ids', None, [])
     except Exception as e:
         logger.error(f"Supabase error fetching all user telegram_ids: {e}")
         return []
@@ -287,76 +469,898 @@ async def get_all_user_telegram_ids() -> list[int]:
 async def get_total_users_count() -> int:
     logger.debug("DB: Getting total users count.")
     try:
-        response = supabase.from_('users').select('telegram_id', count='exact').limit(0).execute()
+        response = await run_db_query('get_total_users_count', lambda: supabase.from_('users').select('telegram_id', count='exact').limit(0))
         count = response.count if response.count is not None else 0
         logger.debug(f"DB: Total users count: {count}")
+        remember_last_known_good('get_total_users_count', None, count)
         return count
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached total users count: {e}")
+        return last_known_good('get_total_users_count', None, 0)
     except Exception as e:
         logger.error(f"Supabase error fetching total users count: {e}")
         return 0
 
-async def get_random_marketing_message_content() -> str | None:
+async def get_random_marketing_message() -> dict | None:
+    """A random marketing row: {'id', 'content', 'media_type', 'media_url', 'media_file_id'}."""
     logger.debug("DB: Getting random marketing message.")
     try:
-        response = supabase.from_('messages').select('content').eq('type', 'marketing').execute()
-        if response.data:
-            messages = [msg['content'] for msg in response.data if msg.get('content')]
-            if messages:
-                selected_message = random.choice(messages)
-                logger.debug("DB: Random marketing message selected.")
-                return selected_message
-            else:
-                logger.debug("DB: No marketing messages with content found.")
-                return None
-        logger.debug("DB: No marketing messages found in table.")
-        return None
+        response = await run_db_query('get_random_marketing_message', lambda: supabase.from_('messages').select('id, content, media_type, media_url, media_file_id').eq('type', 'marketing'))
+        messages = [msg for msg in response.data if msg.get('content') or msg.get('media_type')] if response.data else []
+        remember_last_known_good('get_random_marketing_message', None, messages)
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, using cached marketing messages: {e}")
+        messages = last_known_good('get_random_marketing_message', None, [])
     except Exception as e:
         logger.error(f"Supabase error fetching marketing message: {e}")
         return None
 
+    if messages:
+        selected_message = random.choice(messages)
+        logger.debug(f"DB: Random marketing message {selected_message.get('id')} selected.")
+        return selected_message
+    logger.debug("DB: No marketing messages with content found.")
+    return None
+
+async def save_marketing_media_file_id(message_id, file_id: str | None) -> None:
+    try:
+        await run_db_query('save_marketing_media_file_id', lambda: supabase.from_('messages').update({'media_file_id': file_id}).eq('id', message_id))
+    except Exception as e:
+        # In-memory cache is process mein phir bhi kaam karta hai; agle restart par ek upload aur hoga.
+        logger.error(f"Supabase error saving media file_id for marketing message {message_id}: {e}")
+
 async def calculate_prize_for_date(date_obj: datetime.date) -> Decimal:
-    logger.debug(f"CALC: Calculating prize for date {date_obj.isoformat()}")
-    total_tickets_sold_on_date = await get_total_tickets_for_date(date_obj)
-    logger.info(f"Total tickets sold on {date_obj.isoformat()} for prize calculation: {total_tickets_sold_on_date}")
-    if total_tickets_sold_on_date == 0:
-        logger.debug(f"CALC: No tickets sold on {date_obj.isoformat()}, prize is 0.")
+    return await calculate_prize_for_round(daily_round(date_obj))
+
+# --- Helper Functions: Lottery Rounds ---
+# Har draw ek "round" hai: round_id, kind, opens_at/closes_at, ticket_price aur pool split.
+# Daily round date se derive hota hai (tickets daily_tickets mein hi rehte hain); hourly/flash rounds
+# rounds table mein hain aur unke tickets round_tickets mein. Schema: migrations/007_rounds.sql
+# Round ids mein underscore nahi hota kyunki woh callback data (paid_<amount>_<n>_<round_id>) mein jaate hain.
+ROUND_KINDS = ('daily', 'hourly', 'flash')
+FLASH_ROUND_MAX_MINUTES = 180
+
+def round_timezone():
+    try:
+        return pytz.timezone(TIMEZONE_STR)
+    except pytz.exceptions.UnknownTimeZoneError:
+        return pytz.utc
+
+def daily_round(date_obj: datetime.date) -> dict:
+    tz = round_timezone()
+    opens_at = tz.localize(datetime.datetime.combine(date_obj, datetime.time.min))
+    return {
+        'round_id': f"d{date_obj:%Y%m%d}",
+        'kind': 'daily',
+        'date': date_obj,
+        'opens_at': opens_at,
+        'closes_at': tz.localize(datetime.datetime.combine(date_obj + datetime.timedelta(days=1), datetime.time.min)),
+        'ticket_price': TICKET_PRICE_USDT,
+        'prize_pool_percent': PRIZE_POOL_CONTRIBUTION_PERCENT,
+        'referral_percent': REFERRAL_PERCENT,
+        'status': 'open' if date_obj >= datetime.date.today() else 'closed'
+    }
+
+def round_from_row(row: dict) -> dict:
+    closes_at = datetime.datetime.fromisoformat(row['closes_at']).astimezone(round_timezone())
+    return {
+        'round_id': row['round_id'],
+        'kind': row['kind'],
+        'date': closes_at.date(),
+        'opens_at': datetime.datetime.fromisoformat(row['opens_at']).astimezone(round_timezone()),
+        'closes_at': closes_at,
+        'ticket_price': Decimal(str(row['ticket_price'])),
+        'prize_pool_percent': Decimal(str(row['prize_pool_percent'])),
+        'referral_percent': Decimal(str(row['referral_percent'])),
+        'status': row['status'],
+        'drawing_since': datetime.datetime.fromisoformat(row['drawing_since']) if row.get('drawing_since') else None
+    }
+
+def is_round_open(lottery_round: dict) -> bool:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return lottery_round['status'] == 'open' and lottery_round['opens_at'] <= now < lottery_round['closes_at']
+
+def round_label(lottery_round: dict) -> str:
+    if lottery_round['kind'] == 'daily':
+        return f"the daily draw of {lottery_round['date'].isoformat()}"
+    if lottery_round['kind'] == 'hourly':
+        return f"the {lottery_round['opens_at']:%H:%M}–{lottery_round['closes_at']:%H:%M} hourly round"
+    return f"flash round {lottery_round['round_id']} (closes {lottery_round['closes_at']:%H:%M})"
+
+async def get_round(round_id: str) -> dict | None:
+    if round_id.startswith('d'):
+        try:
+            return daily_round(datetime.datetime.strptime(round_id[1:], '%Y%m%d').date())
+        except ValueError:
+            return None
+    try:
+        response = await run_db_query('get_round', lambda: supabase.from_('rounds').select('*').eq('round_id', round_id).limit(1))
+        return round_from_row(response.data[0]) if response.data else None
+    except Exception as e:
+        logger.error(f"Supabase error fetching round {round_id}: {e}")
+        return None
+
+async def get_open_rounds(include_drawing: bool = False) -> list:
+    """Intraday rounds not yet drawn, including ones whose close time has passed, by closing time.
+
+    include_drawing adds rounds claimed by a draw that has not recorded a winner yet.
+    """
+    statuses = ['open', 'drawing'] if include_drawing else ['open']
+    try:
+        response = await run_db_query('get_open_rounds', lambda: supabase.from_('rounds').select('*').in_('status', statuses).order('closes_at'))
+        return [round_from_row(row) for row in response.data or []]
+    except Exception as e:
+        logger.error(f"Supabase error fetching open rounds: {e}")
+        return []
+
+async def create_round(kind: str, opens_at: datetime.datetime, closes_at: datetime.datetime, ticket_price: Decimal) -> dict | None:
+    """Create an intraday round. Creating an existing round_id again is a no-op, so the hourly job can rerun safely."""
+    round_id = f"h{opens_at.astimezone(round_timezone()):%Y%m%d%H}" if kind == 'hourly' else f"f{int(opens_at.timestamp())}"
+    row = {
+        'round_id': round_id,
+        'kind': kind,
+        'opens_at': opens_at.isoformat(),
+        'closes_at': closes_at.isoformat(),
+        'ticket_price': float(ticket_price),
+        'prize_pool_percent': float(PRIZE_POOL_CONTRIBUTION_PERCENT),
+        'referral_percent': float(REFERRAL_PERCENT),
+        'status': 'open'
+    }
+    try:
+        await run_db_query('create_round', lambda: supabase.from_('rounds').upsert([row], on_conflict='round_id', ignore_duplicates=True))
+    except Exception as e:
+        logger.error(f"Supabase error creating {kind} round {round_id}: {e}")
+        return None
+    return await get_round(round_id)
+
+async def claim_round_for_draw(round_id: str, claim_id: str) -> bool | None:
+    """Atomically move an intraday round to drawing for claim_id. False if another draw holds it or it is drawn, None if the call failed.
+
+    Claiming again with the same claim_id succeeds, so the call is safe to retry.
+    """
+    try:
+        response = await run_db_query('claim_round_for_draw', lambda: supabase.rpc('claim_round_for_draw', {
+            'round_id_input': round_id,
+            'claim_id_input': claim_id,
+            'lease_seconds_input': ROUND_DRAW_LEASE_SECONDS
+        }))
+        return bool(response.data)
+    except Exception as e:
+        logger.error(f"Exception calling RPC claim_round_for_draw for {round_id}: {e}")
+        return None
+
+async def settle_round(round_id: str, status: str, winner_telegram_id: int | None = None, prize: Decimal | None = None) -> None:
+    update_fields = {'status': status}
+    if status == 'drawn':
+        update_fields.update({
+            'winner_telegram_id': winner_telegram_id,
+            'prize': float(prize) if prize is not None else None,
+            'drawn_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
+        })
+    try:
+        await run_db_query('settle_round', lambda: supabase.from_('rounds').update(update_fields).eq('round_id', round_id))
+    except Exception as e:
+        logger.error(f"Supabase error setting round {round_id} to {status}: {e}")
+
+async def record_draw_result(lottery_round: dict, winner_telegram_id: int, prize: Decimal, notifications: list[dict]) -> bool:
+    """Record the winner, mark an intraday round drawn and queue the announcement in one transaction."""
+    round_id = lottery_round['round_id']
+    try:
+        await run_db_query('record_draw_result', lambda: supabase.rpc('record_draw_result', {
+            'round_id_input': None if lottery_round['kind'] == 'daily' else round_id,
+            'win_date_input': lottery_round['date'].isoformat(),
+            'winner_id_input': winner_telegram_id,
+            'prize_input': float(prize),
+            'notifications_input': outbox_rows(notifications)
+        }), idempotent=False)
+        logger.info(f"Winner recorded: {winner_telegram_id} in round {round_id} with {prize:.2f} USDT")
+        return True
+    except Exception as e:
+        logger.error(f"Exception calling RPC record_draw_result for round {round_id} (winner {winner_telegram_id}): {e}")
+        return False
+
+async def get_round_ticket_entries(lottery_round: dict) -> list:
+    """(telegram_id, count) entries of a round. Never served from cache; raises DatabaseUnavailableError on error."""
+    if lottery_round['kind'] == 'daily':
+        return await get_daily_ticket_entries_for_draw(lottery_round['date'])
+    try:
+        response = await run_db_query('get_round_ticket_entries', lambda: supabase.from_('round_tickets').select('telegram_id, count').eq('round_id', lottery_round['round_id']))
+    except Exception as e:
+        logger.error(f"Supabase error fetching ticket entries for round {lottery_round['round_id']}: {e}")
+        raise e if isinstance(e, DatabaseUnavailableError) else DatabaseUnavailableError(str(e)) from e
+    return response.data or []
+
+async def get_total_tickets_for_round(lottery_round: dict) -> int:
+    if lottery_round['kind'] == 'daily':
+        return await get_total_tickets_for_date(lottery_round['date'])
+    try:
+        response = await run_db_query('get_total_tickets_for_round', lambda: supabase.from_('round_tickets').select('count').eq('round_id', lottery_round['round_id']))
+        total = sum(item['count'] for item in response.data or [] if isinstance(item.get('count'), int))
+        remember_last_known_good('get_total_tickets_for_round', lottery_round['round_id'], total)
+        return total
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached ticket total for round {lottery_round['round_id']}: {e}")
+        return last_known_good('get_total_tickets_for_round', lottery_round['round_id'], 0)
+    except Exception as e:
+        logger.error(f"Supabase error fetching total tickets for round {lottery_round['round_id']}: {e}")
+        return 0
+
+async def get_user_tickets_for_round(lottery_round: dict, telegram_id: int) -> int | None:
+    if lottery_round['kind'] == 'daily':
+        operation, table, key_column, key = 'get_user_daily_ticket_count', 'daily_tickets', 'date', lottery_round['date'].isoformat()
+    else:
+        operation, table, key_column, key = 'get_user_round_ticket_count', 'round_tickets', 'round_id', lottery_round['round_id']
+    try:
+        response = await run_db_query(operation, lambda: supabase.from_(table).select('count').eq('telegram_id', telegram_id).eq(key_column, key).limit(1))
+        if response.data and isinstance(response.data[0].get('count'), int):
+            return response.data[0]['count']
+        logger.warning(f"No ticket row for user {telegram_id} in round {lottery_round['round_id']}. Response: {response.data}")
+        return None
+    except Exception as e:
+        logger.warning(f"Could not retrieve tickets of user {telegram_id} in round {lottery_round['round_id']}: {e}")
+        return None
+
+async def calculate_prize_for_round(lottery_round: dict) -> Decimal:
+    """Prize pool for display (/start, /rounds, /stats); may come from the last-known-good cache. The draw uses prize_for_ticket_total."""
+    logger.debug(f"CALC: Calculating prize for round {lottery_round['round_id']}")
+    total_tickets_sold = await get_total_tickets_for_round(lottery_round)
+    logger.info(f"Total tickets sold in round {lottery_round['round_id']} for prize calculation: {total_tickets_sold}")
+    return prize_for_ticket_total(lottery_round, total_tickets_sold)
+
+def prize_for_ticket_total(lottery_round: dict, total_tickets_sold: int) -> Decimal:
+    if total_tickets_sold == 0:
+        logger.debug(f"CALC: No tickets sold in round {lottery_round['round_id']}, prize is 0.")
         return Decimal("0.00")
-    total_revenue_from_tickets = total_tickets_sold_on_date * TICKET_PRICE_USDT
-    prize_amount = total_revenue_from_tickets * PRIZE_POOL_CONTRIBUTION_PERCENT
+    total_revenue_from_tickets = total_tickets_sold * lottery_round['ticket_price']
+    prize_amount = total_revenue_from_tickets * lottery_round['prize_pool_percent']
     final_prize = prize_amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    logger.debug(f"CALC: Prize for {date_obj.isoformat()} calculated: {final_prize} USDT")
+    logger.debug(f"CALC: Prize for round {lottery_round['round_id']} calculated: {final_prize} USDT")
     return final_prize
 
+# --- Helper Functions: Daily Stats Rollup ---
+# daily_stats table ka schema aur RPCs migrations/001_daily_stats.sql mein hain. Increments signup/payment
+# ke RPCs (migrations/009_atomic_writes.sql) ke andar hi hote hain; reconcile job unhe source tables se
+# dobara ginta hai.
+async def reconcile_daily_stats(from_date: datetime.date | None = None) -> int | None:
+    """Recompute daily_stats from users and payments for dates >= from_date (all dates when None). Returns rows rewritten."""
+    logger.debug(f"DB: Reconciling daily stats from {from_date.isoformat() if from_date else 'the beginning'}")
+    try:
+        response = await run_db_query('reconcile_daily_stats', lambda: supabase.rpc('reconcile_daily_stats', {
+            'from_date_input': from_date.isoformat() if from_date else None,
+            'timezone_input': TIMEZONE_STR
+        }))
+        return int(response.data or 0)
+    except Exception as e:
+        logger.error(f"Exception calling RPC reconcile_daily_stats: {e}")
+        return None
+
+async def get_daily_stats_snapshot(today_date: datetime.date) -> dict:
+    """Today's tickets/prize, yesterday's prize and the user total from daily_stats in one call."""
+    logger.debug(f"DB: Getting daily stats snapshot for {today_date.isoformat()}")
+    snapshot = {'total_users': 0, 'today_tickets': 0, 'today_prize': Decimal("0.00"), 'yesterday_prize': Decimal("0.00")}
+    try:
+        response = await run_db_query('get_daily_stats_snapshot', lambda: supabase.rpc('get_daily_stats_snapshot', {'today_input': today_date.isoformat()}))
+        if response.data:
+            snapshot['total_users'] = int(response.data.get('total_users') or 0)
+            snapshot['today_tickets'] = int(response.data.get('today_tickets') or 0)
+            snapshot['today_prize'] = Decimal(str(response.data.get('today_prize') or 0)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+            snapshot['yesterday_prize'] = Decimal(str(response.data.get('yesterday_prize') or 0)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        remember_last_known_good('get_daily_stats_snapshot', today_date, snapshot)
+        return snapshot
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached daily stats snapshot for {today_date}: {e}")
+        return last_known_good('get_daily_stats_snapshot', today_date, snapshot)
+    except Exception as e:
+        logger.error(f"Supabase error fetching daily stats snapshot for {today_date}: {e}")
+        return snapshot
+
+async def get_daily_stats_range(start_date: datetime.date, end_date: datetime.date) -> list:
+    """Pre-aggregated daily_stats rows between start_date and end_date (inclusive), oldest first."""
+    logger.debug(f"DB: Getting daily stats from {start_date.isoformat()} to {end_date.isoformat()}")
+    try:
+        response = await run_db_query('get_daily_stats_range', lambda: supabase.from_('daily_stats').select('date, new_users, tickets, revenue, prize, referral_payouts').gte('date', start_date.isoformat()).lte('date', end_date.isoformat()).order('date'))
+        return response.data if response.data else []
+    except Exception as e:
+        logger.error(f"Supabase error fetching daily stats range {start_date} - {end_date}: {e}")
+        return []
+
+# --- Helper Functions: Referral Stats ---
+# referral_stats table (migrations/005_referral_stats.sql): per referrer ek row, signup aur
+# payment confirmation ke RPCs (migrations/009_atomic_writes.sql) ke andar incrementally update hoti hai.
+async def get_referral_stats(referrer_telegram_id: int) -> dict:
+    logger.debug(f"DB: Getting referral stats for {referrer_telegram_id}")
+    stats = {'referral_count': 0, 'referral_tickets': 0, 'bonus_earned': Decimal("0.00")}
+    try:
+        response = await run_db_query('get_referral_stats', lambda: supabase.from_('referral_stats').select('referral_count, referral_tickets, bonus_earned').eq('referrer_telegram_id', referrer_telegram_id).limit(1))
+        if response.data:
+            row = response.data[0]
+            stats = {
+                'referral_count': int(row.get('referral_count') or 0),
+                'referral_tickets': int(row.get('referral_tickets') or 0),
+                'bonus_earned': Decimal(str(row.get('bonus_earned') or 0)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP),
+            }
+        remember_last_known_good('get_referral_stats', referrer_telegram_id, stats)
+        return stats
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached referral stats for {referrer_telegram_id}: {e}")
+        return last_known_good('get_referral_stats', referrer_telegram_id, stats)
+    except Exception as e:
+        logger.error(f"Supabase error fetching referral stats for {referrer_telegram_id}: {e}")
+        return stats
+
+async def get_top_referrers(limit: int = 10) -> list:
+    logger.debug(f"DB: Getting top {limit} referrers.")
+    try:
+        response = await run_db_query('get_top_referrers', lambda: supabase.from_('referral_stats').select('referrer_telegram_id, referral_count, referral_tickets, bonus_earned').order('bonus_earned', desc=True).limit(limit))
+        top_referrers = response.data if response.data else []
+        if top_referrers:
+            referrer_ids = [row['referrer_telegram_id'] for row in top_referrers]
+            users_response = await run_db_query('get_top_referrers_users', lambda: supabase.from_('users').select('telegram_id, username, first_name').in_('telegram_id', referrer_ids))
+            user_map = {user['telegram_id']: user for user in users_response.data} if users_response.data else {}
+            for row in top_referrers:
+                row['user_info'] = user_map.get(row['referrer_telegram_id'])
+        remember_last_known_good('get_top_referrers', limit, top_referrers)
+        return top_referrers
+    except DatabaseUnavailableError as e:
+        logger.warning(f"DB degraded, serving cached top referrers: {e}")
+        return last_known_good('get_top_referrers', limit, [])
+    except Exception as e:
+        logger.error(f"Supabase error fetching top referrers: {e}")
+        return []
+
+# --- Helper Functions: Payments Ledger ---
+# payments aur referral_bonuses tables: migrations/003_payments_ledger.sql (round/stat columns: 009)
+async def confirm_ticket_payment(payment_key: str, lottery_round: dict, telegram_id: int, num_tickets: int, amount: Decimal, ticket_date: datetime.date,
+                                 ticket_value: Decimal, prize_amount: Decimal, referrer_telegram_id: int | None, referral_bonus: Decimal,
+                                 notifications: list[dict] | None = None) -> dict | None:
+    """Apply a confirmed payment in one transaction: tickets, payments row, referral bonus, the daily/referral
+    rollups and the outbox notifications.
+
+    payment_key identifies the claim; calling again with the same key writes nothing. Returns
+    {'round_tickets': int | None, 'applied': bool}, or None if the call failed (safe to retry).
+    """
+    logger.debug(f"DB: Confirming payment {payment_key} of {amount} USDT for {num_tickets} tickets by {telegram_id} in round {lottery_round['round_id']}")
+    if num_tickets <= 0:
+        logger.warning(f"Attempted to confirm 0 or negative tickets for user {telegram_id}.")
+        return None
+    try:
+        response = await run_db_query('confirm_ticket_payment', lambda: supabase.rpc('confirm_ticket_payment', {
+            'payment_key_input': payment_key,
+            'telegram_id_input': telegram_id,
+            'round_id_input': None if lottery_round['kind'] == 'daily' else lottery_round['round_id'],
+            'draw_date_input': lottery_round['date'].isoformat() if lottery_round['kind'] == 'daily' else None,
+            'ticket_date_input': ticket_date.isoformat(),
+            'num_tickets_input': num_tickets,
+            'amount_input': float(amount),
+            'ticket_value_input': float(ticket_value),
+            'prize_amount_input': float(prize_amount),
+            'referrer_id_input': referrer_telegram_id,
+            'referral_bonus_input': float(referral_bonus),
+            'stat_date_input': datetime.date.today().isoformat(),
+            'notifications_input': outbox_rows(notifications or [])
+        }), idempotent=False)
+        result = response.data or {}
+        if result.get('applied'):
+            logger.info(f"{num_tickets} tickets confirmed via RPC for user {telegram_id} in round {lottery_round['round_id']}.")
+        else:
+            logger.warning(f"Payment {payment_key} of user {telegram_id} was already recorded by an earlier attempt. Nothing written again.")
+        return {'round_tickets': result.get('round_tickets'), 'applied': bool(result.get('applied'))}
+    except Exception as e:
+        logger.error(f"Exception calling RPC confirm_ticket_payment for user {telegram_id} in round {lottery_round['round_id']}: {e}")
+        return None
+
 async def simulate_send_usdt(recipient_info: str, amount: Decimal, transaction_type: str):
     logger.info(f"SIMULATING USDT SEND: Type='{transaction_type}', Recipient='{recipient_info}', Amount='{amount:.2f} USDT'")
     await asyncio.sleep(random.uniform(0.5, 1.2)) 
     logger.info(f"SIMULATION COMPLETE: USDT sent successfully (simulated).")
     return True 
 
+# --- Outbound Request Scheduler (priority lanes) ---
+# Har Bot API request PTB ke rate limiter hook se guzarti hai. Teen lanes hain: interactive (user ke
+# replies, default), admin (ADMIN_ID ko jaane wale messages) aur bulk (broadcasts,
+# rate_limit_args={'lane': 'bulk'}). Har lane ka apna connection share aur rate cap hai; neeche wali
+# lane tabhi token leti hai jab upar wali koi lane wait na kar rahi ho, isliye broadcast sirf bachi
+# hui capacity use karta hai.
+OUTBOUND_LANES = ('interactive', 'admin', 'bulk') # priority order
+OUTBOUND_LANE_SHARES = { # fraction of OUTBOUND_MESSAGES_PER_SECOND / OUTBOUND_CONNECTION_POOL_SIZE
+    'interactive': {'rate': 1.0, 'connections': 0.5},
+    'admin': {'rate': 0.2, 'connections': 0.15},
+    'bulk': {'rate': 0.8, 'connections': 0.35},
+}
+# Shared bucket (multi-worker) mein lane ko itna hissa chhodna padta hai: dusre worker ki bulk lane
+# wahan ke interactive waiters ko nahi dekh sakti, isliye bulk bucket ko kabhi poora khaali nahi karti.
+OUTBOUND_SHARED_RESERVE = {'interactive': 0.0, 'admin': 0.1, 'bulk': 0.3} # fraction of OUTBOUND_MESSAGES_PER_SECOND
+# Sirf yeh endpoints Telegram ke message flood limit mein gine jaate hain; baaki bina token ke jaate hain.
+OUTBOUND_RATE_LIMITED_ENDPOINTS = {
+    'sendMessage', 'editMessageText', 'sendPhoto', 'sendVideo', 'sendAnimation', 'sendDocument',
+    'sendMediaGroup', 'copyMessage', 'forwardMessage',
+}
+OUTBOUND_MAX_RETRIES = 3
+BROADCAST_MAX_IN_FLIGHT = 50 # ek broadcast ki ek saath chalne wali sends
+
+class PriorityLaneRateLimiter(BaseRateLimiter[dict]):
+    """Strict-priority token buckets plus per-lane connection shares for outgoing Bot API calls.
+
+    shared_budget (a multiprocessing.Array('d', [tokens, last_refill, paused_until])) makes the overall
+    bucket and the flood pause shared by every worker process, since Telegram's limit is per bot, not per
+    process. Lane priority across workers comes from OUTBOUND_SHARED_RESERVE: lower lanes leave part of
+    the shared bucket to the lanes above them.
+    """
+
+    def __init__(self, messages_per_second: float, connection_pool_size: int, shared_budget=None):
+        self.messages_per_second = messages_per_second
+        self._shared_budget = shared_budget
+        self.lane_rates = {lane: messages_per_second * OUTBOUND_LANE_SHARES[lane]['rate'] for lane in OUTBOUND_LANES}
+        self.lane_connections = {lane: max(1, int(connection_pool_size * OUTBOUND_LANE_SHARES[lane]['connections'])) for lane in OUTBOUND_LANES}
+        self._semaphores = {}
+        self._waiters = {lane: deque() for lane in OUTBOUND_LANES}
+        self._grant_handle = None
+        self._tokens = messages_per_second
+        self._lane_tokens = dict(self.lane_rates)
+        self._shared_reserve = {lane: messages_per_second * OUTBOUND_SHARED_RESERVE[lane] for lane in OUTBOUND_LANES}
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+
+    async def initialize(self) -> None:
+        self._semaphores = {lane: asyncio.Semaphore(self.lane_connections[lane]) for lane in OUTBOUND_LANES}
+        logger.info(f"OUTBOUND: Priority lanes ready. Rates/s: {self.lane_rates}, connections: {self.lane_connections}")
+
+    async def shutdown(self) -> None:
+        if self._grant_handle:
+            self._grant_handle.cancel()
+            self._grant_handle = None
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.messages_per_second, self._tokens + elapsed * self.messages_per_second)
+        for lane in OUTBOUND_LANES:
+            self._lane_tokens[lane] = min(self.lane_rates[lane], self._lane_tokens[lane] + elapsed * self.lane_rates[lane])
+
+    def _pause_deadline(self) -> float:
+        if self._shared_budget is not None:
+            self._paused_until = max(self._paused_until, self._shared_budget[2])
+        return self._paused_until
+
+    def _pause(self, until: float) -> None:
+        self._paused_until = max(self._paused_until, until)
+        if self._shared_budget is not None:
+            with self._shared_budget.get_lock():
+                self._shared_budget[2] = max(self._shared_budget[2], until)
+
+    def _seconds_until_token(self, lane: str, now: float) -> float:
+        paused_until = self._pause_deadline()
+        if now < paused_until:
+            return paused_until - now
+        reserve = self._shared_reserve[lane] if self._shared_budget is not None else 0.0
+        global_wait = max(0.0, (1 + reserve - self._tokens) / self.messages_per_second)
+        lane_wait = max(0.0, (1 - self._lane_tokens[lane]) / self.lane_rates[lane]) if self.lane_rates[lane] > 0 else 1.0
+        return max(global_wait, lane_wait, 0.001)
+
+    def _try_take_token(self, lane: str, now: float) -> bool:
+        if now < self._pause_deadline() or self._lane_tokens[lane] < 1:
+            return False
+        if self._shared_budget is None:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        else:
+            # Sab workers ek hi bucket se lete hain; monotonic clock system-wide hai, isliye refill yahin hota hai.
+            # Token tabhi milta hai jab lane ka reserve bucket mein bacha rahe.
+            with self._shared_budget.get_lock():
+                tokens = min(self.messages_per_second, self._shared_budget[0] + max(0.0, now - self._shared_budget[1]) * self.messages_per_second)
+                taken = tokens >= 1 + self._shared_reserve[lane]
+                self._shared_budget[1] = max(self._shared_budget[1], now)
+                self._shared_budget[0] = tokens - 1 if taken else tokens
+                self._tokens = self._shared_budget[0]
+            if not taken:
+                return False
+        self._lane_tokens[lane] -= 1
+        return True
+
+    def _return_token(self, lane: str) -> None:
+        self._lane_tokens[lane] += 1
+        if self._shared_budget is None:
+            self._tokens += 1
+            return
+        with self._shared_budget.get_lock():
+            self._shared_budget[0] = min(self.messages_per_second, self._shared_budget[0] + 1)
+
+    def _head_lane(self) -> str | None:
+        # Sabse upar wali lane jiska koi waiter abhi bhi wait kar raha hai (cancelled waiters hata do).
+        for lane in OUTBOUND_LANES:
+            waiters = self._waiters[lane]
+            while waiters and waiters[0].done():
+                waiters.popleft()
+            if waiters:
+                return lane
+        return None
+
+    def _schedule_grant(self) -> None:
+        # Ek hi timer: agla token jis waqt head lane ko milega, tab sirf ek waiter jagta hai.
+        if self._grant_handle:
+            self._grant_handle.cancel()
+            self._grant_handle = None
+        lane = self._head_lane()
+        if lane is None:
+            return
+        now = time.monotonic()
+        self._refill(now)
+        self._grant_handle = asyncio.get_running_loop().call_later(self._seconds_until_token(lane, now), self._grant_tokens)
+
+    def _grant_tokens(self) -> None:
+        self._grant_handle = None
+        now = time.monotonic()
+        self._refill(now)
+        while (lane := self._head_lane()) is not None and self._try_take_token(lane, now):
+            self._waiters[lane].popleft().set_result(None)
+        self._schedule_grant()
+
+    async def _acquire_token(self, lane: str) -> None:
+        now = time.monotonic()
+        self._refill(now)
+        # Neeche wali lane tabhi token leti hai jab upar wali (ya apni lane mein pehle se) koi wait na kar raha ho.
+        head_lane = self._head_lane()
+        ahead_waiting = head_lane is not None and OUTBOUND_LANES.index(head_lane) <= OUTBOUND_LANES.index(lane)
+        if not ahead_waiting and self._try_take_token(lane, now):
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        if head_lane is None or OUTBOUND_LANES.index(lane) < OUTBOUND_LANES.index(head_lane):
+            self._schedule_grant()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Token mil chuka tha par caller cancel ho gaya: token wapas, agla waiter le lega.
+                self._return_token(lane)
+            self._schedule_grant()
+            raise
+
+    async def _wait_for_pause(self) -> None:
+        delay = self._pause_deadline() - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def lane_for_request(self, data: dict, rate_limit_args: dict | None) -> str:
+        if rate_limit_args and rate_limit_args.get('lane') in OUTBOUND_LANES:
+            return rate_limit_args['lane']
+        if data.get('chat_id') == ADMIN_ID:
+            return 'admin'
+        return 'interactive'
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == 'getUpdates':
+            # Long-poll request ka apna connection hai; use lanes mein nahi rokna.
+            return await callback(*args, **kwargs)
+
+        lane = self.lane_for_request(data, rate_limit_args)
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            if endpoint in OUTBOUND_RATE_LIMITED_ENDPOINTS:
+                await self._acquire_token(lane)
+            else:
+                # Token nahi lagta, par flood pause sab endpoints par lagta hai.
+                await self._wait_for_pause()
+            async with self._semaphores[lane]:
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else float(e.retry_after)
+                    # Flood limit poore bot par lagta hai, isliye sab lanes (aur shared budget se sab workers) pause hote hain.
+                    self._pause(time.monotonic() + retry_after)
+                    self._schedule_grant()
+                    logger.warning(f"OUTBOUND: Flood limit hit on {endpoint} ({lane} lane), pausing all lanes for {retry_after}s (attempt {attempt + 1}/{OUTBOUND_MAX_RETRIES + 1}).")
+                    if attempt >= OUTBOUND_MAX_RETRIES:
+                        raise
+
+async def gather_bounded(items: list, action, limit: int | None = None) -> None:
+    """Runs action(item) for every item with at most `limit` calls in flight (default BROADCAST_MAX_IN_FLIGHT)."""
+    pending = iter(items)
+
+    async def drain():
+        for item in pending:
+            await action(item)
+
+    await asyncio.gather(*(drain() for _ in range(min(limit or BROADCAST_MAX_IN_FLIGHT, len(items)))))
+
 async def broadcast_message_to_users_list(context: ContextTypes.DEFAULT_TYPE, user_ids: list[int], text: str, parse_mode: str | None = None):
     sent_count = 0
     failed_count = 0
-    tasks = []
     logger.debug(f"BROADCAST: Preparing to send to {len(user_ids)} users.")
 
     async def send_single_message(user_id_to_send: int):
         nonlocal sent_count, failed_count 
         try:
-            await context.bot.send_message(chat_id=user_id_to_send, text=text, parse_mode=parse_mode)
+            await context.bot.send_message(chat_id=user_id_to_send, text=text, parse_mode=parse_mode, rate_limit_args={'lane': 'bulk'})
             sent_count += 1
             logger.debug(f"BROADCAST: Message sent to {user_id_to_send}")
         except Exception as e:
             logger.warning(f"BROADCAST: Failed to send message to user {user_id_to_send}: {e}")
             failed_count +=1
-            
-    for user_id in user_ids:
-        tasks.append(send_single_message(user_id))
-    
-    if tasks:
-        await asyncio.gather(*tasks)
+
+    # Limiter ke aage hazaron coroutines khadi karne ki jagah sirf kuch hi ek saath chalti hain.
+    await gather_bounded(user_ids, send_single_message)
     
     logger.info(f"BROADCAST: Attempt finished. Sent: {sent_count}, Failed: {failed_count} out of {len(user_ids)} users.")
 
+# --- Marketing Media: upload once, send by file_id ---
+# Media bytes sirf ek baar upload hote hain (pehle recipient ko); Telegram ka lautaya file_id
+# messages.media_file_id mein save hota hai aur baaki sab recipients/agle campaigns usi se jaate hain.
+# media_url ek http(s) URL ya bot ke disk par file path ho sakta hai. Schema: migrations/008_marketing_media.sql
+MARKETING_MEDIA_SENDERS = {'photo': 'send_photo', 'video': 'send_video', 'animation': 'send_animation', 'document': 'send_document'}
+MARKETING_CAPTION_LIMIT = 1024 # Bot API caption limit; lamba text alag message mein jaata hai
+MARKETING_MEDIA_UPLOAD_TIMEOUT_SECONDS = 120
+marketing_media_file_ids = {} # {(message_id, media_type, media_url): file_id}; media badalne par purana file_id nahi milta
+marketing_media_upload_locks = {} # {message_id: asyncio.Lock}
+
+def read_marketing_media_file(path: str) -> bytes:
+    with open(path, 'rb') as media_file:
+        return media_file.read()
+
+async def load_marketing_media(media_url: str) -> InputFile:
+    if media_url.startswith(('http://', 'https://')):
+        async with httpx.AsyncClient(timeout=MARKETING_MEDIA_UPLOAD_TIMEOUT_SECONDS, follow_redirects=True) as client:
+            response = await client.get(media_url)
+            response.raise_for_status()
+            media_bytes = response.content
+    else:
+        media_bytes = await asyncio.to_thread(read_marketing_media_file, media_url)
+    return InputFile(media_bytes, filename=os.path.basename(media_url.split('?')[0]) or None)
+
+def sent_media_file_id(sent_message, media_type: str) -> str | None:
+    if media_type == 'photo':
+        return sent_message.photo[-1].file_id if sent_message.photo else None
+    media = getattr(sent_message, media_type, None)
+    return media.file_id if media else None
+
+async def send_marketing_media(bot, chat_id: int, marketing_message: dict, media) -> object:
+    """Send one marketing media message. media is a file_id or an InputFile; returns the sent media Message."""
+    text = marketing_message.get('content') or None
+    caption = text if text and len(text) <= MARKETING_CAPTION_LIMIT else None
+    sender = getattr(bot, MARKETING_MEDIA_SENDERS[marketing_message['media_type']])
+    upload_timeouts = {} if isinstance(media, str) else {'write_timeout': MARKETING_MEDIA_UPLOAD_TIMEOUT_SECONDS}
+    sent_message = await sender(chat_id, media, caption=caption, rate_limit_args={'lane': 'bulk'}, **upload_timeouts)
+    if text and caption is None:
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, rate_limit_args={'lane': 'bulk'})
+        except Exception as e:
+            # Media pahunch gaya (upload hua ho to file_id bhi mil gaya); sirf text ki failure upload failure nahi hai.
+            logger.warning(f"BROADCAST: Marketing media {marketing_message.get('id')} reached {chat_id}, but its text did not: {e}")
+    return sent_message
+
+async def resolve_marketing_media_file_id(context: ContextTypes.DEFAULT_TYPE, marketing_message: dict, user_ids: list[int]) -> tuple[str | None, list[int]]:
+    """Get a usable file_id, uploading to the first recipient that accepts it if needed.
+
+    Returns (file_id, remaining user_ids). A file_id of None means the upload failed for everyone tried.
+    """
+    message_id = marketing_message['id']
+    cache_key = (message_id, marketing_message['media_type'], marketing_message.get('media_url'))
+    async with marketing_media_upload_locks.setdefault(message_id, asyncio.Lock()):
+        # Row ka file_id sabse taaza hai; cache sirf tab kaam aata hai jab row mein abhi save nahi hua.
+        file_id = marketing_message.get('media_file_id') or marketing_media_file_ids.get(cache_key)
+        remaining_user_ids = list(user_ids)
+        if file_id and remaining_user_ids:
+            # Pehle recipient par file_id check karo; Telegram ne use reject kiya to dobara upload.
+            probe_user_id = remaining_user_ids[0]
+            try:
+                await send_marketing_media(context.bot, probe_user_id, marketing_message, file_id)
+                marketing_media_file_ids[cache_key] = file_id
+                return file_id, remaining_user_ids[1:]
+            except BadRequest as e:
+                if 'file' not in str(e).lower():
+                    logger.warning(f"BROADCAST: Failed to send marketing media to user {probe_user_id}: {e}")
+                    return file_id, remaining_user_ids[1:]
+                logger.warning(f"BROADCAST: Cached file_id for marketing message {message_id} was rejected ({e}). Uploading again.")
+                marketing_media_file_ids.pop(cache_key, None)
+                await save_marketing_media_file_id(message_id, None)
+            except Exception as e:
+                logger.warning(f"BROADCAST: Failed to send marketing media to user {probe_user_id}: {e}")
+                return file_id, remaining_user_ids[1:]
+
+        try:
+            media_file = await load_marketing_media(marketing_message['media_url'])
+        except Exception as e:
+            logger.error(f"BROADCAST: Could not load media for marketing message {message_id} from {marketing_message.get('media_url')}: {e}")
+            return None, remaining_user_ids
+
+        while remaining_user_ids:
+            upload_user_id = remaining_user_ids.pop(0)
+            try:
+                sent_message = await send_marketing_media(context.bot, upload_user_id, marketing_message, media_file)
+            except Exception as e:
+                # Blocked/deleted users par upload fail hota hai; agle recipient par try karo.
+                logger.warning(f"BROADCAST: Uploading marketing media via user {upload_user_id} failed: {e}")
+                continue
+            file_id = sent_media_file_id(sent_message, marketing_message['media_type'])
+            if file_id:
+                marketing_media_file_ids[cache_key] = file_id
+                await save_marketing_media_file_id(message_id, file_id)
+                logger.info(f"BROADCAST: Uploaded media for marketing message {message_id} once; reusing file_id for the rest.")
+            return file_id, remaining_user_ids
+        return None, remaining_user_ids
+
+async def broadcast_media_to_users_list(context: ContextTypes.DEFAULT_TYPE, user_ids: list[int], marketing_message: dict):
+    if not marketing_message.get('media_url') and not marketing_message.get('media_file_id'):
+        logger.error(f"BROADCAST: Marketing message {marketing_message.get('id')} has media_type but no media_url or media_file_id. Skipping.")
+        return
+    file_id, remaining_user_ids = await resolve_marketing_media_file_id(context, marketing_message, user_ids)
+    if not file_id:
+        logger.error(f"BROADCAST: No file_id for marketing message {marketing_message['id']}; media was not sent to {len(remaining_user_ids)} remaining users.")
+        return
+
+    handled_before_fanout = len(user_ids) - len(remaining_user_ids)
+    sent_count = 0
+    failed_count = 0
+
+    async def send_single_media(user_id_to_send: int):
+        nonlocal sent_count, failed_count
+        try:
+            await send_marketing_media(context.bot, user_id_to_send, marketing_message, file_id)
+            sent_count += 1
+        except Exception as e:
+            logger.warning(f"BROADCAST: Failed to send marketing media to user {user_id_to_send}: {e}")
+            failed_count += 1
+
+    await gather_bounded(remaining_user_ids, send_single_media)
+    logger.info(f"BROADCAST: Media attempt finished. {handled_before_fanout} user(s) handled while resolving the file_id; then Sent: {sent_count}, Failed: {failed_count} out of {len(remaining_user_ids)} users.")
+
+# --- Notification Outbox ---
+# Handlers notification intent notification_outbox table mein likhte hain (jahan DB change RPC se hota hai,
+# wahin usi transaction mein) aur lautt jaate hain; Telegram calls dispatch_outbox_job karta hai (batch,
+# retry, delivery status). Broadcast row claim hone par per-recipient rows mein phail jaati hai, isliye
+# restart ya lease khatam hone par sirf bache hue recipients ko bheja jaata hai.
+# Schema aur RPCs: migrations/004_notification_outbox.sql, 011_outbox_fanout.sql
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE_SECONDS = 10
+OUTBOX_LEASE_SECONDS = 120 # claimed rows are retried by another dispatcher if not settled by then
+OUTBOX_DISPATCH_INTERVAL_SECONDS = 2
+outbox_dispatch_state = {'running': False}
+
+def outbox_message(chat_id: int, text: str, parse_mode: str | None = None) -> dict:
+    return {'kind': 'send_message', 'chat_id': chat_id, 'payload': {'text': text, 'parse_mode': parse_mode}}
+
+def outbox_edit_message(chat_id: int, message_id: int, text: str, parse_mode: str | None = None, fallback_chat_id: int | None = None) -> dict:
+    return {'kind': 'edit_message_text', 'chat_id': chat_id, 'payload': {'message_id': message_id, 'text': text, 'parse_mode': parse_mode, 'fallback_chat_id': fallback_chat_id}}
+
+def outbox_broadcast(text: str, parse_mode: str | None = None, user_ids: list[int] | None = None) -> dict:
+    """Broadcast to user_ids, or to every user if user_ids is None."""
+    payload = {'text': text, 'parse_mode': parse_mode}
+    if user_ids is not None:
+        payload['user_ids'] = user_ids
+    return {'kind': 'broadcast', 'chat_id': None, 'payload': payload}
+
+def outbox_rows(notifications: list[dict]) -> list[dict]:
+    """Notifications as notification_outbox rows, for inserts and the notifications_input of write RPCs."""
+    return [{'kind': n['kind'], 'chat_id': n['chat_id'], 'payload': n['payload']} for n in notifications]
+
+async def deliver_notification(context: ContextTypes.DEFAULT_TYPE, notification: dict) -> None:
+    """Perform the Telegram call(s) for one outbox notification. Raises on failure."""
+    payload = notification['payload']
+    rate_limit_args = {'lane': payload['lane']} if payload.get('lane') else None
+    if notification['kind'] == 'send_message':
+        await context.bot.send_message(chat_id=notification['chat_id'], text=payload['text'], parse_mode=payload.get('parse_mode'), rate_limit_args=rate_limit_args)
+    elif notification['kind'] == 'edit_message_text':
+        try:
+            await context.bot.edit_message_text(chat_id=notification['chat_id'], message_id=payload['message_id'], text=payload['text'], parse_mode=payload.get('parse_mode'))
+        except Exception as edit_e:
+            if not payload.get('fallback_chat_id'):
+                raise
+            logger.warning(f"OUTBOX: Failed to edit message {payload['message_id']} in chat {notification['chat_id']}: {edit_e}. Sending a new message instead.")
+            await context.bot.send_message(chat_id=payload['fallback_chat_id'], text=payload['text'], parse_mode=payload.get('parse_mode'))
+    elif notification['kind'] == 'broadcast':
+        # Sirf inline fallback ke liye; outbox mein broadcast rows expand_outbox_broadcast se phailti hain.
+        user_ids = payload['user_ids'] if 'user_ids' in payload else await get_all_user_telegram_ids()
+        if user_ids:
+            await broadcast_message_to_users_list(context, user_ids, payload['text'], parse_mode=payload.get('parse_mode'))
+    else:
+        raise ValueError(f"Unknown outbox notification kind: {notification['kind']}")
+
+def wake_outbox_dispatcher(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if context.job_queue:
+        context.job_queue.run_once(dispatch_outbox_job, when=0)
+
+async def enqueue_notifications(context: ContextTypes.DEFAULT_TYPE, notifications: list[dict]) -> bool:
+    """Insert notifications into the outbox in one call and wake the dispatcher.
+
+    For notifications that announce a DB change, pass them to that change's RPC instead so both commit
+    together. If the outbox insert fails the notifications are delivered inline instead, so nothing is
+    lost compared to sending directly. Returns True if they were queued.
+    """
+    if not notifications:
+        return True
+    logger.debug(f"OUTBOX: Queueing {len(notifications)} notification(s).")
+    try:
+        await run_db_query('enqueue_notifications', lambda: supabase.from_('notification_outbox').insert(outbox_rows(notifications)), idempotent=False)
+    except Exception as e:
+        logger.error(f"OUTBOX: Could not queue {len(notifications)} notification(s), delivering inline: {e}")
+        for notification in notifications:
+            try:
+                await deliver_notification(context, notification)
+            except Exception as e_deliver:
+                logger.error(f"OUTBOX: Inline delivery of {notification['kind']} to {notification['chat_id']} failed: {e_deliver}")
+        return False
+
+    wake_outbox_dispatcher(context)
+    return True
+
+def outbox_retry_fields(row: dict, error: Exception) -> dict:
+    # Bot ko block karna (Forbidden) ya ghalat chat/text (BadRequest) retry se theek nahi hota.
+    if isinstance(error, (BadRequest, Forbidden)) or row['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+        logger.error(f"OUTBOX: Giving up on notification {row['id']} ({row['kind']} to {row['chat_id']}) after {row['attempts']} attempt(s): {type(error).__name__} - {error}")
+        return {'status': 'failed', 'last_error': str(error)[:1000]}
+    retry_delay = OUTBOX_RETRY_BASE_SECONDS * (2 ** (row['attempts'] - 1))
+    next_attempt_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=retry_delay)
+    logger.warning(f"OUTBOX: Notification {row['id']} attempt {row['attempts']} failed, retrying in {retry_delay}s: {error}")
+    return {'status': 'pending', 'next_attempt_at': next_attempt_at.isoformat(), 'last_error': str(error)[:1000]}
+
+async def settle_outbox_rows(rows: list[dict], errors: list[Exception | None]) -> None:
+    """Record delivery results: all successes in one update, each failure with its own retry schedule."""
+    updates = [] # (ids, update_fields)
+    sent_ids = [row['id'] for row, error in zip(rows, errors) if error is None]
+    if sent_ids:
+        updates.append((sent_ids, {'status': 'sent', 'sent_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'last_error': None}))
+    updates += [([row['id']], outbox_retry_fields(row, error)) for row, error in zip(rows, errors) if error is not None]
+    for ids, update_fields in updates:
+        try:
+            await run_db_query('settle_outbox_rows', lambda: supabase.from_('notification_outbox').update(update_fields).in_('id', ids))
+        except Exception as e:
+            # Lease khatam hone par rows dobara claim hongi; send_message at-least-once hai.
+            logger.error(f"OUTBOX: Could not record delivery status for notification(s) {ids}: {e}")
+
+async def deliver_outbox_row(context: ContextTypes.DEFAULT_TYPE, row: dict) -> Exception | None:
+    try:
+        await deliver_notification(context, row)
+    except Exception as e:
+        return e
+    return None
+
+async def expand_outbox_broadcast(row: dict) -> int | None:
+    """Replace a claimed broadcast row by one outbox row per recipient. Returns the recipient count, None on error."""
+    try:
+        response = await run_db_query('expand_outbox_broadcast', lambda: supabase.rpc('expand_outbox_broadcast', {'outbox_id_input': row['id']}), idempotent=False)
+        recipients = int(response.data or 0)
+        logger.info(f"OUTBOX: Broadcast {row['id']} queued for {recipients} recipient(s).")
+        return recipients
+    except Exception as e:
+        # Row lease ke baad dobara claim hogi; expansion ek hi transaction hai, aadhi nahi hoti.
+        logger.error(f"OUTBOX: Could not expand broadcast {row['id']}: {e}")
+        return None
+
+async def dispatch_outbox_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Process mein ek hi dispatcher loop; baaki wake-ups lautt jaate hain. Bhara hua batch aaye to
+    # loop turant agla batch claim karta hai, taaki bade broadcast lease ke andar nipat jaayein.
+    if outbox_dispatch_state['running']:
+        return
+    outbox_dispatch_state['running'] = True
+    try:
+        while True:
+            try:
+                response = await run_db_query('claim_outbox_batch', lambda: supabase.rpc('claim_outbox_batch', {
+                    'batch_size': OUTBOX_BATCH_SIZE,
+                    'lease_seconds': OUTBOX_LEASE_SECONDS
+                }), idempotent=False)
+            except Exception as e:
+                logger.error(f"OUTBOX: Could not claim outbox batch: {e}")
+                return
+            rows = response.data or []
+            if not rows:
+                return
+
+            logger.debug(f"OUTBOX: Dispatching {len(rows)} notification(s).")
+            direct_rows = [row for row in rows if row['kind'] != 'broadcast']
+            expanded_recipients = 0
+            for row in rows:
+                if row['kind'] == 'broadcast':
+                    expanded_recipients += await expand_outbox_broadcast(row) or 0
+            if direct_rows:
+                errors = await asyncio.gather(*(deliver_outbox_row(context, row) for row in direct_rows))
+                await settle_outbox_rows(direct_rows, errors)
+            if len(rows) < OUTBOX_BATCH_SIZE and not expanded_recipients:
+                return
+    finally:
+        outbox_dispatch_state['running'] = False
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.debug("HANDLER: start_command invoked.")
     user = update.effective_user
@@ -371,13 +1375,20 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.info(f"Start command from user: {telegram_id} ({first_name} @{username})")
 
     referrer_telegram_id = None
+    database_unavailable = False
     if context.args:
         logger.debug(f"Start command args: {context.args}")
         try:
             potential_referrer_id = int(context.args[0])
             if potential_referrer_id != telegram_id:
-                referrer_user = await get_user(potential_referrer_id)
-                if referrer_user:
+                try:
+                    referrer_user = await get_user(potential_referrer_id)
+                except DatabaseUnavailableError:
+                    referrer_user = None
+                    database_unavailable = True
+                if database_unavailable:
+                    logger.warning(f"User {telegram_id} started with referrer {potential_referrer_id} during a DB outage. Referrer not verified.")
+                elif referrer_user:
                     referrer_telegram_id = potential_referrer_id
                     logger.info(f"User {telegram_id} started with referrer {referrer_telegram_id}")
                 else:
@@ -387,8 +1398,13 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except (ValueError, IndexError):
             logger.warning(f"User {telegram_id} used invalid referral link format or no valid arg: {context.args}")
 
-    db_user = await get_user(telegram_id)
-    is_new_user = db_user is None
+    try:
+        db_user = await get_user(telegram_id)
+    except DatabaseUnavailableError:
+        db_user = None
+        database_unavailable = True
+    # Outage mein pata nahi ki user naya hai (ya referrer sahi hai), isliye registration agle /start tak skip.
+    is_new_user = db_user is None and not database_unavailable
     logger.debug(f"User {telegram_id} is_new_user: {is_new_user}")
 
     today_date = datetime.date.today()
@@ -402,30 +1418,34 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
     if is_new_user:
         logger.info(f"User {telegram_id} is new. Creating entry...")
-        created_user = await create_user(telegram_id, username, first_name, last_name, referrer_telegram_id)
+        notifications = []
+        if referrer_telegram_id:
+            new_user_display_name = first_name + (f" (@{username})" if username else "")
+            referral_notification_text = (
+                f"Great news! Your referral {new_user_display_name} has joined TrustWin Bot using your link!\n"
+                f"You'll earn {REFERRAL_PERCENT*100:.0f}% of the ticket price every time they buy a ticket!"
+            )
+            notifications.append(outbox_message(referrer_telegram_id, referral_notification_text))
+        created_user = await create_user(telegram_id, username, first_name, last_name, referrer_telegram_id, notifications=notifications)
         if created_user:
             welcome_message_parts.append("You've been registered! Thanks for joining.")
             logger.info(f"User {telegram_id} successfully registered.")
-            if referrer_telegram_id:
-                try:
-                    new_user_display_name = first_name + (f" (@{username})" if username else "")
-                    referral_notification_text = (
-                        f"Great news! Your referral {new_user_display_name} has joined TrustWin Bot using your link!\n"
-                        f"You'll earn {REFERRAL_PERCENT*100:.0f}% of the ticket price every time they buy a ticket!"
-                    )
-                    await context.bot.send_message(chat_id=referrer_telegram_id, text=referral_notification_text)
-                    logger.info(f"Notified referrer {referrer_telegram_id} about new user {telegram_id}")
-                except Exception as e:
-                    logger.warning(f"Could not notify referrer {referrer_telegram_id}: {e}")
+            if notifications:
+                wake_outbox_dispatcher(context)
+                logger.info(f"Queued referrer {referrer_telegram_id} notification about new user {telegram_id}")
         else:
             welcome_message_parts.append("There was an issue registering you. Please try /start again later.")
             logger.error(f"Failed to register new user {telegram_id}.")
+    elif db_user is None:
+        welcome_message_parts.append("⚠️ We're having a temporary database issue. If you're new here, please send /start again in a minute to finish registering.")
+        logger.warning(f"Skipped registration check for user {telegram_id} during a DB outage.")
     
     welcome_message_parts.extend([
         f"\nToday's *potential* prize pool is currently around *{potential_todays_prize:.2f} USDT*.",
         "(This grows as more tickets are sold today for *tomorrow's* draw).",
         f"Each ticket costs *{TICKET_PRICE_USDT:.2f} USDT*.",
         "\nUse the /buy command to get your ticket(s)!",
+        "Use /mytickets to check your tickets and /refer to see your referral earnings.",
         f"\nWant to earn passively? Share your unique referral link:",
         f"`https://t.me/{context.bot.username}?start={telegram_id}`",
         f"You get {REFERRAL_PERCENT*100:.0f}% of the ticket price for every ticket your referred friends buy, FOREVER!",
@@ -449,28 +1469,49 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     telegram_id = user.id
     logger.info(f"Buy command from user: {telegram_id}")
 
-    db_user = await get_user(telegram_id)
+    try:
+        db_user = await get_user(telegram_id)
+    except DatabaseUnavailableError:
+        if update.message:
+            await update.message.reply_text("⚠️ We're having a temporary database issue. Please try /buy again in a minute.")
+            logger.warning(f"User {telegram_id} tried /buy while the database is unavailable.")
+        return
     if not db_user:
         if update.message:
             await update.message.reply_text("Please use the /start command first to register.")
             logger.info(f"User {telegram_id} tried /buy without being registered.")
         return
 
+    lottery_round = None
+    if context.args:
+        lottery_round = await get_round(context.args[0])
+        if not lottery_round or lottery_round['kind'] == 'daily' or not is_round_open(lottery_round):
+            if update.message:
+                await update.message.reply_text("That round is not open. Use /rounds to see the rounds you can still join, or /buy for today's draw.")
+            logger.info(f"User {telegram_id} tried /buy for unknown or closed round {context.args[0]}.")
+            return
+
     num_tickets_to_buy = 1 
-    total_payment_due = num_tickets_to_buy * TICKET_PRICE_USDT
+    ticket_price = lottery_round['ticket_price'] if lottery_round else TICKET_PRICE_USDT
+    total_payment_due = num_tickets_to_buy * ticket_price
     callback_data_string = f"paid_{total_payment_due}_{num_tickets_to_buy}"
+    if lottery_round:
+        callback_data_string += f"_{lottery_round['round_id']}"
     logger.debug(f"Buy command: {num_tickets_to_buy} ticket(s), total due {total_payment_due:.2f} USDT, callback_data: {callback_data_string}")
 
     keyboard = [[InlineKeyboardButton(f"I have paid {total_payment_due:.2f} USDT", callback_data=callback_data_string)]]
     reply_markup = InlineKeyboardMarkup(keyboard)
+    round_description = round_label(lottery_round) if lottery_round else "today's draw"
     
     message_text = (
         f"To buy {num_tickets_to_buy} ticket(s) for *{total_payment_due:.2f} USDT*:\n\n"
         f"1. Send exactly *{total_payment_due:.2f} USDT (TRC-20)* to the following wallet address:\n"
         f"`{USDT_WALLET}`\n\n"
         "2. After sending, click the 'I have paid' button below.\n\n"
-        "Your ticket(s) will be counted for today's draw after admin verification. Good luck!"
+        f"Your ticket(s) will be counted for {round_description} after admin verification. Good luck!"
     )
+    if not lottery_round and HOURLY_ROUNDS_ENABLED:
+        message_text += "\n\nWant a quicker draw? See /rounds for the hourly and flash rounds open right now."
 
     if update.message:
         await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
@@ -478,7 +1519,59 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     else:
         logger.warning("Buy command invoked without message attribute. Cannot send reply.")
 
-async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# --- Idempotent Callback Handling ---
+# Users "I have paid" button kai baar dabaate hain. (user, message_id, callback data) par dedupe:
+# chal rahi execution ke duplicate usi ka intezaar karte hain (coalesce), aur TTL ke andar baad wale
+# taps ko turant cached jawab milta hai. Fail hui execution store se hata di jaati hai taaki retry ho sake.
+CALLBACK_DEDUPE_TTL_SECONDS = 120
+callback_dedupe_store = {} # {(user_id, message_id, data): {'expires_at': float, 'task': asyncio.Task, 'answer_text': str}}
+
+def idempotent_callback(answer_text: str):
+    def decorator(handler):
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            query = update.callback_query
+            if not query or not query.message or not query.from_user:
+                return await handler(update, context)
+
+            now = time.monotonic()
+            for expired_key in [key for key, entry in callback_dedupe_store.items() if entry['expires_at'] <= now and entry['task'].done()]:
+                del callback_dedupe_store[expired_key]
+
+            dedupe_key = (query.from_user.id, query.message.message_id, query.data)
+            while (entry := callback_dedupe_store.get(dedupe_key)):
+                in_flight = not entry['task'].done()
+                try:
+                    accepted = await asyncio.shield(entry['task'])
+                except Exception:
+                    accepted = False # original execution apni error khud handle/report karti hai
+                if not accepted:
+                    # Pehla tap reject hua (jaise amount mismatch); yeh tap "already received" nahi, khud handle hoga.
+                    if callback_dedupe_store.get(dedupe_key) is entry:
+                        del callback_dedupe_store[dedupe_key]
+                    continue
+                logger.info(f"CALLBACK_DEDUPE: Duplicate {handler.__name__} tap from {query.from_user.id} on message {query.message.message_id} ({'in flight' if in_flight else 'completed'}).")
+                try:
+                    await query.answer(entry['answer_text'])
+                except Exception as e_ans:
+                    logger.debug(f"CALLBACK_DEDUPE: Could not answer duplicate callback: {e_ans}")
+                return
+
+            # Key tabhi tikti hai jab handler claim accept kare (truthy return); reject/error par hata di jaati hai.
+            task = asyncio.ensure_future(handler(update, context))
+            entry = {'expires_at': now + CALLBACK_DEDUPE_TTL_SECONDS, 'task': task, 'answer_text': answer_text}
+            callback_dedupe_store[dedupe_key] = entry
+            accepted = False
+            try:
+                accepted = await task
+            finally:
+                if not accepted and callback_dedupe_store.get(dedupe_key) is entry:
+                    del callback_dedupe_store[dedupe_key]
+        wrapper.__name__ = handler.__name__
+        return wrapper
+    return decorator
+
+@idempotent_callback("✅ Your payment claim was already received. The admin will verify it shortly.")
+async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool | None:
     logger.debug("HANDLER: paid_button_callback invoked.")
     query = update.callback_query
 
@@ -491,7 +1584,7 @@ async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                  logger.error(f"Error sending answer in paid_button_callback for invalid query: {e_ans}")
         return
 
-    user = query.effective_user
+    user = update.effective_user
     if not user:
         logger.error("paid_button_callback: no effective_user.")
         await query.answer("Error: No user identified.", show_alert=True)
@@ -500,13 +1593,20 @@ async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     telegram_id = user.id
     data = query.data
     logger.info(f"Paid button callback from user {telegram_id} with data: {data}")
+
+    # Dedupe TTL ke baad bhi: isi message ka claim pehle se pending hai to admin ko dobara mat bhejo.
+    existing_claim = pending_payments.get(telegram_id)
+    if existing_claim and existing_claim['message_id'] == query.message.message_id:
+        await query.answer("✅ Your payment claim was already received. The admin will verify it shortly.")
+        logger.info(f"User {telegram_id} re-tapped paid button for already pending message {query.message.message_id}.")
+        return True
     
     await query.answer("Processing...") 
     logger.debug(f"Initial 'Processing...' answer sent to callback query from {telegram_id}")
 
     try:
         parts = data.split('_')
-        if len(parts) != 3 or parts[0] != 'paid':
+        if len(parts) not in (3, 4) or parts[0] != 'paid':
             logger.error(f"Invalid callback data format: '{data}' for user {telegram_id}")
             raise ValueError("Callback format error")
         
@@ -517,7 +1617,16 @@ async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         num_tickets_claimed = int(num_tickets_claimed_str)
         logger.debug(f"User {telegram_id} claims paid {claimed_amount_paid} for {num_tickets_claimed} tickets.")
 
-        expected_amount_for_tickets = (num_tickets_claimed * TICKET_PRICE_USDT).quantize(Decimal("0.01"))
+        lottery_round = None
+        if len(parts) == 4:
+            lottery_round = await get_round(parts[3])
+            if not lottery_round or not is_round_open(lottery_round):
+                await query.edit_message_text("This round closed before your claim arrived. Please use /rounds or /buy to join an open draw, or contact admin if you already paid.")
+                logger.warning(f"User {telegram_id} claimed payment for closed or unknown round {parts[3]}.")
+                return
+        ticket_price = lottery_round['ticket_price'] if lottery_round else TICKET_PRICE_USDT
+
+        expected_amount_for_tickets = (num_tickets_claimed * ticket_price).quantize(Decimal("0.01"))
 
         if claimed_amount_paid.quantize(Decimal("0.01")) != expected_amount_for_tickets:
             error_msg = (
@@ -538,14 +1647,19 @@ async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         'num_tickets': num_tickets_claimed,
         'date': datetime.date.today(), 
         'message_id': query.message.message_id,
-        'chat_id': query.message.chat_id
+        'chat_id': query.message.chat_id,
+        'round_id': lottery_round['round_id'] if lottery_round else None,
+        'claim_id': f"{telegram_id}:{query.id}" # payment ledger ki idempotency key
     }
+    publish_pending_payment_count()
     logger.info(f"Pending payment for user {telegram_id} recorded: {num_tickets_claimed} tickets, {claimed_amount_paid:.2f} USDT.")
+    round_description = round_label(lottery_round) if lottery_round else "today's draw"
 
     admin_notification_text = (
         f"🔔 Payment Claimed! 🔔\n\n"
         f"User: {user.first_name or 'N/A'} (@{user.username or 'N/A'}) [ID: `{telegram_id}`]\n"
         f"Claimed for: *{num_tickets_claimed} ticket(s)* (Total {claimed_amount_paid:.2f} USDT)\n"
+        f"Round: {round_description}\n"
         f"Claim Date: {datetime.date.today().isoformat()}\n\n"
         f"➡️ Please verify payment and use `/confirm_payment {telegram_id}` if correct."
     )
@@ -556,7 +1670,7 @@ async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         
         await query.edit_message_text(
             f"✅ Received your payment confirmation for {num_tickets_claimed} ticket(s) ({claimed_amount_paid:.2f} USDT).\n"
-            f"The admin will verify your payment shortly. Once confirmed, your tickets will be added for today's draw!"
+            f"The admin will verify your payment shortly. Once confirmed, your tickets will be added for {round_description}!"
         )
         logger.debug(f"User {telegram_id} notified about pending verification.")
 
@@ -571,6 +1685,7 @@ async def paid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             )
         except Exception as e_user_notify_fallback:
             logger.error(f"Also failed to send direct fallback notification to user {telegram_id}: {e_user_notify_fallback}")
+    return True
 
 def admin_only(handler):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -590,25 +1705,71 @@ def admin_only(handler):
 @admin_only
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.debug("HANDLER_ADMIN: stats_command invoked.")
-    if not update.message: return 
+    if not update.message: return
 
-    total_users = await get_total_users_count()
-    todays_total_tickets_sold = await get_total_tickets_for_date(datetime.date.today())
-    pending_count = len(pending_payments)
-    potential_prize_for_tomorrows_draw = await calculate_prize_for_date(datetime.date.today()) 
-    prize_for_todays_draw = await calculate_prize_for_date(datetime.date.today() - datetime.timedelta(days=1)) 
+    if context.args:
+        await stats_range_command(update, context)
+        return
+
+    snapshot = await get_daily_stats_snapshot(datetime.date.today())
+    pending_count = pending_payment_count()
 
     stats_text = (
         f"📊 **TrustWin Bot Statistics** 📊\n\n"
-        f"👤 Total Users: `{total_users}`\n"
-        f"🎟️ Today's Tickets Sold (for tomorrow's draw): `{todays_total_tickets_sold}`\n"
-        f"💰 Today's *Potential* Prize Pool (for tomorrow's draw): `{potential_prize_for_tomorrows_draw:.2f} USDT`\n"
-        f"🏆 Prize for *Today's* Draw (from yesterday's sales): `{prize_for_todays_draw:.2f} USDT`\n"
-        f"⏳ Pending Payments (Admin Verification): `{pending_count}`"
+        f"👤 Total Users: `{snapshot['total_users']}`\n"
+        f"🎟️ Today's Tickets Sold (for tomorrow's draw): `{snapshot['today_tickets']}`\n"
+        f"💰 Today's *Potential* Prize Pool (for tomorrow's draw): `{snapshot['today_prize']:.2f} USDT`\n"
+        f"🏆 Prize for *Today's* Draw (from yesterday's sales): `{snapshot['yesterday_prize']:.2f} USDT`\n"
+        f"⏳ Pending Payments (Admin Verification): `{pending_count}`\n"
+        f"🗄️ Database Circuit: `{db_circuit['state']}`"
     )
     await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
     logger.info("Admin stats displayed.")
 
+async def stats_range_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """`/stats <from> <to>`: totals and per-day breakdown from the daily_stats rollup."""
+    logger.debug(f"HANDLER_ADMIN: stats_range_command invoked with args {context.args}")
+    try:
+        if len(context.args) != 2:
+            raise ValueError("Expected exactly two dates")
+        start_date = datetime.date.fromisoformat(context.args[0])
+        end_date = datetime.date.fromisoformat(context.args[1])
+        if start_date > end_date:
+            raise ValueError("Start date is after end date")
+    except ValueError as e:
+        await update.message.reply_text("Usage: `/stats <from YYYY-MM-DD> <to YYYY-MM-DD>`", parse_mode=ParseMode.MARKDOWN)
+        logger.info(f"Invalid /stats range arguments {context.args}: {e}")
+        return
+
+    rows = await get_daily_stats_range(start_date, end_date)
+    total_new_users = sum(int(row.get('new_users') or 0) for row in rows)
+    total_tickets = sum(int(row.get('tickets') or 0) for row in rows)
+    total_revenue = sum((Decimal(str(row.get('revenue') or 0)) for row in rows), Decimal("0"))
+    total_prize = sum((Decimal(str(row.get('prize') or 0)) for row in rows), Decimal("0"))
+    total_referral_payouts = sum((Decimal(str(row.get('referral_payouts') or 0)) for row in rows), Decimal("0"))
+
+    stats_text = (
+        f"📊 **TrustWin Bot Statistics: {start_date.isoformat()} → {end_date.isoformat()}** 📊\n\n"
+        f"👤 New Users: `{total_new_users}`\n"
+        f"🎟️ Tickets Sold: `{total_tickets}`\n"
+        f"💵 Revenue: `{total_revenue:.2f} USDT`\n"
+        f"🏆 Daily Prize Pools: `{total_prize:.2f} USDT`\n"
+        f"🤝 Referral Payouts: `{total_referral_payouts:.2f} USDT`\n"
+    )
+
+    display_limit = 31
+    if rows:
+        stats_text += "\nPer day (date: users / tickets / revenue):\n"
+        for row in rows[-display_limit:]:
+            stats_text += f"`{row.get('date')}`: {int(row.get('new_users') or 0)} / {int(row.get('tickets') or 0)} / {Decimal(str(row.get('revenue') or 0)):.2f}\n"
+        if len(rows) > display_limit:
+            stats_text += f"(Showing last {display_limit} of {len(rows)} days.)\n"
+    else:
+        stats_text += "\nNo activity recorded in this range.\n"
+
+    await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+    logger.info(f"Admin range stats displayed for {start_date.isoformat()} - {end_date.isoformat()}.")
+
 @admin_only
 async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.debug("HANDLER_ADMIN: users_command invoked.")
@@ -627,7 +1788,12 @@ async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         user_list_text += f"Displaying first {display_limit} of {len(all_user_ids)} total users:\n"
     
     if limited_user_ids:
-        users_details_response = supabase.from_('users').select('telegram_id, username, first_name').in_('telegram_id', limited_user_ids).execute()
+        try:
+            users_details_response = await run_db_query('users_command_details', lambda: supabase.from_('users').select('telegram_id, username, first_name').in_('telegram_id', limited_user_ids))
+        except Exception as e:
+            logger.error(f"Supabase error fetching user details for /users: {e}")
+            await update.message.reply_text("⚠️ Could not fetch user details right now (database unavailable). Please try again later.")
+            return
         
         if users_details_response.data:
             for i, user_data in enumerate(users_details_response.data):
@@ -692,6 +1858,7 @@ async def confirm_payment_command(update: Update, context: ContextTypes.DEFAULT_
         return
 
     payment_info = pending_payments.pop(user_to_confirm_id) 
+    publish_pending_payment_count()
     claimed_payment_amount_by_user = payment_info['amount_paid']
     num_tickets_purchased = payment_info['num_tickets']
     original_message_id = payment_info['message_id']
@@ -699,68 +1866,115 @@ async def confirm_payment_command(update: Update, context: ContextTypes.DEFAULT_
 
     logger.info(f"Processing payment confirmation for user {user_to_confirm_id}: {num_tickets_purchased} tickets, {claimed_payment_amount_by_user:.2f} USDT.")
 
-    if not await increment_daily_tickets_for_user(user_to_confirm_id, num_tickets_purchased):
-        logger.error(f"Failed to increment tickets in DB for {user_to_confirm_id} after admin confirmation. Reverting pending payment.")
-        pending_payments[user_to_confirm_id] = payment_info 
+    lottery_round = daily_round(datetime.date.today())
+    claimed_round = None
+    moved_to_daily_round = False
+    if payment_info.get('round_id'):
+        claimed_round = await get_round(payment_info['round_id'])
+        if claimed_round and is_round_open(claimed_round):
+            lottery_round = claimed_round
+        else:
+            # Round confirm se pehle band ho gaya; tickets aaj ke daily draw mein jaate hain.
+            moved_to_daily_round = True
+            logger.warning(f"Round {payment_info['round_id']} closed before confirming payment of user {user_to_confirm_id}. Adding the tickets to {lottery_round['round_id']} instead.")
+
+    # Revenue aur split us round ke hisaab se jismein tickets jaate hain, taaki ek pool mein do price na milein.
+    priced_round = lottery_round
+    refund_amount = Decimal("0")
+    if moved_to_daily_round:
+        # Jitna pay hua utne daily tickets (daily price par); bacha hissa refund hota hai.
+        paid_value = num_tickets_purchased * claimed_round['ticket_price'] if claimed_round else claimed_payment_amount_by_user
+        paid_for_tickets = num_tickets_purchased
+        num_tickets_purchased = int(paid_value // lottery_round['ticket_price'])
+        refund_amount = (paid_value - num_tickets_purchased * lottery_round['ticket_price']).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        logger.info(f"Converted {paid_for_tickets} closed-round ticket(s) of user {user_to_confirm_id} ({paid_value:.2f} USDT) into {num_tickets_purchased} daily ticket(s) and a {refund_amount:.2f} USDT refund.")
+    value_of_tickets_purchased = num_tickets_purchased * priced_round['ticket_price']
+    referrer_id = None
+    referral_bonus = Decimal("0")
+    try:
+        referred_user_data = await get_user(user_to_confirm_id)
+    except DatabaseUnavailableError:
+        logger.error(f"Cannot confirm payment of {user_to_confirm_id}: database unavailable. Reverting pending payment.")
+        pending_payments[user_to_confirm_id] = payment_info
+        publish_pending_payment_count()
         if update.message:
-            await update.message.reply_text(f"❌ Error: Could not increment tickets for User ID `{user_to_confirm_id}` in the database. The payment claim has been reverted to pending. Please check logs and try again.")
+            await update.message.reply_text(f"⚠️ The database is unavailable right now. The payment claim of User ID `{user_to_confirm_id}` is still pending. Please try again in a minute.")
         return
-
-    referred_user_data = await get_user(user_to_confirm_id)
     if referred_user_data and referred_user_data.get('referrer_telegram_id'):
         referrer_id = referred_user_data['referrer_telegram_id']
-        value_of_tickets_purchased = num_tickets_purchased * TICKET_PRICE_USDT 
-        referral_bonus = value_of_tickets_purchased * REFERRAL_PERCENT
-        
-        if referral_bonus > 0:
-            logger.info(f"Referral bonus of {referral_bonus:.2f} USDT due to referrer {referrer_id} for user {user_to_confirm_id}'s purchase.")
-            await simulate_send_usdt(f"Referrer ID: {referrer_id}", referral_bonus, "Referral Bonus")
-            try:
-                referred_user_name = referred_user_data.get('first_name', f'User {user_to_confirm_id}')
-                await context.bot.send_message(
-                    chat_id=referrer_id, 
-                    text=(f"🎉 Referral Bonus! 🎉\n\n"
-                          f"You earned *{referral_bonus:.2f} USDT* because your referral, {referred_user_name}, "
-                          f"bought {num_tickets_purchased} ticket(s)!"),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                logger.info(f"Notified referrer {referrer_id} of {referral_bonus:.2f} USDT bonus from {user_to_confirm_id}'s purchase.")
-            except Exception as e:
-                logger.warning(f"Could not notify referrer {referrer_id} about their bonus: {e}")
-
-    try:
-        user_tickets_res = supabase.from_('daily_tickets').select('count').eq('telegram_id', user_to_confirm_id).eq('date', datetime.date.today().isoformat()).single().execute()
-        user_todays_total_tickets = 0
-        if user_tickets_res.data and isinstance(user_tickets_res.data.get('count'), int) :
-             user_todays_total_tickets = user_tickets_res.data['count']
-        else:
-             logger.warning(f"Could not retrieve total daily tickets for user {user_to_confirm_id} after confirmation. Response: {user_tickets_res.data}. Assuming newly purchased are the total for message.")
-             user_todays_total_tickets = num_tickets_purchased 
-        confirmation_text_to_user = (
-            f"✅ Your payment for {num_tickets_purchased} ticket(s) ({claimed_payment_amount_by_user:.2f} USDT) is confirmed!\n"
-            f"You now have *{user_todays_total_tickets}* ticket(s) registered for today's draw! Good luck! 🍀"
+        referral_bonus = value_of_tickets_purchased * priced_round['referral_percent']
+
+    notifications = []
+    if referral_bonus > 0:
+        referred_user_name = referred_user_data.get('first_name', f'User {user_to_confirm_id}')
+        notifications.append(outbox_message(
+            referrer_id,
+            (f"🎉 Referral Bonus! 🎉\n\n"
+             f"You earned *{referral_bonus:.2f} USDT* because your referral, {referred_user_name}, "
+             f"bought {num_tickets_purchased} ticket(s)!"),
+            parse_mode=ParseMode.MARKDOWN
+        ))
+
+    # Notifications payment ke saath hi commit hote hain, isliye count pehle padh kar naya total banate hain.
+    user_round_total_tickets = (await get_user_tickets_for_round(lottery_round, user_to_confirm_id) or 0) + num_tickets_purchased
+    round_description = "today's draw" if lottery_round['kind'] == 'daily' else round_label(lottery_round)
+    confirmation_text_to_user = (
+        f"✅ Your payment for {num_tickets_purchased} ticket(s) ({claimed_payment_amount_by_user:.2f} USDT) is confirmed!\n"
+        f"You now have *{user_round_total_tickets}* ticket(s) registered for {round_description}! Good luck! 🍀"
+    )
+    if moved_to_daily_round:
+        confirmation_text_to_user += (
+            f"\n(The round you paid for closed before your payment was verified, so your payment was converted into "
+            f"{num_tickets_purchased} ticket(s) for today's daily draw at {lottery_round['ticket_price']:.2f} USDT each."
         )
-        try:
-            await context.bot.edit_message_text(
-                chat_id=original_chat_id, 
-                message_id=original_message_id, 
-                text=confirmation_text_to_user, 
-                parse_mode=ParseMode.MARKDOWN
-            )
-            logger.info(f"Edited original payment message for user {user_to_confirm_id} with confirmation.")
-        except Exception as edit_e:
-            logger.warning(f"Failed to edit original payment message for {user_to_confirm_id}: {edit_e}. Sending a new message instead.")
-            await context.bot.send_message(
-                chat_id=user_to_confirm_id, 
-                text=confirmation_text_to_user, 
-                parse_mode=ParseMode.MARKDOWN
-            )
-        logger.info(f"Payment confirmed for user {user_to_confirm_id}. {num_tickets_purchased} tickets added to their name.")
-    except Exception as e:
-        logger.error(f"Failed to notify user {user_to_confirm_id} about payment confirmation: {e}")
+        if refund_amount > 0:
+            confirmation_text_to_user += f" The remaining {refund_amount:.2f} USDT is being refunded to you."
+        confirmation_text_to_user += ")"
+    # Original message edit na ho paaye to dispatcher user ko naya message bhejta hai.
+    notifications.append(outbox_edit_message(
+        original_chat_id,
+        original_message_id,
+        confirmation_text_to_user,
+        parse_mode=ParseMode.MARKDOWN,
+        fallback_chat_id=user_to_confirm_id
+    ))
+
+    # Claim ki key se retry safe hai: pichli koshish commit ho chuki ho to dobara credit (ya notify) nahi hota.
+    confirmation = await confirm_ticket_payment(
+        payment_info['claim_id'],
+        lottery_round,
+        user_to_confirm_id,
+        num_tickets_purchased,
+        claimed_payment_amount_by_user,
+        payment_info['date'],
+        ticket_value=value_of_tickets_purchased,
+        prize_amount=value_of_tickets_purchased * priced_round['prize_pool_percent'],
+        referrer_telegram_id=referrer_id,
+        referral_bonus=referral_bonus,
+        notifications=notifications
+    )
+    if confirmation is None:
+        logger.error(f"Failed to confirm payment in DB for {user_to_confirm_id} after admin confirmation. Reverting pending payment.")
+        pending_payments[user_to_confirm_id] = payment_info 
+        publish_pending_payment_count()
+        if update.message:
+            await update.message.reply_text(f"❌ Error: Could not record the payment of User ID `{user_to_confirm_id}` in the database. The payment claim has been reverted to pending. Please check logs and try again; a retry never credits the claim twice.")
+        return
+    invalidate_user_ticket_view(user_to_confirm_id)
+    wake_outbox_dispatcher(context)
+
+    if confirmation['applied'] and referral_bonus > 0:
+        logger.info(f"Referral bonus of {referral_bonus:.2f} USDT due to referrer {referrer_id} for user {user_to_confirm_id}'s purchase.")
+        await simulate_send_usdt(f"Referrer ID: {referrer_id}", referral_bonus, "Referral Bonus")
+    if confirmation['applied'] and refund_amount > 0:
+        await simulate_send_usdt(f"User ID: {user_to_confirm_id}", refund_amount, "Closed Round Remainder Refund")
+    logger.info(f"Payment confirmed for user {user_to_confirm_id}. {num_tickets_purchased} tickets added to their name.")
 
     if update.message:
-        await update.message.reply_text(f"✅ Payment confirmed successfully for User ID `{user_to_confirm_id}`. {num_tickets_purchased} tickets have been added.")
+        admin_reply = f"✅ Payment confirmed successfully for User ID `{user_to_confirm_id}`. {num_tickets_purchased} tickets have been added to round {lottery_round['round_id']}."
+        if moved_to_daily_round:
+            admin_reply += f" The claimed round had closed, so the payment was repriced at the daily ticket price; {refund_amount:.2f} USDT was refunded."
+        await update.message.reply_text(admin_reply)
 
 @admin_only
 async def manual_winner_draw_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -779,43 +1993,94 @@ async def manual_winner_draw_command(update: Update, context: ContextTypes.DEFAU
 async def perform_winner_draw(context: ContextTypes.DEFAULT_TYPE, date_override: datetime.date | None = None) -> None:
     draw_date = date_override if date_override else (datetime.date.today() - datetime.timedelta(days=1))
     logger.info(f"SCHEDULER: Starting winner draw process for tickets of date: {draw_date.isoformat()}")
-
-    actual_prize_amount_for_draw = await calculate_prize_for_date(draw_date)
-    logger.info(f"SCHEDULER: Calculated total prize for {draw_date.isoformat()} draw: {actual_prize_amount_for_draw:.2f} USDT")
-
-    if actual_prize_amount_for_draw <= Decimal("0.00"):
-        logger.info(f"SCHEDULER: No prize pool available for {draw_date.isoformat()} (prize is {actual_prize_amount_for_draw:.2f} USDT). No winner will be drawn.")
-        broadcast_text_no_winner = (
-            f"🗓️ Daily Draw Results for {draw_date.isoformat()} 🗓️\n\n"
-            f"No tickets were sold for this date, so there was no prize pool for this draw.\n"
-            f"Don't miss out! Buy your tickets today for a chance to win in tomorrow's draw!"
-        )
-        user_ids_to_notify = await get_all_user_telegram_ids()
-        if user_ids_to_notify:
-            await broadcast_message_to_users_list(context, user_ids_to_notify, broadcast_text_no_winner)
+    await perform_round_draw(context, daily_round(draw_date))
+
+# --- Round Draw Engine ---
+# Har round ka draw apne job/task mein chalta hai, isliye kai rounds ek saath close aur draw ho sakte
+# hain. Ek hi round ka doosra draw is process mein round_draw_locks rokta hai, aur processes ke beech
+# claim_round_for_draw (open -> drawing, ek claim_id ke naam lease ke saath). Draw fail ho to round
+# 'drawing' mein hi rehta hai aur wahi claim_id retry par use dobara le leta hai; process mar jaaye to
+# lease khatam hone ke baad koi bhi naya draw use le sakta hai. Announcements outbox ke bulk lane se jaate hain.
+round_draw_locks = {} # {round_id: asyncio.Lock}
+ROUND_DRAW_RETRY_SECONDS = 120 # pehli retry; har baar double
+ROUND_DRAW_MAX_ATTEMPTS = 5
+ROUND_DRAW_LEASE_SECONDS = 600
+
+def pick_weighted_winner(ticket_entries: list) -> int | None:
+    """Pick a telegram_id with probability proportional to its ticket count, without expanding one entry per ticket."""
+    entries = [(entry['telegram_id'], entry['count']) for entry in ticket_entries
+               if entry.get('telegram_id') and isinstance(entry.get('count'), int) and entry['count'] > 0]
+    if not entries:
+        return None
+    telegram_ids, counts = zip(*entries)
+    return random.choices(telegram_ids, weights=counts, k=1)[0]
+
+def round_results_title(lottery_round: dict) -> str:
+    if lottery_round['kind'] == 'daily':
+        return f"Daily Draw Results for {lottery_round['date'].isoformat()}"
+    if lottery_round['kind'] == 'hourly':
+        return f"Hourly Round Results ({lottery_round['opens_at']:%H:%M}–{lottery_round['closes_at']:%H:%M})"
+    return f"Flash Round Results ({lottery_round['closes_at']:%H:%M})"
+
+async def perform_round_draw(context: ContextTypes.DEFAULT_TYPE, lottery_round: dict, attempt: int = 0, claim_id: str | None = None) -> None:
+    round_id = lottery_round['round_id']
+    lock = round_draw_locks.setdefault(round_id, asyncio.Lock())
+    if lock.locked():
+        logger.warning(f"SCHEDULER: Draw for round {round_id} is already running. Skipping duplicate trigger.")
         return
-
-    ticket_entries_for_draw = await get_daily_ticket_entries_for_draw(draw_date)
-    if not ticket_entries_for_draw:
-        logger.warning(f"SCHEDULER: Prize pool is > 0 for {draw_date.isoformat()} ({actual_prize_amount_for_draw:.2f} USDT), but no ticket entries were found in the database. This indicates a potential inconsistency. No winner declared.")
+    async with lock:
         try:
-            await context.bot.send_message(ADMIN_ID, f"⚠️ CRITICAL WARNING: Inconsistency in draw for {draw_date.isoformat()}. Prize pool was {actual_prize_amount_for_draw:.2f} USDT, but NO ticket entries found. Please investigate the `daily_tickets` table for this date.")
-        except Exception as e_admin_warn:
-            logger.error(f"Failed to send inconsistency warning to admin: {e_admin_warn}")
+            await draw_round(context, lottery_round, attempt, claim_id)
+        finally:
+            round_draw_locks.pop(round_id, None)
+
+async def draw_round(context: ContextTypes.DEFAULT_TYPE, lottery_round: dict, attempt: int = 0, claim_id: str | None = None) -> None:
+    round_id = lottery_round['round_id']
+    is_daily = lottery_round['kind'] == 'daily'
+    if not is_daily:
+        claim_id = claim_id or f"{round_id}:{uuid.uuid4().hex}"
+        claimed = await claim_round_for_draw(round_id, claim_id)
+        if claimed is None:
+            retry_round_draw(context.job_queue, round_id, attempt, "the claim failed", claim_id)
+            return
+        if not claimed:
+            await recheck_claimed_round(context.job_queue, round_id)
+            return
+
+    # Prize aur winner dono isi uncached read se; DB na mile to cached total se "0 tickets" announce karne ke bajaye retry + admin alert.
+    try:
+        if is_daily and await daily_draw_recorded(lottery_round['date']):
+            logger.info(f"SCHEDULER: Daily draw for {lottery_round['date'].isoformat()} already has a winner. Skipping.")
+            return
+        ticket_entries_for_draw = await get_round_ticket_entries(lottery_round)
+    except DatabaseUnavailableError as e:
+        await handle_unreadable_draw(context, round_id, attempt, claim_id, e)
         return
 
-    weighted_ticket_list = []
-    for entry in ticket_entries_for_draw:
-        if entry.get('telegram_id') and isinstance(entry.get('count'), int) and entry['count'] > 0:
-            weighted_ticket_list.extend([entry['telegram_id']] * entry['count'])
-    
-    if not weighted_ticket_list:
-        logger.info(f"SCHEDULER: Ticket entries were found for {draw_date.isoformat()}, but the weighted list is empty after processing. No winner can be declared.")
+    total_tickets_sold = sum(entry['count'] for entry in ticket_entries_for_draw
+                             if entry.get('telegram_id') and isinstance(entry.get('count'), int) and entry['count'] > 0)
+    actual_prize_amount_for_draw = prize_for_ticket_total(lottery_round, total_tickets_sold)
+    logger.info(f"SCHEDULER: Calculated total prize for round {round_id} from {total_tickets_sold} tickets: {actual_prize_amount_for_draw:.2f} USDT")
+
+    if actual_prize_amount_for_draw <= Decimal("0.00"):
+        logger.info(f"SCHEDULER: No prize pool available for round {round_id} (prize is {actual_prize_amount_for_draw:.2f} USDT). No winner will be drawn.")
+        if is_daily:
+            broadcast_text_no_winner = (
+                f"🗓️ Daily Draw Results for {lottery_round['date'].isoformat()} 🗓️\n\n"
+                f"No tickets were sold for this date, so there was no prize pool for this draw.\n"
+                f"Don't miss out! Buy your tickets today for a chance to win in tomorrow's draw!"
+            )
+            await enqueue_notifications(context, [outbox_broadcast(broadcast_text_no_winner)])
+        else:
+            await settle_round(round_id, 'drawn')
         return
 
-    logger.debug(f"SCHEDULER: Total weighted entries for draw on {draw_date.isoformat()}: {len(weighted_ticket_list)}")
-    winner_telegram_id = random.choice(weighted_ticket_list)
-    winner_user_data = await get_user(winner_telegram_id) 
+    winner_telegram_id = pick_weighted_winner(ticket_entries_for_draw)
+    logger.debug(f"SCHEDULER: {len(ticket_entries_for_draw)} ticket entries in the draw for round {round_id}")
+    try:
+        winner_user_data = await get_user(winner_telegram_id)
+    except DatabaseUnavailableError:
+        winner_user_data = None # naam ke bina bhi announce ho sakta hai
 
     winner_name_display = f'User {winner_telegram_id}' 
     winner_username_display = 'N/A'
@@ -823,29 +2088,157 @@ async def perform_winner_draw(context: ContextTypes.DEFAULT_TYPE, date_override:
         winner_name_display = winner_user_data.get('first_name', winner_name_display)
         winner_username_display = winner_user_data.get('username', winner_username_display)
     
-    logger.info(f"SCHEDULER: Winner selected for {draw_date.isoformat()}: User ID {winner_telegram_id} ({winner_name_display} @{winner_username_display})")
-
-    await simulate_send_usdt(f"Winner ID: {winner_telegram_id}", actual_prize_amount_for_draw, "Winner Prize Payout")
-    
-    await add_winner_record(winner_telegram_id, actual_prize_amount_for_draw, draw_date)
+    logger.info(f"SCHEDULER: Winner selected for round {round_id}: User ID {winner_telegram_id} ({winner_name_display} @{winner_username_display})")
 
     broadcast_text_winner = (
-        f"🎉🏆 **Daily Draw Results for {draw_date.isoformat()}** 🏆🎉\n\n"
+        f"🎉🏆 **{round_results_title(lottery_round)}** 🏆🎉\n\n"
         f"And the winner is... **{winner_name_display}** (@{winner_username_display})!\n\n"
         f"Congratulations! You have won *{actual_prize_amount_for_draw:.2f} USDT*!\n\n"
         f"Thank you to everyone who participated. Buy your tickets today for the next exciting draw!"
     )
-    user_ids_to_notify = await get_all_user_telegram_ids()
-    if user_ids_to_notify:
-        await broadcast_message_to_users_list(context, user_ids_to_notify, broadcast_text_winner, parse_mode=ParseMode.MARKDOWN)
-    
-    logger.info(f"SCHEDULER: Winner {winner_telegram_id} successfully processed and announced for {draw_date.isoformat()} with prize {actual_prize_amount_for_draw:.2f} USDT")
+    # Intraday rounds sirf participants ko announce hote hain; daily draw sabko.
+    participant_ids = None if is_daily else [entry['telegram_id'] for entry in ticket_entries_for_draw if entry.get('telegram_id')]
+    announcement = outbox_broadcast(broadcast_text_winner, parse_mode=ParseMode.MARKDOWN, user_ids=participant_ids)
+    if not await record_draw_result(lottery_round, winner_telegram_id, actual_prize_amount_for_draw, [announcement]):
+        retry_round_draw(context.job_queue, round_id, attempt, "the result could not be recorded", claim_id)
+        await enqueue_notifications(context, [outbox_message(ADMIN_ID, f"⚠️ CRITICAL WARNING: Could not record the winner of round {round_id} (User ID {winner_telegram_id}, {actual_prize_amount_for_draw:.2f} USDT). No prize was paid and nothing was announced. Please check the logs.")])
+        return
+    invalidate_user_ticket_view()
+    wake_outbox_dispatcher(context)
+
+    # Payout sirf record commit hone ke baad, taaki dobara draw hone par double payment na ho.
+    await simulate_send_usdt(f"Winner ID: {winner_telegram_id}", actual_prize_amount_for_draw, "Winner Prize Payout")
+
+    logger.info(f"SCHEDULER: Winner {winner_telegram_id} successfully processed and announced for round {round_id} with prize {actual_prize_amount_for_draw:.2f} USDT")
+
+def schedule_round_draw(job_queue, lottery_round: dict) -> None:
+    job_name = f"round_draw_{lottery_round['round_id']}"
+    if job_queue.get_jobs_by_name(job_name):
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    job_queue.run_once(round_draw_job, when=max(lottery_round['closes_at'], now), data={'round_id': lottery_round['round_id'], 'attempt': 0}, name=job_name)
+    logger.info(f"SCHEDULER: Draw for round {lottery_round['round_id']} scheduled at {lottery_round['closes_at'].isoformat()}.")
+
+def retry_round_draw(job_queue, round_id: str, attempt: int, reason: str, claim_id: str | None) -> bool:
+    """Draw a round again later, with backoff (intraday rounds under the same claim_id). False once attempts run out."""
+    if attempt + 1 >= ROUND_DRAW_MAX_ATTEMPTS:
+        logger.error(f"SCHEDULER: Draw for round {round_id} failed {attempt + 1} times ({reason}). Giving up; intraday rounds are drawn by open-round recovery at the next restart once their {ROUND_DRAW_LEASE_SECONDS}s claim lease runs out, the daily draw needs /trigger_draw.")
+        return False
+    delay = ROUND_DRAW_RETRY_SECONDS * 2 ** attempt
+    job_queue.run_once(round_draw_job, when=delay, data={'round_id': round_id, 'attempt': attempt + 1, 'claim_id': claim_id}, name=f"round_draw_{round_id}")
+    logger.warning(f"SCHEDULER: Draw for round {round_id} did not complete ({reason}). Retrying in {delay}s (attempt {attempt + 2}/{ROUND_DRAW_MAX_ATTEMPTS}).")
+    return True
+
+async def handle_unreadable_draw(context: ContextTypes.DEFAULT_TYPE, round_id: str, attempt: int, claim_id: str | None, error: Exception) -> None:
+    logger.error(f"SCHEDULER: Could not read the tickets of round {round_id} for its draw: {error}")
+    retrying = retry_round_draw(context.job_queue, round_id, attempt, "the database could not be read", claim_id)
+    if attempt > 0 and retrying:
+        return
+    # Outbox bhi DB mein hai, isliye alert seedha bhejo; pehli failure aur aakhri haar par hi, spam nahi.
+    outcome = f"Retrying every few minutes (up to {ROUND_DRAW_MAX_ATTEMPTS} attempts)." if retrying else "Gave up retrying; please redraw it once the database is back."
+    try:
+        await context.bot.send_message(chat_id=ADMIN_ID, text=f"⚠️ Draw for round {round_id} is delayed: the database could not be read ({error}). {outcome}")
+    except TelegramError as e:
+        logger.error(f"SCHEDULER: Could not alert the admin about the delayed draw of round {round_id}: {e}")
+
+async def recheck_claimed_round(job_queue, round_id: str) -> None:
+    # Claim nahi mila: ya round draw ho chuka, ya koi aur draw us par lease rakhta hai. Lease khatam hone par
+    # dobara dekho, taaki beech mein mara hua draw round ko 'drawing' mein hamesha ke liye na chhod de.
+    lottery_round = await get_round(round_id)
+    if not lottery_round or lottery_round['status'] != 'drawing':
+        logger.info(f"SCHEDULER: Round {round_id} is missing or already drawn. Skipping.")
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    lease_ends_at = (lottery_round['drawing_since'] or now) + datetime.timedelta(seconds=ROUND_DRAW_LEASE_SECONDS)
+    job_queue.run_once(round_draw_job, when=max(lease_ends_at, now) + datetime.timedelta(seconds=1), data={'round_id': round_id, 'attempt': 0}, name=f"round_draw_{round_id}")
+    logger.info(f"SCHEDULER: Round {round_id} is being drawn by another claim. Checking again when its lease ends at {lease_ends_at.isoformat()}.")
+
+async def round_draw_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    round_id = context.job.data['round_id']
+    lottery_round = await get_round(round_id)
+    # 'drawing' bhi: claim commit hua par jawab kho gaya, ya draw beech mein ruka. Winner record ho chuka ho to claim mana ho jaata hai.
+    # Daily round ka status hamesha 'closed' hota hai; uska dobara draw daily_draw_recorded se rukta hai.
+    if not lottery_round or (lottery_round['kind'] != 'daily' and lottery_round['status'] not in ('open', 'drawing')):
+        logger.info(f"SCHEDULER: Round {round_id} is missing or already drawn. Nothing to do.")
+        return
+    await perform_round_draw(context, lottery_round, context.job.data['attempt'], context.job.data.get('claim_id'))
+
+async def open_hourly_round_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    opens_at = datetime.datetime.now(round_timezone()).replace(minute=0, second=0, microsecond=0)
+    closes_at = opens_at + datetime.timedelta(hours=1)
+    lottery_round = await create_round('hourly', opens_at, closes_at, HOURLY_TICKET_PRICE_USDT)
+    if not lottery_round:
+        logger.error(f"SCHEDULER: Could not open the hourly round starting {opens_at.isoformat()}.")
+        return
+    schedule_round_draw(context.job_queue, lottery_round)
+
+async def recover_open_rounds_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Restart ke baad: har open round (jinka close time nikal gaya woh bhi) aur adhoore 'drawing' round ka
+    # draw dobara schedule karo; 'drawing' wale ka claim lease khatam hone ke baad hi milta hai.
+    if HOURLY_ROUNDS_ENABLED:
+        await open_hourly_round_job(context)
+    open_rounds = await get_open_rounds(include_drawing=True)
+    for lottery_round in open_rounds:
+        schedule_round_draw(context.job_queue, lottery_round)
+    logger.info(f"SCHEDULER: Recovered {len(open_rounds)} open round(s).")
+
+async def rounds_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("HANDLER: rounds_command invoked.")
+    if not update.message: return
+
+    today_round = daily_round(datetime.date.today())
+    intraday_rounds = [lottery_round for lottery_round in await get_open_rounds() if is_round_open(lottery_round)]
+    prizes = await asyncio.gather(*(calculate_prize_for_round(lottery_round) for lottery_round in [today_round] + intraday_rounds))
+
+    lines = [
+        "🎟️ **Open Rounds** 🎟️\n",
+        f"• Daily draw — ticket *{today_round['ticket_price']:.2f} USDT*, pool so far *{prizes[0]:.2f} USDT*, drawn at 00:01. /buy"
+    ]
+    for lottery_round, prize in zip(intraday_rounds, prizes[1:]):
+        lines.append(
+            f"• {round_label(lottery_round).capitalize()} — ticket *{lottery_round['ticket_price']:.2f} USDT*, "
+            f"pool so far *{prize:.2f} USDT*. /buy {lottery_round['round_id']}"
+        )
+    if not intraday_rounds:
+        lines.append("\nNo hourly or flash rounds are open right now.")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+@admin_only
+async def flash_round_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug(f"HANDLER_ADMIN: flash_round_command invoked with args {context.args}")
+    if not update.message: return
+    try:
+        if not context.args or len(context.args) > 2:
+            raise ValueError("wrong number of arguments")
+        minutes = int(context.args[0])
+        ticket_price = Decimal(context.args[1]) if len(context.args) == 2 else TICKET_PRICE_USDT
+        if not (1 <= minutes <= FLASH_ROUND_MAX_MINUTES) or ticket_price <= 0:
+            raise ValueError("out of range")
+    except (ValueError, ArithmeticError) as e:
+        await update.message.reply_text(f"Usage: `/flash_round <minutes 1-{FLASH_ROUND_MAX_MINUTES}> [ticket_price]`", parse_mode=ParseMode.MARKDOWN)
+        logger.info(f"Invalid /flash_round arguments {context.args}: {e}")
+        return
+
+    opens_at = datetime.datetime.now(datetime.timezone.utc)
+    lottery_round = await create_round('flash', opens_at, opens_at + datetime.timedelta(minutes=minutes), ticket_price)
+    if not lottery_round:
+        await update.message.reply_text("❌ Could not create the flash round. Please check the logs.")
+        return
+    schedule_round_draw(context.job_queue, lottery_round)
+    announcement = (
+        f"⚡ **Flash Round!** ⚡\n\n"
+        f"A {minutes}-minute round just opened. Tickets cost *{ticket_price:.2f} USDT* and the winner is drawn at "
+        f"{lottery_round['closes_at']:%H:%M}.\n\nJoin now: /buy {lottery_round['round_id']}"
+    )
+    await enqueue_notifications(context, [outbox_broadcast(announcement, parse_mode=ParseMode.MARKDOWN)])
+    await update.message.reply_text(f"✅ Flash round `{lottery_round['round_id']}` is open until {lottery_round['closes_at']:%H:%M}.", parse_mode=ParseMode.MARKDOWN)
+    logger.info(f"Admin opened flash round {lottery_round['round_id']} for {minutes} minutes at {ticket_price} USDT.")
 
 async def send_daily_marketing_message_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("SCHEDULER: Starting send_daily_marketing_message_job.")
-    message_content = await get_random_marketing_message_content()
+    marketing_message = await get_random_marketing_message()
     
-    if not message_content:
+    if not marketing_message:
         logger.warning("SCHEDULER: No marketing messages found in the database. Skipping daily marketing message.")
         return
 
@@ -855,9 +2248,192 @@ async def send_daily_marketing_message_job(context: ContextTypes.DEFAULT_TYPE) -
         logger.info("SCHEDULER: No users found to send the marketing message to.")
         return
     
-    await broadcast_message_to_users_list(context, user_ids, message_content) 
+    if marketing_message.get('media_type'):
+        await broadcast_media_to_users_list(context, user_ids, marketing_message)
+    else:
+        await broadcast_message_to_users_list(context, user_ids, marketing_message['content'])
     logger.info("SCHEDULER: Daily marketing message job completed.")
 
+async def archive_daily_tickets_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Aaj aur kal hot rehte hain; usse purani sirf woh dates jaati hain jinka winner record ho chuka hai.
+    logger.info("SCHEDULER: Starting archive_daily_tickets_job.")
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    archived_dates = await archive_closed_ticket_dates(yesterday)
+    if archived_dates is None:
+        logger.error("SCHEDULER: Daily tickets archival failed. Hot table will keep growing until the next successful run.")
+    logger.info("SCHEDULER: archive_daily_tickets_job completed.")
+
+async def reconcile_daily_stats_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # daily_stats ko users/payments se dobara gino, taaki rollup kabhi drift na kare (aur backfill ki zaroorat na rahe).
+    logger.info("SCHEDULER: Starting reconcile_daily_stats_job.")
+    rewritten_rows = await reconcile_daily_stats()
+    if rewritten_rows is None:
+        logger.error("SCHEDULER: Daily stats reconciliation failed. /stats keeps the incremental values until the next run.")
+    elif rewritten_rows:
+        logger.warning(f"SCHEDULER: Daily stats reconciliation corrected {rewritten_rows} row(s).")
+    logger.info("SCHEDULER: reconcile_daily_stats_job completed.")
+
+# --- Per-User Ticket View (/mytickets) ---
+# Draw se pehle users baar-baar /mytickets dekhte hain, isliye har user ka view TTL ke saath cache hota
+# hai. Payment confirm hone par us user ka, aur draw complete hone par sabka cache invalidate hota hai.
+MYTICKETS_CACHE_TTL_SECONDS = 300
+MYTICKETS_HISTORY_DAYS = 7
+MYTICKETS_WINS_LIMIT = 5
+user_ticket_view_cache = {} # {telegram_id: {'date': date, 'epoch': int, 'expires_at': float, 'view': dict}}
+# BOT_WORKERS > 1 mein draw sirf worker 0 par hota hai; yeh shared counter baaki workers ke caches bhi invalidate karta hai.
+shared_ticket_view_epoch = None # multiprocessing.Value, sirf worker processes mein set hota hai
+
+def ticket_view_epoch() -> int:
+    return shared_ticket_view_epoch.value if shared_ticket_view_epoch is not None else 0
+
+def invalidate_user_ticket_view(telegram_id: int | None = None) -> None:
+    """Drop one user's cached /mytickets view, or everyone's (in every worker) when telegram_id is None."""
+    if telegram_id is None:
+        user_ticket_view_cache.clear()
+        if shared_ticket_view_epoch is not None:
+            with shared_ticket_view_epoch.get_lock():
+                shared_ticket_view_epoch.value += 1
+        logger.debug("MYTICKETS: All cached ticket views invalidated.")
+    else:
+        user_ticket_view_cache.pop(telegram_id, None)
+        logger.debug(f"MYTICKETS: Cached ticket view for {telegram_id} invalidated.")
+
+async def load_user_ticket_view(telegram_id: int, today_date: datetime.date) -> dict:
+    from_date = today_date - datetime.timedelta(days=MYTICKETS_HISTORY_DAYS - 1)
+    from_time = round_timezone().localize(datetime.datetime.combine(from_date, datetime.time.min))
+    history_response, round_tickets_response, wins_response = await asyncio.gather(
+        run_db_query('get_user_ticket_history', lambda: supabase.rpc('get_user_ticket_history', {
+            'user_id_input': telegram_id,
+            'from_date_input': from_date.isoformat()
+        })),
+        run_db_query('get_user_round_tickets', lambda: supabase.rpc('get_user_round_tickets', {
+            'user_id_input': telegram_id,
+            'from_input': from_time.isoformat()
+        })),
+        run_db_query('get_user_wins', lambda: supabase.from_('winners').select('amount, win_date').eq('telegram_id', telegram_id).order('win_date', desc=True).limit(MYTICKETS_WINS_LIMIT))
+    )
+    daily_counts = {}
+    for row in history_response.data or []:
+        daily_counts[row['date']] = daily_counts.get(row['date'], 0) + int(row.get('count') or 0)
+    today_count = daily_counts.get(today_date.isoformat(), 0)
+    # Hourly/flash round tickets bhi din ke total mein gine jaate hain; jo round abhi draw nahi hua woh alag dikhta hai.
+    open_rounds = []
+    for row in round_tickets_response.data or []:
+        lottery_round = round_from_row(row)
+        count = int(row.get('count') or 0)
+        day = lottery_round['date'].isoformat()
+        daily_counts[day] = daily_counts.get(day, 0) + count
+        if lottery_round['status'] != 'drawn':
+            open_rounds.append((round_label(lottery_round), count))
+    return {
+        'today_count': today_count,
+        'open_rounds': open_rounds,
+        'recent_days': sorted(daily_counts.items(), reverse=True),
+        'wins': wins_response.data or [],
+    }
+
+async def get_user_ticket_view(telegram_id: int) -> dict | None:
+    today_date = datetime.date.today()
+    current_epoch = ticket_view_epoch()
+    cached = user_ticket_view_cache.get(telegram_id)
+    if cached and cached['date'] == today_date and cached['epoch'] == current_epoch and cached['expires_at'] > time.monotonic():
+        logger.debug(f"MYTICKETS: Cache hit for {telegram_id}.")
+        return cached['view']
+
+    try:
+        view = await load_user_ticket_view(telegram_id, today_date)
+    except Exception as e:
+        logger.error(f"Supabase error loading ticket view for {telegram_id}: {e}")
+        # Outage mein purana view (expired ho tab bhi) khaali jawab se behtar hai.
+        return cached['view'] if cached and cached['date'] == today_date else None
+
+    user_ticket_view_cache[telegram_id] = {'date': today_date, 'epoch': current_epoch, 'expires_at': time.monotonic() + MYTICKETS_CACHE_TTL_SECONDS, 'view': view}
+    return view
+
+async def mytickets_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("HANDLER: mytickets_command invoked.")
+    user = update.effective_user
+    if not update.message or not user: return
+
+    view = await get_user_ticket_view(user.id)
+    if view is None:
+        await update.message.reply_text("⚠️ Could not load your tickets right now. Please try again in a minute.")
+        return
+
+    mytickets_text = (
+        f"🎟️ **Your Tickets** 🎟️\n\n"
+        f"Today's daily draw (drawn at 00:01 tonight): *{view['today_count']}* ticket(s)\n"
+    )
+    for label, count in view['open_rounds']:
+        mytickets_text += f"⏱️ {label.capitalize()} (not drawn yet): *{count}* ticket(s)\n"
+    pending_claim = pending_payments.get(user.id)
+    if pending_claim:
+        mytickets_text += f"⏳ Pending verification: {pending_claim['num_tickets']} ticket(s) ({pending_claim['amount_paid']:.2f} USDT)\n"
+
+    mytickets_text += f"\nLast {MYTICKETS_HISTORY_DAYS} days (all rounds):\n"
+    if view['recent_days']:
+        for day, count in view['recent_days']:
+            mytickets_text += f"🗓️ {day}: {count} ticket(s)\n"
+    else:
+        mytickets_text += "No tickets yet. Use /buy to get started!\n"
+
+    mytickets_text += "\n🏆 Your wins:\n"
+    if view['wins']:
+        for win in view['wins']:
+            amount = Decimal(str(win.get('amount', '0'))).quantize(Decimal("0.01"))
+            mytickets_text += f"{win.get('win_date')}: *{amount:.2f} USDT*\n"
+    else:
+        mytickets_text += "No wins yet. Good luck in the next draw! 🍀\n"
+
+    await update.message.reply_text(mytickets_text, parse_mode=ParseMode.MARKDOWN)
+    logger.info(f"Ticket view displayed for {user.id}.")
+
+async def refer_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("HANDLER: refer_command invoked.")
+    user = update.effective_user
+    if not update.message or not user: return
+
+    stats = await get_referral_stats(user.id)
+    refer_text = (
+        f"🤝 **Your Referral Dashboard** 🤝\n\n"
+        f"Your referral link:\n`https://t.me/{context.bot.username}?start={user.id}`\n\n"
+        f"👥 Friends referred: *{stats['referral_count']}*\n"
+        f"🎟️ Tickets bought by your referrals: *{stats['referral_tickets']}*\n"
+        f"💰 Total bonus earned: *{stats['bonus_earned']:.2f} USDT*\n\n"
+        f"You get {REFERRAL_PERCENT*100:.0f}% of the ticket price for every ticket your referred friends buy, FOREVER!"
+    )
+    await update.message.reply_text(refer_text, parse_mode=ParseMode.MARKDOWN)
+    logger.info(f"Referral dashboard displayed for {user.id}.")
+
+@admin_only
+async def top_referrers_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("HANDLER_ADMIN: top_referrers_command invoked.")
+    if not update.message: return
+
+    try:
+        limit = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Usage: `/top_referrers [count]`", parse_mode=ParseMode.MARKDOWN)
+        return
+    limit = max(1, min(limit, 50))
+
+    top_referrers = await get_top_referrers(limit)
+    leaderboard_text = f"🏅 **Top {limit} Referrers** 🏅\n\n"
+    if not top_referrers:
+        leaderboard_text += "No referrals recorded yet."
+    for i, row in enumerate(top_referrers):
+        user_info = row.get('user_info') or {}
+        # Naam aur username user ke diye hue hain; `_`, `*` jaise chars Markdown tod dete hain.
+        name_display = escape_markdown(user_info.get('first_name') or f"User {row['referrer_telegram_id']}")
+        username_display = escape_markdown(user_info.get('username') or 'N/A')
+        bonus_earned = Decimal(str(row.get('bonus_earned') or 0)).quantize(Decimal("0.01"))
+        leaderboard_text += (
+            f"{i+1}. {name_display} (@{username_display}) [ID: `{row['referrer_telegram_id']}`]: "
+            f"{row.get('referral_count', 0)} referrals, {row.get('referral_tickets', 0)} tickets, *{bonus_earned:.2f} USDT*\n"
+        )
+    await update.message.reply_text(leaderboard_text, parse_mode=ParseMode.MARKDOWN)
+    logger.info("Admin top referrers leaderboard displayed.")
+
 async def winners_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.debug("HANDLER: winners_command invoked.")
     if not update.message: return
@@ -890,13 +2466,465 @@ async def winners_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text(winners_list_text, parse_mode=ParseMode.MARKDOWN)
     logger.info("Winners list displayed.")
 
+# --- Data Export (/export and export.py) ---
+# Keyset pagination: har page pichhle page ki aakhri key ke baad se shuru hota hai, isliye OFFSET
+# ki tarah bade tables par slow nahi hota. Har page seedha gzip file mein likha jaata hai, memory
+# sirf ek page jitni lagti hai.
+EXPORT_PAGE_SIZE = 1000
+EXPORT_ARCHIVE_DAYS_PER_PAGE = 7 # archive rows hold a whole day each
+EXPORT_TELEGRAM_DOCUMENT_LIMIT_BYTES = 50 * 1024 * 1024 # Bot API upload limit
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_TABLES = {
+    'tickets': {'table': 'daily_tickets', 'columns': ['date', 'telegram_id', 'count'], 'date_column': 'date', 'key': ['date', 'telegram_id'], 'is_timestamp': False},
+    'winners': {'table': 'winners', 'columns': ['id', 'win_date', 'telegram_id', 'amount', 'round_id'], 'date_column': 'win_date', 'key': ['win_date', 'id'], 'is_timestamp': False},
+    'payments': {'table': 'payments', 'columns': ['id', 'telegram_id', 'num_tickets', 'amount', 'ticket_date', 'confirmed_at'], 'date_column': 'confirmed_at', 'key': ['id'], 'is_timestamp': True},
+    'referral_bonuses': {'table': 'referral_bonuses', 'columns': ['id', 'referrer_telegram_id', 'referred_telegram_id', 'num_tickets', 'amount', 'created_at'], 'date_column': 'created_at', 'key': ['id'], 'is_timestamp': True},
+}
+export_state = {'running': False}
+
+def export_date_bound(spec: dict, day: datetime.date) -> str:
+    # timestamptz columns ke liye din bot ke timezone (TIMEZONE_STR) ki midnight se shuru hota hai, UTC midnight se nahi.
+    if spec['is_timestamp']:
+        return round_timezone().localize(datetime.datetime.combine(day, datetime.time.min)).isoformat()
+    return day.isoformat()
+
+def build_keyset_filter(key_columns: list[str], last_row: dict) -> str:
+    """PostgREST or=() filter selecting rows strictly after last_row in key order (key must be unique)."""
+    branches = []
+    for index, column in enumerate(key_columns):
+        # (a, b, c) > (x, y, z)  ==  a > x  OR  (a = x AND b > y)  OR  (a = x AND b = y AND c > z)
+        conditions = [f"{earlier}.eq.{last_row[earlier]}" for earlier in key_columns[:index]] + [f"{column}.gt.{last_row[column]}"]
+        branches.append(conditions[0] if len(conditions) == 1 else f"and({','.join(conditions)})")
+    return ','.join(branches)
+
+async def iter_export_pages(export_name: str, start_date: datetime.date, end_date: datetime.date):
+    """Yield pages (lists of dicts) of export_name rows dated start_date..end_date inclusive, in the bot's timezone."""
+    spec = EXPORT_TABLES[export_name]
+    date_column = spec['date_column']
+    start_bound = export_date_bound(spec, start_date)
+    end_bound = export_date_bound(spec, end_date + datetime.timedelta(days=1))
+
+    if export_name == 'tickets':
+        # Archive mein per date ek row hoti hai; use wapas (date, telegram_id, count) rows mein kholte hain.
+        last_archived_date = None
+        while True:
+            def build_archive_query(after=last_archived_date):
+                query = supabase.from_('daily_tickets_archive').select('date, telegram_ids, counts').gte('date', start_bound).lt('date', end_bound)
+                if after:
+                    query = query.gt('date', after)
+                return query.order('date').limit(EXPORT_ARCHIVE_DAYS_PER_PAGE)
+            response = await run_db_query('export_tickets_archive', build_archive_query)
+            if not response.data:
+                break
+            for archived_day in response.data:
+                yield [{'date': archived_day['date'], 'telegram_id': telegram_id, 'count': count}
+                       for telegram_id, count in zip(archived_day.get('telegram_ids') or [], archived_day.get('counts') or [])]
+            last_archived_date = response.data[-1]['date']
+
+    last_row = None
+    while True:
+        def build_query(after=last_row):
+            query = supabase.from_(spec['table']).select(', '.join(spec['columns'])).gte(date_column, start_bound).lt(date_column, end_bound)
+            if after:
+                query = query.or_(build_keyset_filter(spec['key'], after))
+            for key_column in spec['key']:
+                query = query.order(key_column)
+            return query.limit(EXPORT_PAGE_SIZE)
+        response = await run_db_query(f"export_{export_name}", build_query)
+        if not response.data:
+            break
+        yield response.data
+        if len(response.data) < EXPORT_PAGE_SIZE:
+            break
+        last_row = response.data[-1]
+
+def write_export_page(output_file, export_format: str, columns: list[str], rows: list[dict]) -> None:
+    if export_format == 'jsonl':
+        for row in rows:
+            output_file.write(json.dumps({column: row.get(column) for column in columns}, default=str) + "\n")
+    else:
+        writer = csv.DictWriter(output_file, fieldnames=columns, extrasaction='ignore')
+        writer.writerows(rows)
+
+async def export_to_file(export_name: str, start_date: datetime.date, end_date: datetime.date, export_format: str = 'csv', output_path: str | None = None) -> tuple[str, int]:
+    """Stream export_name rows into a gzip CSV/JSONL file. Returns (path, row_count)."""
+    if export_name not in EXPORT_TABLES:
+        raise ValueError(f"Unknown export table '{export_name}'. Choose from: {', '.join(EXPORT_TABLES)}")
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}'. Choose from: {', '.join(EXPORT_FORMATS)}")
+
+    columns = EXPORT_TABLES[export_name]['columns']
+    if output_path is None:
+        file_descriptor, output_path = tempfile.mkstemp(prefix=f"trustwin_{export_name}_{start_date.isoformat()}_{end_date.isoformat()}_", suffix=f".{export_format}.gz")
+        os.close(file_descriptor)
+
+    row_count = 0
+    logger.info(f"EXPORT: Exporting {export_name} from {start_date.isoformat()} to {end_date.isoformat()} as {export_format} into {output_path}")
+    with gzip.open(output_path, 'wt', encoding='utf-8', newline='') as output_file:
+        if export_format == 'csv':
+            csv.DictWriter(output_file, fieldnames=columns).writeheader()
+        async for page in iter_export_pages(export_name, start_date, end_date):
+            # gzip compression CPU-bound hai, isliye page thread mein likha jaata hai.
+            await asyncio.to_thread(write_export_page, output_file, export_format, columns, page)
+            row_count += len(page)
+    logger.info(f"EXPORT: Wrote {row_count} {export_name} rows to {output_path}")
+    return output_path, row_count
+
+async def run_export_and_send(bot, chat_id: int, export_name: str, start_date: datetime.date, end_date: datetime.date, export_format: str) -> None:
+    # export_state['running'] export_command set karta hai (task banne se pehle); yahan sirf khatam hone par reset.
+    output_path = None
+    try:
+        output_path, row_count = await export_to_file(export_name, start_date, end_date, export_format)
+        file_size = os.path.getsize(output_path)
+        if file_size > EXPORT_TELEGRAM_DOCUMENT_LIMIT_BYTES:
+            await bot.send_message(chat_id=chat_id, text=(
+                f"⚠️ Export of {row_count} {export_name} rows is {file_size / 1024 / 1024:.1f} MiB, above Telegram's upload limit.\n"
+                f"Please use a shorter date range or run export.py on the server."))
+            return
+        with open(output_path, 'rb') as document:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=document,
+                filename=os.path.basename(output_path),
+                caption=f"{export_name}: {row_count} rows, {start_date.isoformat()} → {end_date.isoformat()}",
+                read_timeout=120,
+                write_timeout=120
+            )
+        logger.info(f"EXPORT: Sent {export_name} export ({row_count} rows, {file_size} bytes) to {chat_id}.")
+    except Exception as e:
+        logger.error(f"EXPORT: Export of {export_name} {start_date} - {end_date} failed: {e}")
+        try:
+            await bot.send_message(chat_id=chat_id, text=f"❌ Export of {export_name} failed: {e}")
+        except Exception as e_notify:
+            logger.error(f"EXPORT: Also failed to notify {chat_id} about export failure: {e_notify}")
+    finally:
+        export_state['running'] = False
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
+
+@admin_only
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("HANDLER_ADMIN: export_command invoked.")
+    if not update.message: return
+
+    usage = f"Usage: `/export <{'|'.join(EXPORT_TABLES)}> <from YYYY-MM-DD> <to YYYY-MM-DD> [csv|jsonl]`"
+    try:
+        if len(context.args) not in (3, 4) or context.args[0] not in EXPORT_TABLES:
+            raise ValueError("Bad arguments")
+        export_name = context.args[0]
+        start_date = datetime.date.fromisoformat(context.args[1])
+        end_date = datetime.date.fromisoformat(context.args[2])
+        export_format = context.args[3] if len(context.args) == 4 else 'csv'
+        if start_date > end_date or export_format not in EXPORT_FORMATS:
+            raise ValueError("Bad arguments")
+    except ValueError:
+        await update.message.reply_text(usage, parse_mode=ParseMode.MARKDOWN)
+        return
+
+    if export_state['running']:
+        await update.message.reply_text("An export is already running. Please wait for it to finish.")
+        return
+    # Check aur flag ke beech koi await nahi, warna jaldi-jaldi bheje do /export dono shuru ho jaate.
+    export_state['running'] = True
+    context.application.create_task(run_export_and_send(context.bot, update.message.chat_id, export_name, start_date, end_date, export_format))
+    await update.message.reply_text(f"📦 Exporting {export_name} from {start_date.isoformat()} to {end_date.isoformat()}. The file will be sent when ready.")
+
+# --- Admin Diagnostics: /profile and /memstats ---
+# /profile ek sampling profiler hai: background thread har PROFILE_SAMPLE_INTERVAL_SECONDS par event loop
+# thread ka stack padhta hai (loop ke andar koi hook nahi, isliye overhead kam hai). Saath mein asyncio
+# debug mode se slow callbacks pakde jaate hain. /memstats tracemalloc snapshots ka diff deta hai.
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+PROFILE_SLOW_CALLBACK_SECONDS = 0.1
+PROFILE_TOP_N = 15
+MEMSTATS_TOP_N = 15
+TELEGRAM_MESSAGE_LIMIT = 4000
+profile_state = {'running': False}
+memstats_state = {'snapshot': None}
+
+class SlowCallbackCollector(logging.Handler):
+    """Collects asyncio debug-mode "Executing ... took N seconds" warnings while profiling."""
+
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.messages = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        if message.startswith("Executing"):
+            self.messages.append(message)
+
+def sample_thread_stacks(target_thread_id: int, stop_event: threading.Event, cumulative: Counter, own: Counter) -> int:
+    """Sample target thread stacks until stop_event is set. Returns the number of samples taken."""
+    samples = 0
+    while not stop_event.wait(PROFILE_SAMPLE_INTERVAL_SECONDS):
+        frame = sys._current_frames().get(target_thread_id)
+        if frame is None:
+            continue
+        samples += 1
+        seen_in_sample = set()
+        is_top_frame = True
+        while frame is not None:
+            code = frame.f_code
+            function_key = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+            if is_top_frame:
+                own[function_key] += 1
+                is_top_frame = False
+            # Recursion mein ek function ek sample mein sirf ek baar gina jaata hai.
+            if function_key not in seen_in_sample:
+                cumulative[function_key] += 1
+                seen_in_sample.add(function_key)
+            frame = frame.f_back
+    return samples
+
+def take_filtered_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+def truncate_for_telegram(text: str) -> str:
+    if len(text) <= TELEGRAM_MESSAGE_LIMIT:
+        return text
+    return text[:TELEGRAM_MESSAGE_LIMIT - 20] + "\n... (truncated)"
+
+async def run_profile_window(bot, chat_id: int, seconds: int) -> None:
+    loop = asyncio.get_running_loop()
+    loop_thread_id = threading.get_ident()
+    cumulative, own = Counter(), Counter()
+    stop_event = threading.Event()
+    samples_holder = []
+    sampler = threading.Thread(
+        target=lambda: samples_holder.append(sample_thread_stacks(loop_thread_id, stop_event, cumulative, own)),
+        name="profile-sampler",
+        daemon=True
+    )
+
+    slow_callbacks = SlowCallbackCollector()
+    asyncio_logger = logging.getLogger("asyncio")
+    previous_debug = loop.get_debug()
+    previous_slow_duration = loop.slow_callback_duration
+
+    profile_state['running'] = True
+    try:
+        asyncio_logger.addHandler(slow_callbacks)
+        loop.set_debug(True)
+        loop.slow_callback_duration = PROFILE_SLOW_CALLBACK_SECONDS
+        sampler.start()
+        await asyncio.sleep(seconds)
+    finally:
+        stop_event.set()
+        await asyncio.to_thread(sampler.join)
+        loop.set_debug(previous_debug)
+        loop.slow_callback_duration = previous_slow_duration
+        asyncio_logger.removeHandler(slow_callbacks)
+        profile_state['running'] = False
+
+    samples = samples_holder[0] if samples_holder else 0
+    lines = [f"Profile: {seconds}s, {samples} samples of the event loop thread"]
+    if samples:
+        lines.append(f"\nTop {PROFILE_TOP_N} cumulative (% of samples, self %):")
+        for function_key, count in cumulative.most_common(PROFILE_TOP_N):
+            lines.append(f"{count * 100 / samples:5.1f}% {own[function_key] * 100 / samples:5.1f}%  {function_key}")
+    lines.append(f"\nSlow callbacks (> {PROFILE_SLOW_CALLBACK_SECONDS}s): {len(slow_callbacks.messages)}")
+    for message in slow_callbacks.messages[:10]:
+        lines.append(f"- {message[:300]}")
+
+    await bot.send_message(chat_id=chat_id, text=truncate_for_telegram("\n".join(lines)))
+    logger.info(f"PROFILE: {seconds}s profile finished with {samples} samples and {len(slow_callbacks.messages)} slow callbacks.")
+
+@admin_only
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("HANDLER_ADMIN: profile_command invoked.")
+    if not update.message: return
+
+    try:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Usage: `/profile <seconds>`", parse_mode=ParseMode.MARKDOWN)
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if profile_state['running']:
+        await update.message.reply_text("A profile is already running. Please wait for it to finish.")
+        return
+
+    await update.message.reply_text(f"⏱️ Profiling the bot for {seconds}s. Results will be sent when done.")
+    # Handler ko yahin block nahi karna (updates sequential hain), profile background task mein chalta hai.
+    context.application.create_task(run_profile_window(context.bot, update.message.chat_id, seconds))
+
+@admin_only
+async def memstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("HANDLER_ADMIN: memstats_command invoked.")
+    if not update.message: return
+
+    if context.args and context.args[0] == "stop":
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        memstats_state['snapshot'] = None
+        await update.message.reply_text("tracemalloc stopped.")
+        return
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        memstats_state['snapshot'] = take_filtered_snapshot()
+        await update.message.reply_text("tracemalloc started. Run /memstats again to see allocations since now, or `/memstats stop` to turn it off.", parse_mode=ParseMode.MARKDOWN)
+        logger.info("MEMSTATS: tracemalloc started.")
+        return
+
+    snapshot = await asyncio.to_thread(take_filtered_snapshot)
+    previous_snapshot = memstats_state['snapshot']
+    top_stats = snapshot.compare_to(previous_snapshot, 'lineno')[:MEMSTATS_TOP_N]
+    memstats_state['snapshot'] = snapshot
+
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    lines = [f"Traced memory: current {current_bytes / 1024 / 1024:.1f} MiB, peak {peak_bytes / 1024 / 1024:.1f} MiB",
+             f"\nTop {MEMSTATS_TOP_N} allocation changes since last /memstats:"]
+    for stat in top_stats:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size_diff / 1024:+9.1f} KiB ({stat.count_diff:+d} blocks)  {os.path.basename(frame.filename)}:{frame.lineno}")
+
+    await update.message.reply_text(truncate_for_telegram("\n".join(lines)))
+    logger.info("MEMSTATS: Allocation diff sent to admin.")
+
+# --- Error Alert Aggregation ---
+# Har exception par admin ko alag message bhejne ki jagah errors ko fingerprint (type + location)
+# ke hisaab se window mein jama karke ek summary bheji jaati hai. Baar-baar burst aane par window
+# double hoti hai (ERROR_ALERT_MAX_WINDOW_SECONDS tak) aur shaant window ke baad reset ho jaati hai.
+# Admin ko summary na ja paaye to retry exponential backoff ke saath hota hai, aur
+# ERROR_ALERT_MAX_SEND_FAILURES ke baad (ya permanent BadRequest/Forbidden par turant) woh summary chhod di jaati hai.
+# Multi-worker mode mein summary sirf worker 0 bhejta hai; baaki workers apne errors shared_error_alerts queue se wahan bhejte hain.
+ERROR_ALERT_MAX_SEND_FAILURES = 5
+ERROR_ALERT_QUEUE_MAX_SIZE = 1000
+error_alert_buckets = {} # {fingerprint: {error_type, location, count, total_count, sample_error, sample_update, window, next_flush_at, last_seen, send_failures}}
+shared_error_alerts = None # multiprocessing.Queue of error records for worker 0; sirf worker processes mein set hota hai
+
+def error_fingerprint(error: BaseException | None) -> tuple[str, str, str]:
+    """Return (fingerprint, error_type, location) for an exception; location is the innermost frame."""
+    error_type = type(error).__name__ if error else "UnknownError"
+    location = "unknown location"
+    if error is not None and error.__traceback__ is not None:
+        frames = traceback.extract_tb(error.__traceback__)
+        if frames:
+            frame = frames[-1]
+            location = f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    return f"{error_type}@{location}", error_type, location
+
+def record_error_alert(error: BaseException | None, update_details_summary: str, now: float | None = None) -> str:
+    """Count an error against its fingerprint bucket (worker 0's, in multi-worker mode). Returns the fingerprint."""
+    fingerprint, error_type, location = error_fingerprint(error)
+    if shared_error_alerts is not None and worker_slot != 0:
+        try:
+            shared_error_alerts.put_nowait((fingerprint, error_type, location, str(error)[:1000], update_details_summary))
+        except queue.Full:
+            logger.error(f"ERROR_ALERT: Alert queue to worker 0 is full; {fingerprint} is only in this worker's log.")
+        return fingerprint
+    count_error_alert(fingerprint, error_type, location, str(error)[:1000], update_details_summary, now)
+    return fingerprint
+
+def count_error_alert(fingerprint: str, error_type: str, location: str, sample_error: str, update_details_summary: str, now: float | None = None) -> None:
+    now = time.monotonic() if now is None else now
+    bucket = error_alert_buckets.get(fingerprint)
+    if bucket is None:
+        # Pehli baar dikhne wala error agle flush mein turant jaata hai.
+        bucket = {
+            'error_type': error_type,
+            'location': location,
+            'count': 0,
+            'total_count': 0,
+            'sample_error': "",
+            'sample_update': "",
+            'window': ERROR_ALERT_WINDOW_SECONDS,
+            'next_flush_at': now,
+            'last_seen': now,
+            'send_failures': 0,
+        }
+        error_alert_buckets[fingerprint] = bucket
+    bucket['count'] += 1
+    bucket['total_count'] += 1
+    bucket['sample_error'] = sample_error
+    bucket['sample_update'] = update_details_summary
+    bucket['last_seen'] = now
+    logger.debug(f"ERROR_ALERT: Recorded {fingerprint} (pending in window: {bucket['count']}, total: {bucket['total_count']})")
+
+def collect_worker_error_alerts(now: float | None = None) -> None:
+    # Worker 0: baaki workers ke errors apne buckets mein jodo, taaki admin ko ek hi summary jaaye.
+    if shared_error_alerts is None:
+        return
+    while True:
+        try:
+            record = shared_error_alerts.get_nowait()
+        except queue.Empty:
+            return
+        count_error_alert(*record, now)
+
+def format_error_alert(bucket: dict, next_window: int) -> str:
+    def clean(text: str) -> str:
+        return text.replace('`', "'")
+    return (
+        f"🚨 **Bot Error Alert!** 🚨\n\n"
+        f"Error Type: `{bucket['error_type']}`\n"
+        f"Location: `{clean(bucket['location'])}`\n"
+        f"Occurrences: `{bucket['count']}` in this window (`{bucket['total_count']}` since first seen)\n"
+        f"Latest Error: `{clean(bucket['sample_error'])}`\n\n"
+        f"Latest Update: `{clean(bucket['sample_update'])}`\n\n"
+        f"Next summary for this error in at most {next_window}s. Please check the bot logs for full tracebacks."
+    )
+
+async def flush_error_alerts(bot, now: float | None = None) -> int:
+    """Send one summary per due fingerprint via `bot`. Returns the number of summaries sent."""
+    now = time.monotonic() if now is None else now
+    collect_worker_error_alerts(now)
+    sent = 0
+    for fingerprint, bucket in list(error_alert_buckets.items()):
+        if now < bucket['next_flush_at']:
+            continue
+
+        if bucket['count'] == 0:
+            # Poori window shaant rahi: backoff reset, aur lambe samay se idle bucket hata do.
+            bucket['window'] = ERROR_ALERT_WINDOW_SECONDS
+            if now - bucket['last_seen'] >= ERROR_ALERT_MAX_WINDOW_SECONDS:
+                del error_alert_buckets[fingerprint]
+            continue
+
+        # Jo error window ke andar dobara aaya (burst), uski agli window double.
+        next_window = bucket['window']
+        if bucket['count'] > 1:
+            next_window = min(bucket['window'] * 2, ERROR_ALERT_MAX_WINDOW_SECONDS)
+
+        if not ADMIN_ID:
+            logger.warning("ERROR_ALERT: ADMIN_ID not set. Cannot send error summary to admin.")
+            return sent
+        try:
+            await bot.send_message(chat_id=ADMIN_ID, text=format_error_alert(bucket, next_window), parse_mode=ParseMode.MARKDOWN)
+        except Exception as e_notify:
+            bucket['send_failures'] += 1
+            permanent = isinstance(e_notify, (BadRequest, Forbidden))
+            if not permanent and bucket['send_failures'] < ERROR_ALERT_MAX_SEND_FAILURES:
+                # Count rakh lo, backoff ke baad dobara koshish hogi.
+                retry_in = min(ERROR_ALERT_WINDOW_SECONDS * 2 ** (bucket['send_failures'] - 1), ERROR_ALERT_MAX_WINDOW_SECONDS)
+                bucket['next_flush_at'] = now + retry_in
+                logger.error(f"CRITICAL_ERROR_HANDLER: Failed to send error summary for {fingerprint} to admin {ADMIN_ID} (attempt {bucket['send_failures']}/{ERROR_ALERT_MAX_SEND_FAILURES}), retrying in {retry_in}s: {e_notify}")
+                continue
+            logger.error(f"CRITICAL_ERROR_HANDLER: Dropping error summary for {fingerprint} ({bucket['count']} occurrences) after {bucket['send_failures']} failed send(s) to admin {ADMIN_ID}: {e_notify}")
+        else:
+            sent += 1
+            logger.info(f"ERROR_ALERT: Summary for {fingerprint} ({bucket['count']} occurrences) sent to admin {ADMIN_ID}.")
+
+        bucket['send_failures'] = 0
+        bucket['window'] = next_window
+        bucket['count'] = 0
+        bucket['next_flush_at'] = now + bucket['window']
+    return sent
+
+async def flush_error_alerts_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await flush_error_alerts(context.bot)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(f"ERROR_HANDLER: Exception while handling an update: {context.error}", exc_info=context.error)
-    
+
+    update_details_summary = "Update data not available or too complex."
     try:
-        error_summary = str(context.error)[:1000] 
-        
-        update_details_summary = "Update data not available or too complex."
         if isinstance(update, Update) and update.effective_message:
             update_details_summary = f"Message ID: {update.effective_message.message_id}, Chat ID: {update.effective_message.chat_id}, Text: '{str(update.effective_message.text)[:200]}'"
         elif isinstance(update, Update) and update.callback_query:
@@ -905,29 +2933,125 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
              update_details_summary = str(update)[:1000]
         else:
              update_details_summary = str(type(update))[:1000]
+    except Exception as e_summary:
+        logger.warning(f"ERROR_HANDLER: Could not summarise update for alert: {e_summary}")
+
+    # Admin ko message flush_error_alerts_job bhejta hai (batched, per fingerprint).
+    record_error_alert(context.error, update_details_summary)
+
+# --- Update Recording (capacity testing with replay_updates.py) ---
+# RECORD_UPDATES_PATH set ho to har incoming update scrub karke gzip JSONL mein likha jaata hai.
+# User/chat ids HMAC se pseudonymize hote hain (same user -> same id, taaki referrals/confirm_payment
+# replay mein bhi jude rahein), naam/username hash, free text same length ke 'x'. Commands aur callback
+# data rakhe jaate hain kyunki handlers unhi par chalte hain. Disk write alag thread mein hota hai.
+UPDATE_RECORDER_HANDLER_GROUP = -100 # sabse pehle, baaki handlers ko rokta nahi
+UPDATE_RECORDER_FLUSH_SECONDS = 5
+RECORD_ID_PARENT_KEYS = {'from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat', 'via_bot',
+                         'new_chat_member', 'old_chat_member', 'new_chat_members', 'left_chat_member', 'sender_user'}
+RECORD_ID_KEYS = {'user_id', 'chat_id', 'sender_chat_id', 'migrate_to_chat_id', 'migrate_from_chat_id'}
+RECORD_NAME_KEYS = {'first_name', 'last_name', 'username', 'title'}
+RECORD_TEXT_KEYS = {'text', 'caption', 'query', 'bio', 'description'}
+RECORD_TOKEN_KEYS = {'file_id', 'file_unique_id', 'chat_instance', 'inline_message_id'}
+RECORD_URL_KEYS = {'url'} # text_link entities, link previews
+RECORD_DROPPED_KEYS = {'contact', 'location', 'venue', 'phone_number', 'email', 'shipping_address', 'order_info', 'photo_url', 'invite_link'}
+
+class UpdateRecorder:
+    def __init__(self, path: str, secret: str | None):
+        if not secret:
+            logger.warning("RECORD_UPDATES_SECRET is not set; using a random key, so ids will not match across recordings.")
+        self.path = path
+        self.secret = (secret or os.urandom(32).hex()).encode()
+        self.records = queue.SimpleQueue()
+        self.writer_thread = threading.Thread(target=self.write_records, name="update-recorder", daemon=True)
+        self.writer_thread.start()
+        self.records.put({'type': 'header', 'admin_id': self.pseudonymize_id(ADMIN_ID), 'started_at': time.time()})
+
+    def digest(self, value) -> bytes:
+        return hmac.new(self.secret, str(value).encode(), hashlib.sha256).digest()
+
+    def pseudonymize_id(self, value: int) -> int:
+        pseudonym = 10**9 + int.from_bytes(self.digest(abs(value))[:6], 'big') % 10**12
+        return -pseudonym if value < 0 else pseudonym
+
+    def scrub_text(self, text: str) -> str:
+        if not text.startswith('/'):
+            return 'x' * len(text)
+        words = text.split(' ')
+        return ' '.join([words[0]] + [str(self.pseudonymize_id(int(word))) if word.lstrip('-').isdigit() else 'x' * len(word) for word in words[1:]])
+
+    def scrub(self, value, key: str | None = None, parent_key: str | None = None):
+        if isinstance(value, dict):
+            return {k: self.scrub(v, k, key) for k, v in value.items() if k not in RECORD_DROPPED_KEYS}
+        if isinstance(value, list):
+            return [self.scrub(item, key, parent_key) for item in value]
+        if isinstance(value, bool) or value is None:
+            return value
+        if isinstance(value, int) and (key in RECORD_ID_KEYS or (key == 'id' and parent_key in RECORD_ID_PARENT_KEYS)):
+            return self.pseudonymize_id(value)
+        if isinstance(value, str):
+            if key == 'username':
+                return f"u{self.digest(value).hex()[:10]}"
+            if key in RECORD_NAME_KEYS:
+                return f"User {self.digest(value).hex()[:6]}"
+            if key in RECORD_TEXT_KEYS:
+                return self.scrub_text(value)
+            if key in RECORD_TOKEN_KEYS:
+                return self.digest(value).hex()[:len(value)]
+            if key in RECORD_URL_KEYS:
+                return f"https://example.invalid/{self.digest(value).hex()[:12]}"
+        return value
+
+    def record(self, update_data: dict) -> None:
+        try:
+            self.records.put({'type': 'update', 'ts': time.time(), 'update': self.scrub(update_data)})
+        except Exception as e:
+            logger.error(f"RECORDER: Could not record update {update_data.get('update_id')}: {e}")
 
-        error_message_to_admin = (
-            f"🚨 **Bot Error Alert!** 🚨\n\n"
-            f"Error Type: `{type(context.error).__name__}`\n"
-            f"Error: `{error_summary}`\n\n"
-            f"Update Type: `{type(update).__name__}`\n"
-            f"Update Details: `{update_details_summary}`\n\n"
-            f"Please check the bot logs for the full traceback."
-        )
-        if ADMIN_ID: 
-            await context.bot.send_message(chat_id=ADMIN_ID, text=error_message_to_admin, parse_mode=ParseMode.MARKDOWN)
-            logger.info(f"ERROR_HANDLER: Error notification sent to admin {ADMIN_ID}.")
-        else:
-            logger.warning("ERROR_HANDLER: ADMIN_ID not set. Cannot send error notification to admin.")
-
-    except Exception as e_notify:
-        logger.error(f"CRITICAL_ERROR_HANDLER: Failed to send error notification to admin {ADMIN_ID}. Original error: {context.error}. Notification attempt error: {e_notify}")
+    async def handle_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self.record(update.to_dict())
 
-def main() -> None:
-    logger.info("STAGE MAIN_0: main() function started.")
+    def write_records(self) -> None:
+        with gzip.open(self.path, 'at', encoding='utf-8') as output_file:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    record = self.records.get(timeout=UPDATE_RECORDER_FLUSH_SECONDS)
+                except queue.Empty:
+                    record = None
+                if record is not None and record.get('type') == 'stop':
+                    return
+                if record is not None:
+                    output_file.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+                if time.monotonic() - last_flush >= UPDATE_RECORDER_FLUSH_SECONDS:
+                    output_file.flush()
+                    last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.records.put({'type': 'stop'})
+        self.writer_thread.join(timeout=10)
+
+def build_application(request=None, get_updates_request=None, update_recorder: UpdateRecorder | None = None,
+                      worker_index: int = 0, worker_count: int = 1, send_budget=None) -> Application:
+    """Build the Application with all handlers and jobs.
+
+    request/get_updates_request replace the HTTP layer (replay_updates.py). With worker_count > 1 the
+    Application has no updater (updates come from the ingress process), takes its Telegram sends from
+    send_budget, the bucket shared by all workers, and only worker 0 runs the global jobs.
+    """
     logger.info("Attempting to start TrustWin Bot...")
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        builder = Application.builder().token(BOT_TOKEN).rate_limiter(PriorityLaneRateLimiter(OUTBOUND_MESSAGES_PER_SECOND, OUTBOUND_CONNECTION_POOL_SIZE, shared_budget=send_budget))
+        if worker_count > 1:
+            builder = builder.updater(None)
+        if request is not None:
+            builder = builder.request(request).get_updates_request(get_updates_request)
+        else:
+            builder = builder.connection_pool_size(OUTBOUND_CONNECTION_POOL_SIZE)
+        if update_recorder is not None:
+            async def close_update_recorder(application: Application) -> None:
+                await asyncio.to_thread(update_recorder.close)
+            builder = builder.post_shutdown(close_update_recorder)
+        application = builder.build()
         logger.info("STAGE MAIN_1: Telegram Application built successfully.")
     except Exception as e:
         logger.critical(f"FATAL: Failed to build Telegram Application: {e}. Bot cannot start. Exiting.")
@@ -948,25 +3072,255 @@ def main() -> None:
         logger.info(f"STAGE MAIN_3.1: Scheduler timezone defaulted to UTC.")
 
     logger.debug("STAGE MAIN_4: Adding command and callback handlers.")
+    if update_recorder is not None:
+        application.add_handler(TypeHandler(Update, update_recorder.handle_update), group=UPDATE_RECORDER_HANDLER_GROUP)
+        logger.info(f"Recording incoming updates to {update_recorder.path}.")
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("buy", buy_command))
     application.add_handler(CommandHandler("winners", winners_command))
+    application.add_handler(CommandHandler("rounds", rounds_command))
+    application.add_handler(CommandHandler("mytickets", mytickets_command))
+    application.add_handler(CommandHandler("refer", refer_command))
+    application.add_handler(CommandHandler("top_referrers", top_referrers_command))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("users", users_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
     application.add_handler(CommandHandler("confirm_payment", confirm_payment_command))
     application.add_handler(CommandHandler("trigger_draw", manual_winner_draw_command))
+    application.add_handler(CommandHandler("flash_round", flash_round_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("memstats", memstats_command))
+    application.add_handler(CommandHandler("export", export_command))
     application.add_handler(CallbackQueryHandler(paid_button_callback, pattern='^paid_'))
     application.add_error_handler(error_handler)
     logger.info("STAGE MAIN_4.1: All handlers added.")
 
+    if worker_index != 0:
+        logger.info(f"STAGE MAIN_5.1: Worker {worker_index} leaves global jobs (and error alert summaries) to worker 0.")
+        return application
+
+    job_queue.run_repeating(flush_error_alerts_job, interval=10, first=10, name="error_alert_flush")
+    logger.info("Scheduled error alert flush every 10s.")
+
     logger.debug("STAGE MAIN_5: Scheduling daily jobs.")
     job_queue.run_daily(perform_winner_draw, time=datetime.time(hour=0, minute=1, second=0, tzinfo=timezone), name="daily_winner_draw")
     logger.info(f"Scheduled daily winner draw at 00:01 ({timezone}) for previous day's tickets.")
     
     job_queue.run_daily(send_daily_marketing_message_job, time=datetime.time(hour=9, minute=0, second=0, tzinfo=timezone), name="daily_marketing_message")
     logger.info(f"Scheduled daily marketing message at 09:00 ({timezone}).")
+    job_queue.run_daily(archive_daily_tickets_job, time=datetime.time(hour=0, minute=30, second=0, tzinfo=timezone), name="daily_tickets_archive")
+    logger.info(f"Scheduled daily tickets archival at 00:30 ({timezone}).")
+    job_queue.run_daily(reconcile_daily_stats_job, time=datetime.time(hour=0, minute=45, second=0, tzinfo=timezone), name="daily_stats_reconcile")
+    job_queue.run_once(reconcile_daily_stats_job, when=30, name="daily_stats_reconcile_startup")
+    logger.info(f"Scheduled daily stats reconciliation at 00:45 ({timezone}) and 30s after startup.")
+
+    if HOURLY_ROUNDS_ENABLED:
+        next_hour = (datetime.datetime.now(timezone) + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        job_queue.run_repeating(open_hourly_round_job, interval=3600, first=next_hour, name="hourly_round_open")
+        logger.info(f"Scheduled hourly rounds from {next_hour.isoformat()}.")
+    job_queue.run_once(recover_open_rounds_job, when=0, name="open_rounds_recovery")
+
+    job_queue.run_repeating(dispatch_outbox_job, interval=OUTBOX_DISPATCH_INTERVAL_SECONDS, first=OUTBOX_DISPATCH_INTERVAL_SECONDS, name="notification_outbox_dispatch")
+    logger.info(f"Scheduled notification outbox dispatch every {OUTBOX_DISPATCH_INTERVAL_SECONDS}s.")
     logger.info("STAGE MAIN_5.1: Daily jobs scheduled.")
+    return application
+
+# --- Multi-Process Run Mode (BOT_WORKERS > 1) ---
+# Ek halka ingress process getUpdates long-poll karta hai (raw JSON, PTB parsing nahi) aur har update ko
+# user id ke consistent hash se N worker processes mein se ek ko bhejta hai. Har worker apni Application
+# (updater ke bina) chalata hai, isliye ek user ke updates hamesha usi worker par, usi order mein jaate hain
+# aur per-user in-memory state (pending_payments, callback dedupe, /mytickets cache) sahi rehta hai.
+# Admin ke updates aur global jobs worker 0 par; /confirm_payment <id> us user ke worker ko jaata hai,
+# kyunki pending claim wahin hai.
+WORKER_RING_REPLICAS = 160 # virtual nodes per worker
+WORKER_QUEUE_MAX_SIZE = 1000 # per worker
+INGRESS_SHARD_BACKLOG_MAX = 10000 # worker queue bhari ho to us shard ke updates ingress mein yahan tak rukte hain, phir drop
+INGRESS_BACKLOG_RETRY_SECONDS = 0.05
+INGRESS_POLL_TIMEOUT_SECONDS = 30
+WORKER_SHUTDOWN_TIMEOUT_SECONDS = 30
+UPDATE_ROUTING_KEYS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                       'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+                       'chat_join_request', 'message_reaction', 'channel_post', 'edited_channel_post')
+
+def hash_point(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big')
+
+def build_worker_ring(worker_count: int) -> tuple[list[int], list[int]]:
+    """Consistent-hash ring as (sorted points, worker index per point)."""
+    ring = sorted((hash_point(f"worker-{worker_index}-{replica}"), worker_index)
+                  for worker_index in range(worker_count) for replica in range(WORKER_RING_REPLICAS))
+    return [point for point, _ in ring], [worker_index for _, worker_index in ring]
+
+def worker_for_user(ring: tuple[list[int], list[int]], user_id: int) -> int:
+    if user_id == ADMIN_ID:
+        return 0
+    points, workers = ring
+    return workers[bisect.bisect(points, hash_point(str(user_id))) % len(points)]
+
+def route_update(ring: tuple[list[int], list[int]], update_data: dict) -> int:
+    for key in UPDATE_ROUTING_KEYS:
+        payload = update_data.get(key)
+        if not payload:
+            continue
+        user = payload.get('from') or payload.get('user') or payload.get('chat')
+        if not user:
+            break
+        user_id = user['id']
+        if user_id == ADMIN_ID:
+            command_parts = (payload.get('text') or '').split()
+            if len(command_parts) > 1 and command_parts[0].split('@')[0] == '/confirm_payment' and command_parts[1].isdigit():
+                return worker_for_user(ring, int(command_parts[1]))
+        return worker_for_user(ring, user_id)
+    return 0
+
+def read_worker_queue(worker_queue, loop: asyncio.AbstractEventLoop, incoming: asyncio.Queue) -> None:
+    # Apna thread: blocking get() default executor ka thread hamesha ke liye nahi gherta.
+    while True:
+        update_data = worker_queue.get()
+        loop.call_soon_threadsafe(incoming.put_nowait, update_data)
+        if update_data is None:
+            return
+
+async def serve_worker_updates(application: Application, worker_queue) -> None:
+    async with application:
+        await application.start()
+        incoming = asyncio.Queue()
+        threading.Thread(target=read_worker_queue, args=(worker_queue, asyncio.get_running_loop(), incoming), name="worker-queue-reader", daemon=True).start()
+        while (update_data := await incoming.get()) is not None:
+            try:
+                await application.update_queue.put(Update.de_json(update_data, application.bot))
+            except Exception as e:
+                logger.error(f"WORKER: Could not parse update {update_data.get('update_id')}: {e}")
+        await application.stop() # update_queue mein pehle se pade updates stop se pehle process hote hain
+
+def run_worker(worker_index: int, worker_count: int, worker_queue, ticket_view_epoch_value, send_budget, pending_payment_counts, error_alerts) -> None:
+    global shared_ticket_view_epoch, shared_pending_payment_counts, shared_error_alerts, worker_slot
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # shutdown ingress ke sentinel se hota hai
+    shared_ticket_view_epoch = ticket_view_epoch_value
+    shared_pending_payment_counts = pending_payment_counts
+    shared_error_alerts = error_alerts
+    worker_slot = worker_index
+    logger.info(f"WORKER {worker_index}/{worker_count}: starting (pid {os.getpid()}).")
+    application = build_application(worker_index=worker_index, worker_count=worker_count, send_budget=send_budget)
+    asyncio.run(serve_worker_updates(application, worker_queue))
+    logger.info(f"WORKER {worker_index}/{worker_count}: stopped.")
+
+async def forward_shard_backlog(worker_index: int, worker_queue, backlog: deque, backlog_ready: asyncio.Event) -> None:
+    """Move one shard's buffered updates into its worker queue, in order, as the worker frees space."""
+    while True:
+        if not backlog:
+            backlog_ready.clear()
+            await backlog_ready.wait()
+            continue
+        try:
+            worker_queue.put_nowait(backlog[0])
+        except queue.Full:
+            await asyncio.sleep(INGRESS_BACKLOG_RETRY_SECONDS)
+            continue
+        backlog.popleft()
+        if not backlog:
+            logger.info(f"INGRESS: Worker {worker_index} caught up; its backlog is empty.")
+
+async def run_ingress(worker_queues: list, workers: list, update_recorder: UpdateRecorder | None) -> None:
+    ring = build_worker_ring(len(worker_queues))
+    api_url = f"https://api.telegram.org/bot{BOT_TOKEN}/"
+    offset = None
+    # Dheema shard sirf apne users ko rokta hai: uske updates yahan buffer hote hain, baaki shards aur polling chalti rehti hai.
+    backlogs = [deque() for _ in worker_queues]
+    backlog_events = [asyncio.Event() for _ in worker_queues]
+    dropped_updates = [0] * len(worker_queues)
+    forwarders = [asyncio.create_task(forward_shard_backlog(worker_index, worker_queue, backlogs[worker_index], backlog_events[worker_index]))
+                  for worker_index, worker_queue in enumerate(worker_queues)]
+    try:
+        async with httpx.AsyncClient(timeout=INGRESS_POLL_TIMEOUT_SECONDS + 10) as client:
+            await client.post(api_url + 'deleteWebhook')
+            logger.info(f"INGRESS: Polling for updates and routing them to {len(worker_queues)} workers.")
+            while True:
+                dead_workers = [worker.name for worker in workers if not worker.is_alive()]
+                if dead_workers:
+                    # Us shard ke users ke updates kahin nahi ja sakte; poora bot band karo taaki platform restart kare.
+                    raise RuntimeError(f"Worker process(es) exited: {', '.join(dead_workers)}")
+                request_body = {'timeout': INGRESS_POLL_TIMEOUT_SECONDS, 'allowed_updates': Update.ALL_TYPES}
+                if offset is not None:
+                    request_body['offset'] = offset
+                try:
+                    response = (await client.post(api_url + 'getUpdates', json=request_body)).json()
+                except (httpx.HTTPError, ValueError) as e:
+                    logger.warning(f"INGRESS: getUpdates failed: {e}. Retrying in 1s.")
+                    await asyncio.sleep(1)
+                    continue
+                if not response.get('ok'):
+                    retry_after = (response.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning(f"INGRESS: getUpdates returned an error: {response.get('description')}. Retrying in {retry_after}s.")
+                    await asyncio.sleep(retry_after)
+                    continue
+                for update_data in response['result']:
+                    worker_index = route_update(ring, update_data)
+                    backlog = backlogs[worker_index]
+                    queued = False
+                    if not backlog: # backlog ho to order bachane ke liye naya update bhi usi ke peeche
+                        try:
+                            worker_queues[worker_index].put_nowait(update_data)
+                            queued = True
+                        except queue.Full:
+                            logger.warning(f"INGRESS: Worker {worker_index} queue is full; buffering its updates.")
+                    if not queued:
+                        if len(backlog) < INGRESS_SHARD_BACKLOG_MAX:
+                            backlog.append(update_data)
+                            backlog_events[worker_index].set()
+                        else:
+                            dropped_updates[worker_index] += 1
+                            if dropped_updates[worker_index] % 1000 == 1:
+                                logger.error(f"INGRESS: Worker {worker_index} backlog is full ({INGRESS_SHARD_BACKLOG_MAX}); dropped update {update_data.get('update_id')} ({dropped_updates[worker_index]} dropped so far).")
+                    if update_recorder is not None:
+                        update_recorder.record(update_data)
+                    offset = update_data['update_id'] + 1
+    finally:
+        for forwarder in forwarders:
+            forwarder.cancel()
+
+def run_sharded(worker_count: int, update_recorder: UpdateRecorder | None) -> None:
+    mp_context = multiprocessing.get_context('spawn')
+    ticket_view_epoch_value = mp_context.Value('q', 0)
+    send_budget = mp_context.Array('d', [OUTBOUND_MESSAGES_PER_SECOND, time.monotonic(), 0.0]) # [tokens, last_refill, paused_until], sab workers ka ek bucket
+    pending_payment_counts = mp_context.Array('q', worker_count)
+    error_alerts = mp_context.Queue(maxsize=ERROR_ALERT_QUEUE_MAX_SIZE)
+    worker_queues = [mp_context.Queue(maxsize=WORKER_QUEUE_MAX_SIZE) for _ in range(worker_count)]
+    workers = [mp_context.Process(target=run_worker, args=(worker_index, worker_count, worker_queues[worker_index], ticket_view_epoch_value, send_budget, pending_payment_counts, error_alerts), name=f"bot-worker-{worker_index}")
+               for worker_index in range(worker_count)]
+    for worker in workers:
+        worker.start()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(run_ingress(worker_queues, workers, update_recorder))
+    except KeyboardInterrupt:
+        logger.info("INGRESS: Shutting down, draining workers.")
+    except Exception as e:
+        logger.critical(f"INGRESS: Failed critically: {e}. Stopping workers.")
+    finally:
+        for worker_queue in worker_queues:
+            try:
+                worker_queue.put(None, timeout=WORKER_SHUTDOWN_TIMEOUT_SECONDS)
+            except queue.Full:
+                pass # worker atka hua hai; neeche terminate hoga
+        for worker in workers:
+            worker.join(timeout=WORKER_SHUTDOWN_TIMEOUT_SECONDS)
+            if worker.is_alive():
+                logger.warning(f"INGRESS: {worker.name} did not stop in time, terminating it.")
+                worker.terminate()
+        if update_recorder is not None:
+            update_recorder.close()
+
+def main() -> None:
+    logger.info("STAGE MAIN_0: main() function started.")
+    update_recorder = UpdateRecorder(RECORD_UPDATES_PATH, RECORD_UPDATES_SECRET) if RECORD_UPDATES_PATH else None
+    if BOT_WORKERS > 1:
+        logger.info(f"STAGE MAIN_FINAL: Starting ingress with {BOT_WORKERS} worker processes...")
+        run_sharded(BOT_WORKERS, update_recorder)
+        logger.info("Bot ingress has ended.")
+        return
+    application = build_application(update_recorder=update_recorder)
 
     logger.info("STAGE MAIN_FINAL: Bot is starting to poll for updates...")
     try:
@@ -0,0 +1,30 @@
+# export.py
+# Command-line entry point for the accounting exports served by /export.
+# Usage: python export.py <tickets|winners|payments|referral_bonuses> <from YYYY-MM-DD> <to YYYY-MM-DD> [--format csv|jsonl] [--output path]
+# Needs the same environment variables as the bot (bot.py validates them on import).
+
+import argparse
+import asyncio
+import datetime
+
+from bot import EXPORT_FORMATS, EXPORT_TABLES, export_to_file
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stream TrustWin data into a gzip CSV/JSONL file.")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    parser.add_argument("start_date", type=datetime.date.fromisoformat, help="First date (YYYY-MM-DD), inclusive")
+    parser.add_argument("end_date", type=datetime.date.fromisoformat, help="Last date (YYYY-MM-DD), inclusive")
+    parser.add_argument("--format", dest="export_format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--output", dest="output_path", default=None, help="Output file (default: a temp file)")
+    args = parser.parse_args()
+
+    if args.start_date > args.end_date:
+        parser.error("start_date must not be after end_date")
+
+    output_path, row_count = asyncio.run(export_to_file(args.table, args.start_date, args.end_date, args.export_format, args.output_path))
+    print(f"Exported {row_count} rows to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
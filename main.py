@@ -1,4 +1,4 @@
-from bot import application
+from bot import main
 
 if __name__ == '__main__':
-    application.run_polling()
+    main()
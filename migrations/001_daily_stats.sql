@@ -0,0 +1,82 @@
+-- 001_daily_stats.sql
+-- Per-day aggregates behind /stats. The bot updates one row per day
+-- incrementally (new users, confirmed tickets, revenue, prize pool, referral
+-- payouts) so /stats never has to scan users or daily_tickets.
+-- Run once in the Supabase SQL editor.
+
+create table if not exists public.daily_stats (
+    date date primary key,
+    new_users integer not null default 0,
+    tickets integer not null default 0,
+    revenue numeric not null default 0,
+    prize numeric not null default 0,
+    referral_payouts numeric not null default 0,
+    updated_at timestamptz not null default now()
+);
+
+-- Upsert-and-add, called by the bot on every signup and payment confirmation.
+create or replace function public.increment_daily_stats(
+    stat_date_input date,
+    new_users_delta integer default 0,
+    tickets_delta integer default 0,
+    revenue_delta numeric default 0,
+    prize_delta numeric default 0,
+    referral_payouts_delta numeric default 0
+) returns void
+language sql
+as $$
+    insert into public.daily_stats as s (date, new_users, tickets, revenue, prize, referral_payouts)
+    values (stat_date_input, new_users_delta, tickets_delta, revenue_delta, prize_delta, referral_payouts_delta)
+    on conflict (date) do update set
+        new_users = s.new_users + excluded.new_users,
+        tickets = s.tickets + excluded.tickets,
+        revenue = s.revenue + excluded.revenue,
+        prize = s.prize + excluded.prize,
+        referral_payouts = s.referral_payouts + excluded.referral_payouts,
+        updated_at = now();
+$$;
+
+-- Everything /stats shows in one round trip: today's and yesterday's rows plus
+-- the running user total (a sum over at most one row per day).
+create or replace function public.get_daily_stats_snapshot(today_input date)
+returns json
+language sql
+stable
+as $$
+    select json_build_object(
+        'total_users', coalesce((select sum(new_users) from public.daily_stats), 0),
+        'today_tickets', coalesce((select tickets from public.daily_stats where date = today_input), 0),
+        'today_prize', coalesce((select prize from public.daily_stats where date = today_input), 0),
+        'yesterday_prize', coalesce((select prize from public.daily_stats where date = today_input - 1), 0)
+    );
+$$;
+
+-- Backfill from the raw tables. Revenue and prize use the default
+-- TICKET_PRICE_USDT (4.0) and prize pool share (1 - 0.25 - 0.25 = 0.5);
+-- adjust the constants below if the bot runs with different values.
+insert into public.daily_stats (date, new_users)
+select join_date::date, count(*)
+from public.users
+group by join_date::date
+on conflict (date) do update set new_users = excluded.new_users;
+
+insert into public.daily_stats (date, tickets, revenue, prize)
+select date, sum(count), sum(count) * 4.0, sum(count) * 4.0 * 0.5
+from public.daily_tickets
+group by date
+on conflict (date) do update set
+    tickets = excluded.tickets,
+    revenue = excluded.revenue,
+    prize = excluded.prize;
+
+-- Referral payouts: REFERRAL_PERCENT (0.25) of every ticket bought by a referred user.
+update public.daily_stats s
+set referral_payouts = r.payouts
+from (
+    select t.date, sum(t.count) * 4.0 * 0.25 as payouts
+    from public.daily_tickets t
+    join public.users u on u.telegram_id = t.telegram_id
+    where u.referrer_telegram_id is not null
+    group by t.date
+) r
+where s.date = r.date;
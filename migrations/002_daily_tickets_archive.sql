@@ -0,0 +1,86 @@
+-- 002_daily_tickets_archive.sql
+-- Closed draw dates move out of daily_tickets. A date is closed once its winner
+-- is recorded in winners. Each archived date becomes one compact row in
+-- daily_tickets_archive (parallel telegram_id / count arrays) plus one
+-- daily_ticket_summaries row. daily_tickets then only holds today, yesterday and
+-- dates whose draw has not been recorded yet.
+-- The bot calls archive_daily_tickets(today - 1) every night after the draw.
+-- Run once in the Supabase SQL editor.
+
+create index if not exists daily_tickets_date_idx on public.daily_tickets (date);
+
+create table if not exists public.daily_tickets_archive (
+    date date primary key,
+    telegram_ids bigint[] not null,
+    counts integer[] not null
+);
+
+create table if not exists public.daily_ticket_summaries (
+    date date primary key,
+    total_tickets integer not null,
+    participants integer not null,
+    winner_telegram_id bigint,
+    prize numeric,
+    archived_at timestamptz not null default now()
+);
+
+-- Archives every closed date older than cutoff_date_input. Returns the number of dates archived.
+create or replace function public.archive_daily_tickets(cutoff_date_input date)
+returns integer
+language plpgsql
+as $$
+declare
+    archived_dates integer;
+begin
+    create temp table _closed_dates on commit drop as
+    select distinct t.date
+    from public.daily_tickets t
+    where t.date < cutoff_date_input
+      and exists (select 1 from public.winners w where w.win_date = t.date);
+
+    -- Re-archiving a date (late rows, or a retry) merges live rows into the archived set by
+    -- telegram_id and replaces the archive row, so a user is never listed twice for a date.
+    create temp table _archived_counts on commit drop as
+    select merged.date, merged.telegram_id, sum(merged.count)::integer as count
+    from (
+        select t.date, t.telegram_id, t.count
+        from public.daily_tickets t
+        join _closed_dates c on c.date = t.date
+        union all
+        select a.date, u.telegram_id, u.count
+        from public.daily_tickets_archive a
+        join _closed_dates c on c.date = a.date
+        cross join lateral unnest(a.telegram_ids, a.counts) as u(telegram_id, count)
+    ) merged
+    group by merged.date, merged.telegram_id;
+
+    insert into public.daily_tickets_archive (date, telegram_ids, counts)
+    select ac.date, array_agg(ac.telegram_id order by ac.telegram_id), array_agg(ac.count order by ac.telegram_id)
+    from _archived_counts ac
+    group by ac.date
+    on conflict (date) do update set
+        telegram_ids = excluded.telegram_ids,
+        counts = excluded.counts;
+
+    insert into public.daily_ticket_summaries (date, total_tickets, participants, winner_telegram_id, prize)
+    select ac.date, sum(ac.count), count(*),
+           (select w.telegram_id from public.winners w where w.win_date = ac.date limit 1),
+           (select w.amount from public.winners w where w.win_date = ac.date limit 1)
+    from _archived_counts ac
+    group by ac.date
+    on conflict (date) do update set
+        total_tickets = excluded.total_tickets,
+        participants = excluded.participants,
+        archived_at = now();
+
+    delete from public.daily_tickets t
+    using _closed_dates c
+    where t.date = c.date;
+
+    select count(*) into archived_dates from _closed_dates;
+    return archived_dates;
+end;
+$$;
+
+-- Initial archival of existing history.
+select public.archive_daily_tickets(current_date - 1);
@@ -0,0 +1,30 @@
+-- 003_payments_ledger.sql
+-- Ledger of confirmed payments and referral bonuses. Until now these only existed
+-- as daily_tickets increments and log lines. The bot appends one row per
+-- /confirm_payment (and one per referral bonus paid out). /export and export.py
+-- page through these tables by id.
+-- Run once in the Supabase SQL editor.
+
+create table if not exists public.payments (
+    id bigserial primary key,
+    telegram_id bigint not null,
+    num_tickets integer not null,
+    amount numeric not null,
+    ticket_date date not null,
+    confirmed_at timestamptz not null default now()
+);
+create index if not exists payments_confirmed_at_idx on public.payments (confirmed_at, id);
+
+create table if not exists public.referral_bonuses (
+    id bigserial primary key,
+    referrer_telegram_id bigint not null,
+    referred_telegram_id bigint not null,
+    num_tickets integer not null,
+    amount numeric not null,
+    created_at timestamptz not null default now()
+);
+create index if not exists referral_bonuses_created_at_idx on public.referral_bonuses (created_at, id);
+
+-- Keyset pagination for /export on the tables that have no surrogate id.
+create index if not exists daily_tickets_date_telegram_id_idx on public.daily_tickets (date, telegram_id);
+create index if not exists winners_win_date_telegram_id_idx on public.winners (win_date, telegram_id);
@@ -0,0 +1,44 @@
+-- 004_notification_outbox.sql
+-- Transactional outbox for user/admin notifications. Handlers insert a row here
+-- right after their DB change and return. The bot's dispatcher claims pending
+-- rows in batches, sends them and records the delivery status.
+-- Run once in the Supabase SQL editor.
+
+create table if not exists public.notification_outbox (
+    id bigserial primary key,
+    kind text not null, -- send_message | edit_message_text | broadcast
+    chat_id bigint,
+    payload jsonb not null,
+    status text not null default 'pending', -- pending | sending | sent | failed
+    attempts integer not null default 0,
+    last_error text,
+    created_at timestamptz not null default now(),
+    next_attempt_at timestamptz not null default now(),
+    sent_at timestamptz
+);
+create index if not exists notification_outbox_due_idx
+    on public.notification_outbox (next_attempt_at)
+    where status in ('pending', 'sending');
+
+-- Claims up to batch_size due rows for one dispatcher. A claimed row is leased
+-- for lease_seconds. If the dispatcher dies before settling it, the row becomes
+-- due again. SKIP LOCKED lets several dispatchers run side by side.
+create or replace function public.claim_outbox_batch(batch_size integer, lease_seconds integer)
+returns setof public.notification_outbox
+language sql
+as $$
+    update public.notification_outbox o
+    set status = 'sending',
+        attempts = o.attempts + 1,
+        next_attempt_at = now() + make_interval(secs => lease_seconds)
+    where o.id in (
+        select id
+        from public.notification_outbox
+        where status in ('pending', 'sending')
+          and next_attempt_at <= now()
+        order by id
+        limit batch_size
+        for update skip locked
+    )
+    returning o.*;
+$$;
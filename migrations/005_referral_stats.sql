@@ -0,0 +1,58 @@
+-- 005_referral_stats.sql
+-- Per-referrer counters behind /refer and /top_referrers. The bot adds to them
+-- on signup (referral_count) and on payment confirmation (referral_tickets,
+-- bonus_earned), so each lookup reads one row by primary key, or the
+-- bonus_earned index for the leaderboard.
+-- Run once in the Supabase SQL editor.
+
+create table if not exists public.referral_stats (
+    referrer_telegram_id bigint primary key,
+    referral_count integer not null default 0,
+    referral_tickets integer not null default 0,
+    bonus_earned numeric not null default 0,
+    updated_at timestamptz not null default now()
+);
+create index if not exists referral_stats_bonus_earned_idx on public.referral_stats (bonus_earned desc);
+
+create or replace function public.increment_referral_stats(
+    referrer_id_input bigint,
+    referrals_delta integer default 0,
+    tickets_delta integer default 0,
+    bonus_delta numeric default 0
+) returns void
+language sql
+as $$
+    insert into public.referral_stats as r (referrer_telegram_id, referral_count, referral_tickets, bonus_earned)
+    values (referrer_id_input, referrals_delta, tickets_delta, bonus_delta)
+    on conflict (referrer_telegram_id) do update set
+        referral_count = r.referral_count + excluded.referral_count,
+        referral_tickets = r.referral_tickets + excluded.referral_tickets,
+        bonus_earned = r.bonus_earned + excluded.bonus_earned,
+        updated_at = now();
+$$;
+
+-- Backfill. Ticket history includes archived days (002). Bonus uses the default
+-- TICKET_PRICE_USDT (4.0) and REFERRAL_PERCENT (0.25); adjust if yours differ.
+insert into public.referral_stats (referrer_telegram_id, referral_count)
+select referrer_telegram_id, count(*)
+from public.users
+where referrer_telegram_id is not null
+group by referrer_telegram_id
+on conflict (referrer_telegram_id) do update set referral_count = excluded.referral_count;
+
+with all_tickets as (
+    select telegram_id, count from public.daily_tickets
+    union all
+    select unnest(telegram_ids), unnest(counts) from public.daily_tickets_archive
+)
+update public.referral_stats r
+set referral_tickets = t.tickets,
+    bonus_earned = t.tickets * 4.0 * 0.25
+from (
+    select u.referrer_telegram_id, sum(a.count) as tickets
+    from all_tickets a
+    join public.users u on u.telegram_id = a.telegram_id
+    where u.referrer_telegram_id is not null
+    group by u.referrer_telegram_id
+) t
+where r.referrer_telegram_id = t.referrer_telegram_id;
@@ -0,0 +1,23 @@
+-- 006_user_ticket_history.sql
+-- One user's per-day ticket counts since from_date_input, from hot daily_tickets
+-- rows and archived days (002) alike. Used by /mytickets.
+-- Run once in the Supabase SQL editor.
+
+create index if not exists daily_tickets_telegram_id_date_idx on public.daily_tickets (telegram_id, date);
+create index if not exists daily_tickets_archive_telegram_ids_idx on public.daily_tickets_archive using gin (telegram_ids);
+create index if not exists winners_telegram_id_win_date_idx on public.winners (telegram_id, win_date desc);
+
+create or replace function public.get_user_ticket_history(user_id_input bigint, from_date_input date)
+returns table (date date, count integer)
+language sql
+stable
+as $$
+    select t.date, t.count
+    from public.daily_tickets t
+    where t.telegram_id = user_id_input and t.date >= from_date_input
+    union all
+    select a.date, a.counts[array_position(a.telegram_ids, user_id_input)]
+    from public.daily_tickets_archive a
+    where a.date >= from_date_input and a.telegram_ids @> array[user_id_input]
+    order by 1 desc;
+$$;
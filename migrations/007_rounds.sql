@@ -0,0 +1,146 @@
+-- 007_rounds.sql
+-- Intraday lottery rounds (hourly and flash) alongside the daily draw. The daily
+-- round keeps using daily_tickets keyed by date. Every other round has a rounds
+-- row with its own open/close window, ticket price and pool split, and its
+-- tickets live in round_tickets.
+-- Run once in the Supabase SQL editor.
+
+create table if not exists public.rounds (
+    round_id text primary key,
+    kind text not null, -- hourly | flash
+    opens_at timestamptz not null,
+    closes_at timestamptz not null,
+    ticket_price numeric not null,
+    prize_pool_percent numeric not null,
+    referral_percent numeric not null,
+    status text not null default 'open', -- open | drawing | drawn
+    winner_telegram_id bigint,
+    prize numeric,
+    drawn_at timestamptz
+);
+create index if not exists rounds_status_closes_at_idx on public.rounds (status, closes_at);
+
+create table if not exists public.round_tickets (
+    round_id text not null references public.rounds (round_id),
+    telegram_id bigint not null,
+    count integer not null default 0,
+    primary key (round_id, telegram_id)
+);
+
+create or replace function public.increment_round_ticket(round_id_input text, user_id_input bigint, num_tickets_to_add integer)
+returns void
+language sql
+as $$
+    insert into public.round_tickets as t (round_id, telegram_id, count)
+    values (round_id_input, user_id_input, num_tickets_to_add)
+    on conflict (round_id, telegram_id) do update set count = t.count + excluded.count;
+$$;
+
+-- Intraday winners are recorded in winners too, tagged with their round.
+alter table public.winners add column if not exists round_id text;
+
+-- Draw claims. draw_claim identifies one draw (a scheduled draw and its
+-- retries), and drawing_since starts its lease.
+alter table public.rounds add column if not exists drawing_since timestamptz;
+alter table public.rounds add column if not exists draw_claim text;
+drop function if exists public.claim_round_for_draw(text);
+
+-- Moves a round to 'drawing' for claim_id_input, so only one draw runs it
+-- even when several bot processes schedule it. Claiming again with the same
+-- id succeeds and renews the lease, so a call whose reply was lost can be
+-- retried. A 'drawing' round whose lease (lease_seconds_input) has run out
+-- can be claimed by another draw, because the process that held it died or
+-- gave up. A round with a recorded winner is never claimed. Returns no row
+-- when the claim is refused.
+create or replace function public.claim_round_for_draw(round_id_input text, claim_id_input text, lease_seconds_input integer)
+returns setof public.rounds
+language sql
+as $$
+    update public.rounds r
+    set status = 'drawing', draw_claim = claim_id_input, drawing_since = now()
+    where r.round_id = round_id_input
+      and (r.status = 'open'
+           or (r.status = 'drawing'
+               and (r.draw_claim = claim_id_input
+                    or r.drawing_since is null
+                    or r.drawing_since < now() - make_interval(secs => lease_seconds_input))))
+      and not exists (select 1 from public.winners w where w.round_id = round_id_input)
+    returning *;
+$$;
+
+-- Only the daily draw closes a date for archival (002), so ignore round winners.
+create or replace function public.archive_daily_tickets(cutoff_date_input date)
+returns integer
+language plpgsql
+as $$
+declare
+    archived_dates integer;
+begin
+    create temp table _closed_dates on commit drop as
+    select distinct t.date
+    from public.daily_tickets t
+    where t.date < cutoff_date_input
+      and exists (select 1 from public.winners w where w.win_date = t.date and w.round_id is null);
+
+    -- Re-archiving a date (late rows, or a retry) merges live rows into the archived set by
+    -- telegram_id and replaces the archive row, so a user is never listed twice for a date.
+    create temp table _archived_counts on commit drop as
+    select merged.date, merged.telegram_id, sum(merged.count)::integer as count
+    from (
+        select t.date, t.telegram_id, t.count
+        from public.daily_tickets t
+        join _closed_dates c on c.date = t.date
+        union all
+        select a.date, u.telegram_id, u.count
+        from public.daily_tickets_archive a
+        join _closed_dates c on c.date = a.date
+        cross join lateral unnest(a.telegram_ids, a.counts) as u(telegram_id, count)
+    ) merged
+    group by merged.date, merged.telegram_id;
+
+    insert into public.daily_tickets_archive (date, telegram_ids, counts)
+    select ac.date, array_agg(ac.telegram_id order by ac.telegram_id), array_agg(ac.count order by ac.telegram_id)
+    from _archived_counts ac
+    group by ac.date
+    on conflict (date) do update set
+        telegram_ids = excluded.telegram_ids,
+        counts = excluded.counts;
+
+    insert into public.daily_ticket_summaries (date, total_tickets, participants, winner_telegram_id, prize)
+    select ac.date, sum(ac.count), count(*),
+           (select w.telegram_id from public.winners w where w.win_date = ac.date and w.round_id is null limit 1),
+           (select w.amount from public.winners w where w.win_date = ac.date and w.round_id is null limit 1)
+    from _archived_counts ac
+    group by ac.date
+    on conflict (date) do update set
+        total_tickets = excluded.total_tickets,
+        participants = excluded.participants,
+        archived_at = now();
+
+    delete from public.daily_tickets t
+    using _closed_dates c
+    where t.date = c.date;
+
+    select count(*) into archived_dates from _closed_dates;
+    return archived_dates;
+end;
+$$;
+
+-- One user's intraday round tickets for rounds closing at or after
+-- from_input, newest first. /mytickets shows them next to the daily tickets
+-- from get_user_ticket_history (006).
+create index if not exists round_tickets_telegram_id_idx on public.round_tickets (telegram_id);
+
+create or replace function public.get_user_round_tickets(user_id_input bigint, from_input timestamptz)
+returns table (round_id text, kind text, opens_at timestamptz, closes_at timestamptz, ticket_price numeric,
+               prize_pool_percent numeric, referral_percent numeric, status text, drawing_since timestamptz, count integer)
+language sql
+stable
+as $$
+    select r.round_id, r.kind, r.opens_at, r.closes_at, r.ticket_price,
+           r.prize_pool_percent, r.referral_percent, r.status, r.drawing_since, t.count
+    from public.round_tickets t
+    join public.rounds r on r.round_id = t.round_id
+    where t.telegram_id = user_id_input and r.closes_at >= from_input
+    order by r.closes_at desc;
+$$;
@@ -0,0 +1,33 @@
+-- 008_marketing_media.sql
+-- Image/video campaigns for the daily marketing broadcast. A marketing row with
+-- media_type set is sent as media with content as its caption. The bot uploads
+-- media_url (an http(s) URL or a path on the bot's disk) once and stores the
+-- file_id Telegram returns in media_file_id. Every later recipient and campaign
+-- sends that file_id instead of the bytes.
+-- Run once in the Supabase SQL editor.
+
+alter table public.messages add column if not exists media_type text; -- photo | video | animation | document
+alter table public.messages add column if not exists media_url text;
+alter table public.messages add column if not exists media_file_id text;
+
+alter table public.messages drop constraint if exists messages_media_type_check;
+alter table public.messages add constraint messages_media_type_check
+    check (media_type is null or media_type in ('photo', 'video', 'animation', 'document'));
+
+-- Changing the asset must drop the cached file_id, or the old media keeps going out.
+create or replace function public.reset_message_media_file_id()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.media_url is distinct from old.media_url or new.media_type is distinct from old.media_type then
+        new.media_file_id := null;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists messages_reset_media_file_id on public.messages;
+create trigger messages_reset_media_file_id
+    before update of media_url, media_type on public.messages
+    for each row execute function public.reset_message_media_file_id();
@@ -0,0 +1,220 @@
+-- 009_atomic_writes.sql
+-- Signup and payment confirmation used to be a chain of REST calls, with the
+-- daily_stats and referral_stats increments sent as follow-up calls whose
+-- failures were only logged, so the rollups could drift from the source tables.
+-- register_user, confirm_ticket_payment and record_draw_result now apply each
+-- write together with its rollup increments and its notification_outbox rows
+-- (004) in one transaction, so a notification is queued exactly when the change
+-- it announces commits. reconcile_daily_stats recomputes
+-- daily_stats from users and payments. The bot runs it at startup and nightly,
+-- so total_users is right even where the 001 backfill never ran.
+-- Run once in the Supabase SQL editor.
+
+-- What a confirmation added to daily_stats, kept per payment so it can be recomputed.
+alter table public.payments add column if not exists round_id text;
+alter table public.payments add column if not exists stat_date date;
+alter table public.payments add column if not exists ticket_value numeric;
+alter table public.payments add column if not exists prize_amount numeric;
+alter table public.payments add column if not exists referral_bonus numeric;
+create index if not exists payments_stat_date_idx on public.payments (stat_date);
+-- One key per "I have paid" claim, so a retried /confirm_payment cannot credit it twice.
+alter table public.payments add column if not exists payment_key text;
+create unique index if not exists payments_payment_key_idx on public.payments (payment_key);
+
+-- Inserts notifications given as a json array of {kind, chat_id, payload}.
+create or replace function public.enqueue_outbox(notifications_input jsonb)
+returns void
+language sql
+as $$
+    insert into public.notification_outbox (kind, chat_id, payload)
+    select n->>'kind', (n->>'chat_id')::bigint, n->'payload'
+    from jsonb_array_elements(coalesce(notifications_input, '[]'::jsonb)) as n;
+$$;
+
+-- Creates the user and counts the signup (and the referral) in the same
+-- transaction, queueing notifications_input with it. Calling it again for an
+-- existing user returns that user and writes nothing.
+create or replace function public.register_user(
+    telegram_id_input bigint,
+    username_input text,
+    first_name_input text,
+    last_name_input text,
+    referrer_id_input bigint,
+    join_date_input timestamptz,
+    stat_date_input date,
+    notifications_input jsonb default '[]'
+) returns setof public.users
+language plpgsql
+as $$
+declare
+    new_user public.users;
+begin
+    if exists (select 1 from public.users where telegram_id = telegram_id_input) then
+        return query select * from public.users where telegram_id = telegram_id_input;
+        return;
+    end if;
+
+    insert into public.users (telegram_id, username, first_name, last_name, referrer_telegram_id, join_date)
+    values (telegram_id_input, username_input, first_name_input, last_name_input, referrer_id_input, join_date_input)
+    returning * into new_user;
+
+    perform public.increment_daily_stats(stat_date_input, new_users_delta => 1);
+    if referrer_id_input is not null then
+        perform public.increment_referral_stats(referrer_id_input, referrals_delta => 1);
+    end if;
+    perform public.enqueue_outbox(notifications_input);
+    return next new_user;
+end;
+$$;
+
+-- Everything a /confirm_payment changes: the tickets (daily_tickets when
+-- round_id_input is null, round_tickets otherwise), the payments row, the
+-- referral bonus, both rollups and the notifications. payment_key_input
+-- identifies the claim. If a payment with that key exists (an earlier call
+-- committed but its reply was lost), nothing is written again. Returns the user's ticket count in the round
+-- and whether this call applied the payment.
+create or replace function public.confirm_ticket_payment(
+    payment_key_input text,
+    telegram_id_input bigint,
+    round_id_input text,
+    draw_date_input date,
+    ticket_date_input date,
+    num_tickets_input integer,
+    amount_input numeric,
+    ticket_value_input numeric,
+    prize_amount_input numeric,
+    referrer_id_input bigint,
+    referral_bonus_input numeric,
+    stat_date_input date,
+    notifications_input jsonb default '[]'
+) returns json
+language plpgsql
+as $$
+declare
+    round_tickets_after integer;
+    bonus numeric := case when referrer_id_input is null then 0 else coalesce(referral_bonus_input, 0) end;
+    already_applied boolean;
+begin
+    -- Same-key calls wait here for each other, so only one of them applies.
+    perform pg_advisory_xact_lock(hashtext(payment_key_input));
+    select exists (select 1 from public.payments where payment_key = payment_key_input) into already_applied;
+    if already_applied then
+        if round_id_input is null then
+            select count into round_tickets_after from public.daily_tickets
+            where telegram_id = telegram_id_input and date = draw_date_input;
+        else
+            select count into round_tickets_after from public.round_tickets
+            where round_id = round_id_input and telegram_id = telegram_id_input;
+        end if;
+        return json_build_object('round_tickets', round_tickets_after, 'applied', false);
+    end if;
+
+    if round_id_input is null then
+        perform public.increment_daily_ticket(user_id_input => telegram_id_input, ticket_date_input => draw_date_input, num_tickets_to_add => num_tickets_input);
+        select count into round_tickets_after from public.daily_tickets
+        where telegram_id = telegram_id_input and date = draw_date_input;
+    else
+        perform public.increment_round_ticket(round_id_input, telegram_id_input, num_tickets_input);
+        select count into round_tickets_after from public.round_tickets
+        where round_id = round_id_input and telegram_id = telegram_id_input;
+    end if;
+
+    insert into public.payments (payment_key, telegram_id, num_tickets, amount, ticket_date, round_id, stat_date, ticket_value, prize_amount, referral_bonus)
+    values (payment_key_input, telegram_id_input, num_tickets_input, amount_input, ticket_date_input, round_id_input, stat_date_input, ticket_value_input, prize_amount_input, bonus);
+
+    if bonus > 0 then
+        insert into public.referral_bonuses (referrer_telegram_id, referred_telegram_id, num_tickets, amount)
+        values (referrer_id_input, telegram_id_input, num_tickets_input, bonus);
+        perform public.increment_referral_stats(referrer_id_input, tickets_delta => num_tickets_input, bonus_delta => bonus);
+    end if;
+
+    perform public.increment_daily_stats(
+        stat_date_input,
+        tickets_delta => num_tickets_input,
+        revenue_delta => ticket_value_input,
+        -- daily_stats.prize is the daily draw's pool; intraday rounds pay out their own pools.
+        prize_delta => case when round_id_input is null then prize_amount_input else 0 end,
+        referral_payouts_delta => bonus
+    );
+    perform public.enqueue_outbox(notifications_input);
+    return json_build_object('round_tickets', round_tickets_after, 'applied', true);
+end;
+$$;
+
+-- Records a draw's winner, marks an intraday round drawn (round_id_input is
+-- null for the daily draw) and queues the announcement.
+create or replace function public.record_draw_result(
+    round_id_input text,
+    win_date_input date,
+    winner_id_input bigint,
+    prize_input numeric,
+    notifications_input jsonb default '[]'
+) returns void
+language plpgsql
+as $$
+begin
+    insert into public.winners (telegram_id, amount, win_date, round_id)
+    values (winner_id_input, prize_input, win_date_input, round_id_input);
+    if round_id_input is not null then
+        update public.rounds
+        set status = 'drawn', winner_telegram_id = winner_id_input, prize = prize_input, drawn_at = now()
+        where round_id = round_id_input;
+    end if;
+    perform public.enqueue_outbox(notifications_input);
+end;
+$$;
+
+-- Rewrites daily_stats from the source tables for dates >= from_date_input
+-- (all dates when null). new_users comes from users.join_date in the bot's
+-- timezone. tickets, revenue, prize and referral_payouts come from payments
+-- rows that carry a stat_date (prize from daily-round payments only, as in
+-- confirm_ticket_payment); days confirmed before this migration keep
+-- their incremental values. Returns the number of rows rewritten.
+create or replace function public.reconcile_daily_stats(from_date_input date, timezone_input text)
+returns integer
+language plpgsql
+as $$
+declare
+    signup_rows integer;
+    payment_rows integer;
+begin
+    with joined as (
+        select (join_date at time zone timezone_input)::date as date, count(*) as new_users
+        from public.users
+        where from_date_input is null or join_date >= (from_date_input::timestamp at time zone timezone_input)
+        group by 1
+    ),
+    days as (
+        select date from public.daily_stats where from_date_input is null or date >= from_date_input
+        union
+        select date from joined
+    )
+    insert into public.daily_stats as s (date, new_users)
+    select d.date, coalesce(j.new_users, 0)
+    from days d
+    left join joined j on j.date = d.date
+    on conflict (date) do update set
+        new_users = excluded.new_users,
+        updated_at = now()
+    where s.new_users is distinct from excluded.new_users;
+    get diagnostics signup_rows = row_count;
+
+    insert into public.daily_stats as s (date, tickets, revenue, prize, referral_payouts)
+    select stat_date, sum(num_tickets), sum(ticket_value), coalesce(sum(prize_amount) filter (where round_id is null), 0), sum(referral_bonus)
+    from public.payments
+    where stat_date is not null
+      and (from_date_input is null or stat_date >= from_date_input)
+    group by stat_date
+    on conflict (date) do update set
+        tickets = excluded.tickets,
+        revenue = excluded.revenue,
+        prize = excluded.prize,
+        referral_payouts = excluded.referral_payouts,
+        updated_at = now()
+    where (s.tickets, s.revenue, s.prize, s.referral_payouts)
+        is distinct from (excluded.tickets, excluded.revenue, excluded.prize, excluded.referral_payouts);
+    get diagnostics payment_rows = row_count;
+
+    return signup_rows + payment_rows;
+end;
+$$;
@@ -0,0 +1,11 @@
+-- 010_winners_export_key.sql
+-- Since intraday rounds (007), one user can win several times on the same
+-- date, so (win_date, telegram_id) no longer identifies a winners row and the
+-- /export keyset pagination could skip tied rows. Give every row a surrogate id
+-- (existing rows are numbered when the column is added) and page by (win_date, id).
+-- Run once in the Supabase SQL editor.
+
+alter table public.winners add column if not exists id bigserial;
+create unique index if not exists winners_id_idx on public.winners (id);
+create index if not exists winners_win_date_id_idx on public.winners (win_date, id);
+drop index if exists public.winners_win_date_telegram_id_idx;
@@ -0,0 +1,70 @@
+-- 011_outbox_fanout.sql
+-- A broadcast used to be one outbox row, sent to every recipient under a
+-- single lease. A broadcast that outlived the lease, or a restart halfway
+-- through, sent it to everyone again. The dispatcher now calls
+-- expand_outbox_broadcast on a claimed broadcast row. In one transaction that
+-- marks the row sent and queues one send_message row per recipient, so progress
+-- is tracked per recipient and a retry only resends unsettled rows. Expanded
+-- rows get priority 1, and claim_outbox_batch serves priority 0 first, so
+-- confirmations and other direct messages are not queued behind a broadcast.
+-- Run once in the Supabase SQL editor.
+
+alter table public.notification_outbox add column if not exists priority smallint not null default 0;
+create index if not exists notification_outbox_claim_idx
+    on public.notification_outbox (priority, id)
+    where status in ('pending', 'sending');
+
+create or replace function public.claim_outbox_batch(batch_size integer, lease_seconds integer)
+returns setof public.notification_outbox
+language sql
+as $$
+    update public.notification_outbox o
+    set status = 'sending',
+        attempts = o.attempts + 1,
+        next_attempt_at = now() + make_interval(secs => lease_seconds)
+    where o.id in (
+        select id
+        from public.notification_outbox
+        where status in ('pending', 'sending')
+          and next_attempt_at <= now()
+        order by priority, id
+        limit batch_size
+        for update skip locked
+    )
+    returning o.*;
+$$;
+
+-- Fans a broadcast row out to payload.user_ids, or to every user when absent.
+-- Returns the number of recipient rows queued (0 if the row was already expanded).
+create or replace function public.expand_outbox_broadcast(outbox_id_input bigint)
+returns integer
+language plpgsql
+as $$
+declare
+    broadcast_payload jsonb;
+    recipients integer;
+begin
+    update public.notification_outbox
+    set status = 'sent', sent_at = now(), last_error = null
+    where id = outbox_id_input and kind = 'broadcast' and status in ('pending', 'sending')
+    returning payload into broadcast_payload;
+    if not found then
+        return 0;
+    end if;
+
+    insert into public.notification_outbox (kind, chat_id, payload, priority)
+    select 'send_message',
+           recipient.chat_id,
+           jsonb_build_object('text', broadcast_payload->'text', 'parse_mode', broadcast_payload->'parse_mode', 'lane', 'bulk'),
+           1
+    from (
+        select (jsonb_array_elements_text(broadcast_payload->'user_ids'))::bigint as chat_id
+        where broadcast_payload ? 'user_ids'
+        union
+        select telegram_id from public.users
+        where not (broadcast_payload ? 'user_ids')
+    ) recipient;
+    get diagnostics recipients = row_count;
+    return recipients;
+end;
+$$;
@@ -0,0 +1,617 @@
+# replay_updates.py
+# Capacity testing: feeds a recording made with RECORD_UPDATES_PATH back through the bot's handlers
+# against local stand-ins for Telegram and Supabase, then reports throughput and latency.
+# Usage: python replay_updates.py <recording.jsonl.gz> [--speed 1|10|max] [--db-latency-ms 20] [--telegram-latency-ms 50]
+# Nothing leaves the machine: the bot is built with a fake HTTP layer and an in-memory database.
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+from postgrest.exceptions import APIError
+from telegram.request import BaseRequest
+
+REPLAY_BOT_ID = 100000001
+
+
+GZIP_MEMBER_MAGIC = b'\x1f\x8b\x08'
+GZIP_READ_CHUNK = 1 << 16
+
+
+def decompress_gzip_member(data: bytes, start: int, end: int) -> tuple[bytes, int | None]:
+    """Inflate one gzip member from data[start:end].
+
+    Returns (bytes, offset just past the member), with offset None when the member never ended;
+    output up to a corrupt byte is kept.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    output = []
+    for position in range(start, end, GZIP_READ_CHUNK):
+        chunk_end = min(position + GZIP_READ_CHUNK, end)
+        try:
+            output.append(decompressor.decompress(data[position:chunk_end]))
+        except zlib.error:
+            break
+        if decompressor.eof:
+            return b''.join(output), chunk_end - len(decompressor.unused_data)
+    return b''.join(output), None
+
+
+def recording_lines(path: str) -> tuple[list[str], int]:
+    """Complete lines of a recording, and how many of its gzip members were cut short.
+
+    The recorder appends one gzip member per run. After an unclean exit the last member has no
+    trailer (gzip.open raises EOFError there), and the next run appends a new member after it.
+    A cut member keeps its complete lines and reading resumes at the next member header.
+    """
+    with open(path, 'rb') as recording:
+        data = recording.read()
+    lines, truncated_members, offset = [], 0, 0
+    while offset < len(data):
+        text, next_offset = decompress_gzip_member(data, offset, len(data))
+        if next_offset is None:
+            # Trailer ke bina member: agle member header tak hi iska data hai; adhoori aakhri line chhod do.
+            truncated_members += 1
+            next_offset = data.find(GZIP_MEMBER_MAGIC, offset + 1)
+            if next_offset < 0:
+                next_offset = len(data)
+            text, _ = decompress_gzip_member(data, offset, next_offset)
+            text = text[:text.rfind(b'\n') + 1]
+        lines.extend(text.decode('utf-8', errors='replace').splitlines())
+        offset = next_offset
+    return lines, truncated_members
+
+
+def read_recording(path: str) -> tuple[dict, list[dict]]:
+    header = {}
+    updates = []
+    lines, truncated_members = recording_lines(path)
+    skipped_lines = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            skipped_lines += 1
+            continue
+        if record['type'] == 'header':
+            header = record
+        elif record['type'] == 'update':
+            updates.append(record)
+    if truncated_members or skipped_lines:
+        print(f"Recording {path}: {truncated_members} gzip member(s) ended without a trailer (unclean exit), {skipped_lines} unreadable line(s) skipped; replaying the {len(updates)} complete updates.")
+    updates.sort(key=lambda record: record['ts'])
+    return header, updates
+
+
+# --- Telegram stand-in ---
+class ReplayTelegramRequest(BaseRequest):
+    """Answers Bot API calls locally after telegram_latency seconds, counting them per method."""
+
+    def __init__(self, telegram_latency: float, calls: Counter):
+        self.telegram_latency = telegram_latency
+        self.calls = calls
+        self.message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def sent_message(self, parameters: dict) -> dict:
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(parameters.get('chat_id') or 0), 'type': 'private'},
+            'from': {'id': REPLAY_BOT_ID, 'is_bot': True, 'first_name': 'Replay'}
+        }
+        if 'text' in parameters:
+            message['text'] = parameters['text']
+        for media_type in ('video', 'animation', 'document'):
+            if media_type in parameters:
+                message[media_type] = {'file_id': f"replay-{media_type}", 'file_unique_id': f"replay-{media_type}", 'width': 1, 'height': 1, 'duration': 1}
+        if 'photo' in parameters:
+            message['photo'] = [{'file_id': 'replay-photo', 'file_unique_id': 'replay-photo', 'width': 1, 'height': 1}]
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if endpoint == 'getUpdates':
+            await asyncio.sleep(1)
+            result = []
+        else:
+            await asyncio.sleep(self.telegram_latency)
+            if endpoint == 'getMe':
+                result = {'id': REPLAY_BOT_ID, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+            elif endpoint.startswith(('send', 'edit', 'copy', 'forward')) and endpoint != 'sendChatAction':
+                result = self.sent_message(parameters)
+            else:
+                result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+# --- Supabase stand-in ---
+class InMemoryResponse(SimpleNamespace):
+    pass
+
+
+class InMemoryQuery:
+    """The subset of the postgrest query builder bot.py uses, evaluated against in-memory tables."""
+
+    def __init__(self, database, table: str):
+        self.database = database
+        self.table = table
+        self.action = 'select'
+        self.columns = None
+        self.count_mode = None
+        self.values = None
+        self.on_conflict = None
+        self.ignore_duplicates = False
+        self.filters = []
+        self.orders = []
+        self.row_limit = None
+        self.row_offset = 0
+        self.expect_single = False
+
+    def select(self, *columns, count=None):
+        self.columns = [column.strip() for column in ','.join(columns).split(',')] if columns and columns != ('*',) else None
+        self.count_mode = count
+        return self
+
+    def insert(self, rows):
+        self.action, self.values = 'insert', rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.action, self.values = 'upsert', rows if isinstance(rows, list) else [rows]
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def update(self, fields):
+        self.action, self.values = 'update', fields
+        return self
+
+    def delete(self):
+        self.action = 'delete'
+        return self
+
+    def eq(self, column, value): return self.add_filter(column, 'eq', value)
+    def neq(self, column, value): return self.add_filter(column, 'neq', value)
+    def gt(self, column, value): return self.add_filter(column, 'gt', value)
+    def gte(self, column, value): return self.add_filter(column, 'gte', value)
+    def lt(self, column, value): return self.add_filter(column, 'lt', value)
+    def lte(self, column, value): return self.add_filter(column, 'lte', value)
+    def in_(self, column, values): return self.add_filter(column, 'in', list(values))
+    def is_(self, column, value): return self.add_filter(column, 'is', None if value in (None, 'null') else value)
+
+    def or_(self, filter_string: str):
+        self.filters.append(parse_or_filter(filter_string))
+        return self
+
+    def add_filter(self, column, operator, value):
+        self.filters.append(lambda row: compare(row.get(column), operator, value))
+        return self
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def range(self, start, end):
+        self.row_offset, self.row_limit = start, end - start + 1
+        return self
+
+    def single(self):
+        self.expect_single = True
+        return self
+
+    def execute(self):
+        return self.database.run(self)
+
+
+def coerce(stored, value):
+    if isinstance(stored, (int, float)) and not isinstance(stored, bool) and isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def compare(stored, operator: str, value) -> bool:
+    if operator == 'in':
+        return stored in value
+    if operator == 'is':
+        return stored is value
+    value = coerce(stored, value)
+    if operator == 'eq':
+        return stored == value
+    if operator == 'neq':
+        return stored != value
+    if stored is None:
+        return False
+    return {'gt': stored > value, 'gte': stored >= value, 'lt': stored < value, 'lte': stored <= value}[operator]
+
+
+def parse_or_filter(filter_string: str):
+    """Parse the PostgREST or=() syntax used by build_keyset_filter: col.op.val,and(col.op.val,...)."""
+    def split_top_level(text):
+        parts, depth, current = [], 0, ''
+        for char in text:
+            if char == ',' and depth == 0:
+                parts.append(current)
+                current = ''
+                continue
+            depth += {'(': 1, ')': -1}.get(char, 0)
+            current += char
+        return parts + [current]
+
+    def build(expression):
+        match = re.fullmatch(r'(and|or)\((.*)\)', expression)
+        if match:
+            children = [build(part) for part in split_top_level(match.group(2))]
+            combine = all if match.group(1) == 'and' else any
+            return lambda row: combine(child(row) for child in children)
+        column, operator, value = expression.split('.', 2)
+        return lambda row: compare(row.get(column), operator, value)
+
+    branches = [build(part) for part in split_top_level(filter_string)]
+    return lambda row: any(branch(row) for branch in branches)
+
+
+class InMemorySupabase:
+    """Tables as lists of dicts plus Python versions of the RPCs in migrations/. Thread-safe, with fixed latency per call."""
+
+    def __init__(self, db_latency: float, calls: Counter):
+        self.db_latency = db_latency
+        self.calls = calls
+        self.tables = defaultdict(list)
+        self.lock = threading.Lock()
+        self.row_ids = itertools.count(1)
+
+    def from_(self, table: str) -> InMemoryQuery:
+        return InMemoryQuery(self, table)
+
+    table = from_
+
+    # bot.py ke har supabase.rpc(...) ka stand-in; tests/test_replay_stand_in.py isko bot.py se milata hai.
+    RPC_STAND_INS = frozenset({
+        'register_user', 'confirm_ticket_payment', 'record_draw_result', 'expand_outbox_broadcast', 'reconcile_daily_stats',
+        'get_daily_stats_snapshot', 'get_user_ticket_history', 'get_user_round_tickets', 'claim_outbox_batch', 'claim_round_for_draw', 'archive_daily_tickets',
+    })
+
+    def rpc(self, name: str, params: dict):
+        return SimpleNamespace(execute=lambda: self.run_rpc(name, params))
+
+    def now(self) -> str:
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def new_row(self, table: str, values: dict) -> dict:
+        row = dict(values)
+        row.setdefault('id', next(self.row_ids))
+        row.setdefault('created_at', self.now())
+        if table == 'notification_outbox':
+            row.setdefault('priority', 0)
+            row.setdefault('status', 'pending')
+            row.setdefault('attempts', 0)
+            row.setdefault('next_attempt_at', self.now())
+        return row
+
+    def run(self, query: InMemoryQuery) -> InMemoryResponse:
+        time.sleep(self.db_latency)
+        self.calls[f"{query.action}:{query.table}"] += 1
+        with self.lock:
+            rows = self.tables[query.table]
+            if query.action == 'insert':
+                inserted = [self.new_row(query.table, values) for values in query.values]
+                rows.extend(inserted)
+                return InMemoryResponse(data=inserted, count=None)
+            if query.action == 'upsert':
+                key_columns = [column.strip() for column in (query.on_conflict or 'id').split(',')]
+                upserted = []
+                for values in query.values:
+                    existing = next((row for row in rows if all(row.get(column) == values.get(column) for column in key_columns)), None)
+                    if existing is None:
+                        existing = self.new_row(query.table, values)
+                        rows.append(existing)
+                    elif not query.ignore_duplicates:
+                        existing.update(values)
+                    upserted.append(existing)
+                return InMemoryResponse(data=upserted, count=None)
+
+            matched = [row for row in rows if all(row_filter(row) for row_filter in query.filters)]
+            if query.action == 'update':
+                for row in matched:
+                    row.update(query.values)
+                return InMemoryResponse(data=[dict(row) for row in matched], count=None)
+            if query.action == 'delete':
+                self.tables[query.table] = [row for row in rows if row not in matched]
+                return InMemoryResponse(data=matched, count=None)
+
+            for column, desc in reversed(query.orders):
+                matched.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+            total = len(matched)
+            end = None if query.row_limit is None else query.row_offset + query.row_limit
+            matched = matched[query.row_offset:end]
+            data = [{column: row.get(column) for column in query.columns} if query.columns else dict(row) for row in matched]
+        if query.expect_single:
+            if len(data) != 1:
+                raise APIError({'code': 'PGRST116', 'message': 'JSON object requested, multiple (or no) rows returned',
+                                'details': f'The result contains {len(data)} rows', 'hint': None})
+            data = data[0]
+        return InMemoryResponse(data=data, count=total if query.count_mode else None)
+
+    def increment(self, table: str, key: dict, deltas: dict) -> None:
+        rows = self.tables[table]
+        row = next((row for row in rows if all(row.get(column) == value for column, value in key.items())), None)
+        if row is None:
+            row = dict(key, **{column: 0 for column in deltas})
+            rows.append(row)
+        for column, delta in deltas.items():
+            row[column] = (row.get(column) or 0) + delta
+
+    def enqueue_outbox(self, notifications: list[dict] | None) -> None:
+        self.tables['notification_outbox'].extend(self.new_row('notification_outbox', notification) for notification in notifications or [])
+
+    def expand_outbox_broadcast(self, outbox_id: int) -> int:
+        broadcast = next((row for row in self.tables['notification_outbox'] if row['id'] == outbox_id and row['kind'] == 'broadcast' and row['status'] in ('pending', 'sending')), None)
+        if broadcast is None:
+            return 0
+        broadcast.update(status='sent', sent_at=self.now(), last_error=None)
+        payload = broadcast['payload']
+        recipients = payload['user_ids'] if 'user_ids' in payload else [row['telegram_id'] for row in self.tables['users']]
+        self.enqueue_outbox({'kind': 'send_message', 'chat_id': chat_id, 'priority': 1,
+                             'payload': {'text': payload['text'], 'parse_mode': payload.get('parse_mode'), 'lane': 'bulk'}} for chat_id in dict.fromkeys(recipients))
+        return len(dict.fromkeys(recipients))
+
+    def confirm_ticket_payment(self, params: dict) -> dict:
+        telegram_id, num_tickets = params['telegram_id_input'], params['num_tickets_input']
+        if params['round_id_input'] is None:
+            key, table = {'telegram_id': telegram_id, 'date': params['draw_date_input']}, 'daily_tickets'
+        else:
+            key, table = {'round_id': params['round_id_input'], 'telegram_id': telegram_id}, 'round_tickets'
+
+        def round_tickets():
+            return next((row['count'] for row in self.tables[table] if all(row.get(column) == value for column, value in key.items())), None)
+
+        if any(row.get('payment_key') == params['payment_key_input'] for row in self.tables['payments']):
+            return {'round_tickets': round_tickets(), 'applied': False}
+        self.increment(table, key, {'count': num_tickets})
+        bonus = params['referral_bonus_input'] if params['referrer_id_input'] is not None else 0
+        self.tables['payments'].append(self.new_row('payments', {
+            'payment_key': params['payment_key_input'], 'telegram_id': telegram_id, 'num_tickets': num_tickets, 'amount': params['amount_input'], 'ticket_date': params['ticket_date_input'],
+            'round_id': params['round_id_input'], 'stat_date': params['stat_date_input'], 'ticket_value': params['ticket_value_input'],
+            'prize_amount': params['prize_amount_input'], 'referral_bonus': bonus
+        }))
+        if bonus > 0:
+            self.tables['referral_bonuses'].append(self.new_row('referral_bonuses', {
+                'referrer_telegram_id': params['referrer_id_input'], 'referred_telegram_id': telegram_id, 'num_tickets': num_tickets, 'amount': bonus
+            }))
+            self.increment('referral_stats', {'referrer_telegram_id': params['referrer_id_input']}, {'referral_tickets': num_tickets, 'bonus_earned': bonus})
+        self.increment('daily_stats', {'date': params['stat_date_input']}, {
+            'tickets': num_tickets, 'revenue': params['ticket_value_input'], 'prize': params['prize_amount_input'] if params['round_id_input'] is None else 0, 'referral_payouts': bonus
+        })
+        self.enqueue_outbox(params.get('notifications_input'))
+        return {'round_tickets': round_tickets(), 'applied': True}
+
+    def run_rpc(self, name: str, params: dict) -> InMemoryResponse:
+        time.sleep(self.db_latency)
+        self.calls[f"rpc:{name}"] += 1
+        with self.lock:
+            if name not in self.RPC_STAND_INS:
+                raise NotImplementedError(f"No in-memory stand-in for RPC {name!r}; add one to InMemorySupabase.run_rpc.")
+            if name == 'register_user':
+                existing = [dict(row) for row in self.tables['users'] if row['telegram_id'] == params['telegram_id_input']]
+                if existing:
+                    return InMemoryResponse(data=existing, count=None)
+                user = self.new_row('users', {
+                    'telegram_id': params['telegram_id_input'], 'username': params['username_input'], 'first_name': params['first_name_input'],
+                    'last_name': params['last_name_input'], 'referrer_telegram_id': params['referrer_id_input'], 'join_date': params['join_date_input']
+                })
+                self.tables['users'].append(user)
+                self.increment('daily_stats', {'date': params['stat_date_input']}, {'new_users': 1})
+                if params['referrer_id_input'] is not None:
+                    self.increment('referral_stats', {'referrer_telegram_id': params['referrer_id_input']}, {'referral_count': 1})
+                self.enqueue_outbox(params.get('notifications_input'))
+                return InMemoryResponse(data=[dict(user)], count=None)
+            elif name == 'confirm_ticket_payment':
+                return InMemoryResponse(data=self.confirm_ticket_payment(params), count=None)
+            elif name == 'record_draw_result':
+                self.tables['winners'].append(self.new_row('winners', {
+                    'telegram_id': params['winner_id_input'], 'amount': params['prize_input'], 'win_date': params['win_date_input'], 'round_id': params['round_id_input']
+                }))
+                for row in self.tables['rounds']:
+                    if params['round_id_input'] is not None and row['round_id'] == params['round_id_input']:
+                        row.update(status='drawn', winner_telegram_id=params['winner_id_input'], prize=params['prize_input'], drawn_at=self.now())
+                self.enqueue_outbox(params.get('notifications_input'))
+            elif name == 'expand_outbox_broadcast':
+                return InMemoryResponse(data=self.expand_outbox_broadcast(params['outbox_id_input']), count=None)
+            elif name == 'reconcile_daily_stats':
+                return InMemoryResponse(data=0, count=None)
+            elif name == 'get_daily_stats_snapshot':
+                today = datetime.date.fromisoformat(params['today_input'])
+                stats = {row['date']: row for row in self.tables['daily_stats']}
+                yesterday = (today - datetime.timedelta(days=1)).isoformat()
+                return InMemoryResponse(data={
+                    'total_users': sum(row.get('new_users') or 0 for row in stats.values()),
+                    'today_tickets': stats.get(today.isoformat(), {}).get('tickets', 0),
+                    'today_prize': stats.get(today.isoformat(), {}).get('prize', 0),
+                    'yesterday_prize': stats.get(yesterday, {}).get('prize', 0)
+                }, count=None)
+            elif name == 'get_user_ticket_history':
+                return InMemoryResponse(data=sorted(
+                    ({'date': row['date'], 'count': row['count']} for row in self.tables['daily_tickets']
+                     if row['telegram_id'] == params['user_id_input'] and row['date'] >= params['from_date_input']),
+                    key=lambda row: row['date'], reverse=True), count=None)
+            elif name == 'get_user_round_tickets':
+                from_input = datetime.datetime.fromisoformat(params['from_input'])
+                rounds = {row['round_id']: row for row in self.tables['rounds'] if datetime.datetime.fromisoformat(row['closes_at']) >= from_input}
+                return InMemoryResponse(data=sorted(
+                    ({**rounds[row['round_id']], 'count': row['count']} for row in self.tables['round_tickets']
+                     if row['telegram_id'] == params['user_id_input'] and row['round_id'] in rounds),
+                    key=lambda row: datetime.datetime.fromisoformat(row['closes_at']), reverse=True), count=None)
+            elif name == 'claim_outbox_batch':
+                now = self.now()
+                due = sorted((row for row in self.tables['notification_outbox'] if row['status'] in ('pending', 'sending') and row['next_attempt_at'] <= now),
+                             key=lambda row: (row.get('priority', 0), row['id']))
+                lease_until = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=params['lease_seconds'])).isoformat()
+                for row in due[:params['batch_size']]:
+                    row.update(status='sending', attempts=row['attempts'] + 1, next_attempt_at=lease_until)
+                return InMemoryResponse(data=[dict(row) for row in due[:params['batch_size']]], count=None)
+            elif name == 'claim_round_for_draw':
+                now = datetime.datetime.now(datetime.timezone.utc)
+                lease = datetime.timedelta(seconds=params['lease_seconds_input'])
+
+                def claimable(row):
+                    if row['status'] == 'open':
+                        return True
+                    return row['status'] == 'drawing' and (row.get('draw_claim') == params['claim_id_input'] or not row.get('drawing_since')
+                                                           or datetime.datetime.fromisoformat(row['drawing_since']) < now - lease)
+                drawn = any(row.get('round_id') == params['round_id_input'] for row in self.tables['winners'])
+                claimed = [row for row in self.tables['rounds'] if row['round_id'] == params['round_id_input'] and not drawn and claimable(row)]
+                for row in claimed:
+                    row.update(status='drawing', draw_claim=params['claim_id_input'], drawing_since=now.isoformat())
+                return InMemoryResponse(data=[dict(row) for row in claimed], count=None)
+            elif name == 'archive_daily_tickets':
+                return InMemoryResponse(data=0, count=None)
+        return InMemoryResponse(data=None, count=None)
+
+
+# --- Replay driver ---
+def update_kind(update_data: dict) -> str:
+    message = update_data.get('message') or update_data.get('edited_message') or {}
+    text = message.get('text') or ''
+    if text.startswith('/'):
+        return text.split(' ', 1)[0].split('@', 1)[0]
+    if 'callback_query' in update_data:
+        return f"callback:{(update_data['callback_query'].get('data') or '').split('_', 1)[0]}"
+    if message:
+        return 'message'
+    return next((key for key in update_data if key != 'update_id'), 'unknown')
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def replay(bot_module, records: list[dict], speed: float | None, telegram_latency: float, drain_seconds: float, telegram_calls: Counter) -> dict:
+    from telegram import Update
+
+    application = bot_module.build_application(
+        request=ReplayTelegramRequest(telegram_latency, telegram_calls),
+        get_updates_request=ReplayTelegramRequest(telegram_latency, Counter())
+    )
+    handler_errors = Counter()
+
+    async def count_handler_error(update, context) -> None:
+        handler_errors[type(context.error).__name__] += 1
+    application.add_error_handler(count_handler_error)
+
+    latencies = defaultdict(list)
+    # Application ki concurrency ki nakal: default 1 ka matlab updates ek-ek karke, arrival order mein.
+    concurrency = max(1, int(getattr(application, 'concurrent_updates', 1) or 1))
+    processing_slots = asyncio.Semaphore(concurrency)
+
+    async def process(update, kind: str, arrived_at: float) -> None:
+        async with processing_slots:
+            await application.process_update(update)
+        latencies[kind].append(time.perf_counter() - arrived_at)
+
+    async with application:
+        await application.start()
+        first_ts = records[0]['ts'] if records else 0
+        started_at = time.perf_counter()
+        tasks = []
+        for record in records:
+            if speed:
+                delay = started_at + (record['ts'] - first_ts) / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            update = Update.de_json(record['update'], application.bot)
+            tasks.append(asyncio.create_task(process(update, update_kind(record['update']), time.perf_counter())))
+        await asyncio.gather(*tasks)
+        finished_at = time.perf_counter()
+        if drain_seconds:
+            await asyncio.sleep(drain_seconds) # outbox dispatch aur broadcasts ko khatam hone do
+        await application.stop()
+
+    return {'latencies': latencies, 'elapsed': finished_at - started_at, 'handler_errors': handler_errors, 'concurrency': concurrency}
+
+
+def print_report(result: dict, telegram_calls: Counter, db_calls: Counter) -> None:
+    all_latencies = sorted(latency for kind_latencies in result['latencies'].values() for latency in kind_latencies)
+    total = len(all_latencies)
+    print(f"Replayed {total} updates in {result['elapsed']:.2f}s -> {total / result['elapsed'] if result['elapsed'] else 0:.1f} updates/s (concurrent_updates={result['concurrency']})")
+    print(f"{'update':<22}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = [('ALL', all_latencies)] + sorted(((kind, sorted(values)) for kind, values in result['latencies'].items()), key=lambda item: -len(item[1]))
+    for kind, values in rows:
+        print(f"{kind:<22}{len(values):>7}" + ''.join(f"{percentile(values, fraction) * 1000:>10.1f}" for fraction in (0.5, 0.9, 0.99)) + f"{(values[-1] if values else 0) * 1000:>10.1f}")
+    if result['handler_errors']:
+        print(f"Handler errors: {dict(result['handler_errors'])}")
+    print(f"Telegram calls: {sum(telegram_calls.values())} {dict(telegram_calls.most_common(8))}")
+    print(f"Database calls: {sum(db_calls.values())} {dict(db_calls.most_common(8))}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded TrustWin updates against local Telegram/Supabase stand-ins.")
+    parser.add_argument("recording", help="gzip JSONL written by the bot with RECORD_UPDATES_PATH set")
+    parser.add_argument("--speed", default="1", help="Time scale: 1 = real time, 10 = ten times faster, max = no waiting")
+    parser.add_argument("--db-latency-ms", type=float, default=20, help="Simulated Supabase round trip per call")
+    parser.add_argument("--telegram-latency-ms", type=float, default=50, help="Simulated Bot API round trip per call")
+    parser.add_argument("--drain-seconds", type=float, default=5, help="Keep jobs running this long after the last update")
+    parser.add_argument("--limit", type=int, default=None, help="Only replay the first N updates")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    try:
+        speed = None if args.speed == 'max' else float(args.speed)
+    except ValueError:
+        parser.error("--speed must be a number or 'max'")
+    if speed is not None and speed <= 0:
+        parser.error("--speed must be positive")
+
+    header, records = read_recording(args.recording)
+    if args.limit:
+        records = records[:args.limit]
+
+    # bot.py env vars import par validate karta hai; replay kabhi asli bot/database ko touch nahi karta.
+    os.environ.update({
+        'BOT_TOKEN': f"{REPLAY_BOT_ID}:replay",
+        'ADMIN_ID': str(header.get('admin_id', 1)),
+        'USDT_WALLET': 'replay-wallet',
+        'SUPABASE_URL': 'http://localhost:54321',
+        'SUPABASE_KEY': 'replay.replay.replay'
+    })
+    os.environ.pop('RECORD_UPDATES_PATH', None)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=args.log_level.upper()) # bot.py ka basicConfig phir no-op hai
+    import bot as bot_module
+
+    telegram_calls, db_calls = Counter(), Counter()
+    bot_module.supabase = InMemorySupabase(args.db_latency_ms / 1000, db_calls)
+    result = asyncio.run(replay(bot_module, records, speed, args.telegram_latency_ms / 1000, args.drain_seconds, telegram_calls))
+    print_report(result, telegram_calls, db_calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Error alert fingerprinting, aggregation and flush backoff (bot.py "Error Alert Aggregation").
+# Run with: python -m pytest -q tests
+
+import asyncio
+import queue
+import os
+
+# bot.py env vars import par validate karta hai; yeh tests network ya database ko touch nahi karte.
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('USDT_WALLET', 'test-wallet')
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_KEY', 'test.test.test')
+
+import pytest
+from telegram.error import BadRequest, NetworkError
+
+import bot
+
+
+class FakeBot:
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append(text)
+
+
+def raise_at_same_place(message: str) -> ValueError:
+    try:
+        raise ValueError(message)
+    except ValueError as error:
+        return error
+
+
+@pytest.fixture(autouse=True)
+def empty_buckets():
+    bot.error_alert_buckets.clear()
+    yield
+    bot.error_alert_buckets.clear()
+
+
+def test_same_location_shares_a_fingerprint():
+    first = bot.error_fingerprint(raise_at_same_place("first"))
+    second = bot.error_fingerprint(raise_at_same_place("second"))
+    assert first == second
+    assert first[1] == 'ValueError'
+    assert 'raise_at_same_place' in first[2]
+    assert bot.error_fingerprint(KeyError("x"))[0] != first[0]
+
+
+def test_burst_is_sent_as_one_summary_and_doubles_the_window():
+    fingerprint = None
+    for index in range(3):
+        fingerprint = bot.record_error_alert(raise_at_same_place(f"error {index}"), "update", now=100.0)
+    fake_bot = FakeBot()
+
+    assert asyncio.run(bot.flush_error_alerts(fake_bot, now=100.0)) == 1
+    assert "`3` in this window" in fake_bot.sent[0]
+    bucket = bot.error_alert_buckets[fingerprint]
+    assert bucket['count'] == 0
+    assert bucket['window'] == min(bot.ERROR_ALERT_WINDOW_SECONDS * 2, bot.ERROR_ALERT_MAX_WINDOW_SECONDS)
+
+    # Nayi window khatam hone se pehle kuch nahi jaata.
+    bot.record_error_alert(raise_at_same_place("again"), "update", now=101.0)
+    assert asyncio.run(bot.flush_error_alerts(fake_bot, now=101.0)) == 0
+    assert asyncio.run(bot.flush_error_alerts(fake_bot, now=100.0 + bucket['window'])) == 1
+
+
+def test_failed_send_backs_off_then_gives_up():
+    fingerprint = bot.record_error_alert(raise_at_same_place("boom"), "update", now=0.0)
+    fake_bot = FakeBot(failures=[NetworkError("down")] * bot.ERROR_ALERT_MAX_SEND_FAILURES)
+
+    now = 0.0
+    for attempt in range(1, bot.ERROR_ALERT_MAX_SEND_FAILURES):
+        assert asyncio.run(bot.flush_error_alerts(fake_bot, now=now)) == 0
+        bucket = bot.error_alert_buckets[fingerprint]
+        assert bucket['count'] == 1
+        assert bucket['next_flush_at'] - now == min(bot.ERROR_ALERT_WINDOW_SECONDS * 2 ** (attempt - 1), bot.ERROR_ALERT_MAX_WINDOW_SECONDS)
+        # Backoff ke beech flush dobara koshish nahi karta.
+        assert asyncio.run(bot.flush_error_alerts(fake_bot, now=now + 1)) == 0
+        now = bucket['next_flush_at']
+
+    assert asyncio.run(bot.flush_error_alerts(fake_bot, now=now)) == 0
+    bucket = bot.error_alert_buckets[fingerprint]
+    assert bucket['count'] == 0
+    assert bucket['send_failures'] == 0
+    assert fake_bot.sent == []
+
+
+def test_permanent_send_error_is_not_retried():
+    fingerprint = bot.record_error_alert(raise_at_same_place("boom"), "update", now=0.0)
+    fake_bot = FakeBot(failures=[BadRequest("Can't parse entities")])
+
+    assert asyncio.run(bot.flush_error_alerts(fake_bot, now=0.0)) == 0
+    bucket = bot.error_alert_buckets[fingerprint]
+    assert bucket['count'] == 0
+    assert bucket['next_flush_at'] == bot.ERROR_ALERT_WINDOW_SECONDS
+
+
+def test_other_workers_report_to_worker_zero(monkeypatch):
+    alerts = queue.Queue()
+    monkeypatch.setattr(bot, 'shared_error_alerts', alerts)
+    monkeypatch.setattr(bot, 'worker_slot', 2)
+    fingerprint = bot.record_error_alert(raise_at_same_place("on worker 2"), "update", now=0.0)
+    bot.record_error_alert(raise_at_same_place("again on worker 2"), "update", now=0.0)
+    assert bot.error_alert_buckets == {}
+
+    monkeypatch.setattr(bot, 'worker_slot', 0)
+    fake_bot = FakeBot()
+    assert asyncio.run(bot.flush_error_alerts(fake_bot, now=0.0)) == 1
+    assert "`2` in this window" in fake_bot.sent[0]
+    assert bot.error_alert_buckets[fingerprint]['count'] == 0
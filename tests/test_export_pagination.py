@@ -0,0 +1,47 @@
+# Keyset pagination of /export (bot.py "Data Export").
+# Run with: python -m pytest -q tests
+
+import asyncio
+import datetime
+import os
+from collections import Counter
+
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('USDT_WALLET', 'test-wallet')
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_KEY', 'test.test.test')
+
+import bot
+import replay_updates
+
+
+def test_keyset_filter_breaks_ties_on_later_key_columns():
+    last_row = {'win_date': '2026-10-01', 'id': 17, 'amount': 5}
+    assert bot.build_keyset_filter(['win_date', 'id'], last_row) == "win_date.gt.2026-10-01,and(win_date.eq.2026-10-01,id.gt.17)"
+    assert bot.build_keyset_filter(['id'], last_row) == "id.gt.17"
+
+
+def test_keyset_filter_selects_rows_strictly_after_the_last_row():
+    rows = [{'win_date': date, 'id': row_id} for date in ('2026-10-01', '2026-10-02') for row_id in (3, 17, 40)]
+    matches = replay_updates.parse_or_filter(bot.build_keyset_filter(['win_date', 'id'], {'win_date': '2026-10-01', 'id': 17}))
+    assert [row for row in rows if matches(row)] == [
+        {'win_date': '2026-10-01', 'id': 40},
+        {'win_date': '2026-10-02', 'id': 3}, {'win_date': '2026-10-02', 'id': 17}, {'win_date': '2026-10-02', 'id': 40},
+    ]
+
+
+def test_pages_with_equal_sort_keys_lose_and_repeat_nothing(monkeypatch):
+    db = replay_updates.InMemorySupabase(0, Counter())
+    for row_id in range(1, 8):
+        # Saare winners ek hi din ke: page boundary par sirf id tie todti hai.
+        db.tables['winners'].append({'id': row_id, 'win_date': '2026-10-01', 'telegram_id': 100 + row_id, 'amount': 1.0, 'round_id': None})
+    monkeypatch.setattr(bot, 'supabase', db)
+    monkeypatch.setattr(bot, 'EXPORT_PAGE_SIZE', 3)
+
+    async def collect():
+        return [page async for page in bot.iter_export_pages('winners', datetime.date(2026, 10, 1), datetime.date(2026, 10, 1))]
+
+    pages = asyncio.run(collect())
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [row['id'] for page in pages for row in page] == list(range(1, 8))
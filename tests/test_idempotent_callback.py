@@ -0,0 +1,123 @@
+# Duplicate "I have paid" taps (bot.py "Idempotent Callback Handling").
+# Run with: python -m pytest -q tests
+
+import asyncio
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('USDT_WALLET', 'test-wallet')
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_KEY', 'test.test.test')
+
+import pytest
+
+import bot
+
+
+class FakeQuery:
+    def __init__(self, data='paid_4_16.00', user_id=7, message_id=42):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(message_id=message_id)
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def tap(query):
+    return SimpleNamespace(callback_query=query)
+
+
+@pytest.fixture(autouse=True)
+def empty_store():
+    bot.callback_dedupe_store.clear()
+    yield
+    bot.callback_dedupe_store.clear()
+
+
+def test_duplicate_taps_coalesce_into_one_execution():
+    calls = []
+
+    @bot.idempotent_callback("already received")
+    async def handler(update, context):
+        calls.append(update.callback_query)
+        await asyncio.sleep(0.01)
+        return True
+
+    async def scenario():
+        queries = [FakeQuery() for _ in range(3)]
+        await asyncio.gather(*(handler(tap(query), None) for query in queries))
+        later = FakeQuery()
+        await handler(tap(later), None)
+        return queries, later
+
+    queries, later = asyncio.run(scenario())
+    assert calls == [queries[0]]
+    assert [query.answers for query in queries[1:]] == [["already received"], ["already received"]]
+    assert later.answers == ["already received"]
+
+
+def test_other_messages_and_data_are_not_deduplicated():
+    calls = []
+
+    @bot.idempotent_callback("already received")
+    async def handler(update, context):
+        calls.append(update.callback_query)
+        return True
+
+    async def scenario():
+        await handler(tap(FakeQuery()), None)
+        await handler(tap(FakeQuery(message_id=43)), None)
+        await handler(tap(FakeQuery(data='paid_5_20.00')), None)
+
+    asyncio.run(scenario())
+    assert len(calls) == 3
+
+
+def test_rejected_claim_releases_the_key():
+    results = [None, True]
+    calls = []
+
+    @bot.idempotent_callback("already received")
+    async def handler(update, context):
+        calls.append(update.callback_query)
+        return results[len(calls) - 1]
+
+    async def scenario():
+        await handler(tap(FakeQuery()), None)
+        assert bot.callback_dedupe_store == {}
+        retry = FakeQuery()
+        await handler(tap(retry), None)
+        return retry
+
+    retry = asyncio.run(scenario())
+    assert len(calls) == 2
+    assert retry.answers == [] # handled again, not answered as a duplicate
+    assert len(bot.callback_dedupe_store) == 1
+
+
+def test_failed_handler_releases_the_key_for_waiting_duplicates():
+    calls = []
+
+    @bot.idempotent_callback("already received")
+    async def handler(update, context):
+        calls.append(update.callback_query)
+        if len(calls) == 1:
+            await asyncio.sleep(0.01)
+            raise RuntimeError("database down")
+        return True
+
+    async def scenario():
+        first, duplicate = FakeQuery(), FakeQuery()
+        results = await asyncio.gather(handler(tap(first), None), handler(tap(duplicate), None), return_exceptions=True)
+        return first, duplicate, results
+
+    first, duplicate, results = asyncio.run(scenario())
+    assert isinstance(results[0], RuntimeError)
+    # Duplicate pehli execution fail hone ke baad khud chalta hai, "already received" nahi paata.
+    assert calls == [first, duplicate]
+    assert duplicate.answers == []
+    assert list(bot.callback_dedupe_store) == [(7, 42, 'paid_4_16.00')]
@@ -0,0 +1,70 @@
+# Outgoing Bot API priority lanes (bot.py PriorityLaneRateLimiter).
+# Run with: python -m pytest -q tests
+
+import asyncio
+import multiprocessing
+import os
+import time
+
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('USDT_WALLET', 'test-wallet')
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_KEY', 'test.test.test')
+
+import pytest
+
+import bot
+
+
+def test_waiting_lanes_are_served_in_strict_priority_order():
+    async def scenario():
+        limiter = bot.PriorityLaneRateLimiter(messages_per_second=20, connection_pool_size=8)
+        await limiter.initialize()
+        order = []
+
+        async def send(tag):
+            order.append(tag)
+
+        def request(tag, lane):
+            return asyncio.create_task(limiter.process_request(send, (tag,), {}, 'sendMessage', {'chat_id': 5}, {'lane': lane}))
+
+        # Pehle poora bucket khaali karo, taaki baad wale sab requests waiters banein.
+        await asyncio.gather(*(request(f"burst-{index}", 'interactive') for index in range(20)))
+        waiting = [request(f"bulk-{index}", 'bulk') for index in range(3)]
+        waiting += [request(f"admin-{index}", 'admin') for index in range(3)]
+        waiting += [request(f"interactive-{index}", 'interactive') for index in range(3)]
+        await asyncio.gather(*waiting)
+        await limiter.shutdown()
+        return order[20:]
+
+    # Bulk sabse pehle queue hua tha, phir bhi interactive aur admin waiters aage nikalte hain.
+    assert asyncio.run(scenario()) == [f"{lane}-{index}" for lane in ('interactive', 'admin', 'bulk') for index in range(3)]
+
+
+def test_shared_bulk_leaves_a_reserve_for_other_workers():
+    now = time.monotonic()
+    budget = multiprocessing.Array('d', [10.0, now, 0.0])
+    bulk_worker = bot.PriorityLaneRateLimiter(10, 8, shared_budget=budget)
+    interactive_worker = bot.PriorityLaneRateLimiter(10, 8, shared_budget=budget)
+
+    bulk_taken = 0
+    while bulk_worker._try_take_token('bulk', now):
+        bulk_taken += 1
+    reserve = 10 * bot.OUTBOUND_SHARED_RESERVE['bulk']
+    assert bulk_taken == 10 - reserve
+    # Dusre worker ki interactive lane ko reserve turant milta hai.
+    assert all(interactive_worker._try_take_token('interactive', now) for _ in range(int(reserve)))
+    assert not interactive_worker._try_take_token('interactive', now)
+
+
+def test_flood_pause_is_shared_by_all_workers():
+    now = time.monotonic()
+    budget = multiprocessing.Array('d', [10.0, now, 0.0])
+    paused_worker = bot.PriorityLaneRateLimiter(10, 8, shared_budget=budget)
+    other_worker = bot.PriorityLaneRateLimiter(10, 8, shared_budget=budget)
+
+    paused_worker._pause(now + 5)
+    assert not other_worker._try_take_token('interactive', now)
+    assert other_worker._seconds_until_token('interactive', now) == pytest.approx(5)
+    assert other_worker._try_take_token('interactive', now + 5)
@@ -0,0 +1,43 @@
+# replay_updates.py ka InMemorySupabase bot.py ke saath chalna chahiye (capacity testing).
+# Run with: python -m pytest -q tests
+
+import os
+import re
+from collections import Counter
+
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('USDT_WALLET', 'test-wallet')
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_KEY', 'test.test.test')
+
+import pytest
+
+import bot
+import replay_updates
+
+BOT_SOURCE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot.py')
+
+
+def test_every_rpc_called_by_bot_has_a_stand_in():
+    with open(BOT_SOURCE_PATH, encoding='utf-8') as source_file:
+        called = set(re.findall(r"\.rpc\(\s*['\"]([a-z_]+)['\"]", source_file.read()))
+    assert called
+    assert called - replay_updates.InMemorySupabase.RPC_STAND_INS == set()
+
+
+def test_unknown_rpc_is_rejected():
+    db = replay_updates.InMemorySupabase(0, Counter())
+    with pytest.raises(NotImplementedError):
+        db.rpc('increment_daily_ticket', {}).execute()
+
+
+def test_recorder_scrubs_link_urls():
+    recorder = bot.UpdateRecorder.__new__(bot.UpdateRecorder)
+    recorder.secret = b'test-secret'
+    entity = {'type': 'text_link', 'offset': 0, 'length': 4, 'url': 'https://private.example.com/invite?token=abc'}
+    scrubbed = recorder.scrub({'message': {'text': 'link', 'entities': [entity]}})
+    scrubbed_entity = scrubbed['message']['entities'][0]
+    assert 'private' not in scrubbed_entity['url']
+    assert scrubbed_entity['url'] == recorder.scrub(entity)['url'] # same url -> same pseudonym
+    assert (scrubbed_entity['offset'], scrubbed_entity['length']) == (0, 4)
@@ -0,0 +1,57 @@
+# Update routing to worker processes (bot.py "Multi-Process Run Mode").
+# Run with: python -m pytest -q tests
+
+import os
+
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('USDT_WALLET', 'test-wallet')
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_KEY', 'test.test.test')
+
+import bot
+
+USER_IDS = range(10**6, 10**6 + 5000)
+
+
+def message_from(user_id: int, text: str = 'hi') -> dict:
+    return {'update_id': 1, 'message': {'message_id': 1, 'from': {'id': user_id}, 'chat': {'id': user_id}, 'text': text}}
+
+
+def test_ring_moves_few_users_when_a_worker_is_added():
+    four, five = bot.build_worker_ring(4), bot.build_worker_ring(5)
+    moved = [user_id for user_id in USER_IDS if bot.worker_for_user(four, user_id) != bot.worker_for_user(five, user_id)]
+    # Consistent hashing: sirf naye worker ka hissa (~1/5) hilta hai, aur sirf usi par jaata hai.
+    assert 0 < len(moved) < len(USER_IDS) * 0.3
+    assert {bot.worker_for_user(five, user_id) for user_id in moved} == {4}
+
+
+def test_ring_spreads_users_over_every_worker():
+    ring = bot.build_worker_ring(4)
+    counts = [0] * 4
+    for user_id in USER_IDS:
+        counts[bot.worker_for_user(ring, user_id)] += 1
+    assert min(counts) > len(USER_IDS) / 4 * 0.7
+
+
+def test_user_updates_stay_on_one_worker():
+    ring = bot.build_worker_ring(4)
+    user_id = 123456789
+    callback = {'update_id': 2, 'callback_query': {'id': 'q', 'from': {'id': user_id}, 'data': 'paid_1_4.00'}}
+    assert bot.route_update(ring, message_from(user_id)) == bot.route_update(ring, callback) == bot.worker_for_user(ring, user_id)
+
+
+def test_admin_goes_to_worker_zero():
+    ring = bot.build_worker_ring(4)
+    assert bot.route_update(ring, message_from(bot.ADMIN_ID, '/stats')) == 0
+    assert bot.route_update(ring, {'update_id': 3}) == 0
+
+
+def test_confirm_payment_goes_to_the_claimants_worker():
+    ring = bot.build_worker_ring(4)
+    claimant = next(user_id for user_id in USER_IDS if bot.worker_for_user(ring, user_id) != 0)
+    expected = bot.worker_for_user(ring, claimant)
+    assert bot.route_update(ring, message_from(bot.ADMIN_ID, f"/confirm_payment {claimant}")) == expected
+    assert bot.route_update(ring, message_from(bot.ADMIN_ID, f"/confirm_payment@TrustWinBot {claimant} 4")) == expected
+    # Kisi aur user ka /confirm_payment uske apne worker par hi rehta hai.
+    assert bot.route_update(ring, message_from(claimant, f"/confirm_payment {claimant}")) == expected